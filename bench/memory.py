@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+helptext="""\
+Usage: memory.py [-h] [-s sizes] [-t n] [-o results.json] [-b budget.json]
+                 [--save]
+
+Measure, with tracemalloc, how much memory the exercise library and
+prepared routines cost, using synthetic guides and routines (see
+lib/corpus.py):
+
+ exercise_definition  bytes per exercise in a parsed Guide
+ prepared_exercise    bytes per Exercise in a prepared Routine, each with
+                      its sounder and countdowns
+ guide                bytes per Guide of ten exercises in a GuideBook
+ repeated_guide       bytes per Guide of ten exercises in a GuideBook, all
+                      repeating the same descriptions and tips
+
+Each is measured at several sizes, and the largest per-item cost compared
+against a stored budget; the exit status is 1 if any exceeds it.
+
+Optional arguments:
+ -s sizes   Comma separated sizes to measure at (default 10,100,1000)
+ -t n       List the n source lines allocating the most for each (default 5)
+ -o file    Also write the results, as JSON, to file
+ -b file    The budget to compare against
+            (default bench/baselines/memory.json)
+ --save     Save these results, plus 25% headroom, as the new budget
+"""
+
+import sys,os,io,json,getopt
+
+root=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+sys.path.append(os.path.join(root,'lib'))
+import benchmark,corpus,guide,routine
+
+headroom=1.25
+
+def load_guide(text,filename='synthetic'):
+    g=guide.Guide()
+    g.load_io(io.StringIO(text))
+    g.filename=filename
+    return g
+
+def exercise_definition(n):
+    text=corpus.guide_text(n)
+    return lambda: load_guide(text)
+
+def prepared_exercise(n):
+    g=load_guide(corpus.guide_text(100))
+    text=corpus.routine_text(n,corpus.exercise_ids(100))
+    rf=routine.RoutineFile()
+    rf.add_guide(g)
+    return lambda: rf.load_io(io.StringIO(text))
+
+def guide_per_book(n,repeated=False):
+    texts=[corpus.guide_text(10,0 if repeated else seed,'guide{0}'.format(seed))
+      for seed in range(n)]
+    def load_book():
+        book=guide.GuideBook()
+        for (i,text) in enumerate(texts):
+            book.add_guide(load_guide(text,'synthetic{0}'.format(i)))
+        return book
+    return load_book
+
+measures={
+  'exercise_definition':exercise_definition,
+  'prepared_exercise':prepared_exercise,
+  'guide':guide_per_book,
+  'repeated_guide':lambda n: guide_per_book(n,True),
+}
+
+def main(argv):
+    try:
+        (opts,args)=getopt.getopt(argv,"hs:t:o:b:",["help","save"])
+    except getopt.GetoptError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    sizes=[10,100,1000]
+    top=5
+    output=None
+    budget=os.path.join(root,"bench/baselines/memory.json")
+    save=False
+    for (opt,val) in opts:
+        if opt in ('-h','--help'):
+            print(helptext)
+            return 0
+        elif opt=='-s':
+            sizes=[int(size) for size in val.split(',')]
+        elif opt=='-t':
+            top=int(val)
+        elif opt=='-o':
+            output=val
+        elif opt=='-b':
+            budget=val
+        elif opt=='--save':
+            save=True
+
+    results={}
+    for name in sorted(measures):
+        per_item={}
+        for n in sizes:
+            make=measures[name](n)
+            (kept,size,sites)=benchmark.measure_memory(make,top)
+            del kept
+            per_item[str(n)]=size/n
+            print("{0:20} n={1:<7} {2:12.0f} bytes {3:9.0f} bytes each".format(
+              name,n,size,size/n
+            ))
+        for (site,size) in sites:
+            print("    {0:30} {1:12.0f} bytes".format(site,size))
+        results[name]={
+          'bytes_each':per_item,
+          'largest':per_item[str(max(sizes))]
+        }
+    if output:
+        benchmark.save_results(results,output)
+    if save:
+        benchmark.save_results({name:int(results[name]['largest']*headroom)
+          for name in results},budget)
+        return 0
+    if not os.path.exists(budget):
+        print("No budget to compare against at",budget)
+        return 0
+    status=0
+    budgets=benchmark.load_results(budget)
+    for name in sorted(budgets):
+        if name in results and results[name]['largest']>budgets[name]:
+            print("OVER BUDGET {0}: {1:.0f} bytes each, budget {2}".format(
+              name,results[name]['largest'],budgets[name]
+            ))
+            status=1
+    return status
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
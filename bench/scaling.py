@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+helptext="""\
+Usage: scaling.py [-h] [--min n] [--max n] [-o results.json]
+
+Measure how the loaders and lookups scale, using synthetic guides and
+routines (see lib/corpus.py) at sizes from --min to --max in powers of ten:
+
+ guide_load     Guide.load_io of a guide with n exercises
+ guidebook_add  GuideBook.add_guide of ten guides totalling n exercises
+ get_exercise   1000 GuideBook.get_exercise lookups in a book of n exercises
+ routine_load   RoutineFile.load_io_into of a routine of n lines
+
+For each it reports the time and throughput at every size, and the
+exponent k of the best fitting time=c*n**k.  The exit status is 1 if any
+exponent is more than 0.3 above what the operation should cost (linear for
+the loads, constant for the fixed number of lookups).
+
+Optional arguments:
+ --min n    Smallest size (default 10)
+ --max n    Largest size (default 10000; 1000000 takes a good while)
+ -o file    Also write the results, as JSON, to file
+"""
+
+import sys,os,io,json,getopt,random
+
+root=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+sys.path.append(os.path.join(root,'lib'))
+import benchmark,corpus,guide,routine
+
+lookups=1000
+margin=0.3
+
+def load_guide(text):
+    g=guide.Guide()
+    g.load_io(io.StringIO(text))
+    return g
+
+def bench_guide_load(n):
+    text=corpus.guide_text(n)
+    return benchmark.best_time(lambda: load_guide(text))
+
+def bench_guidebook_add(n):
+    guides=[]
+    ids=corpus.exercise_ids(n)
+    per_guide=max(1,n//10)
+    for i in range(0,n,per_guide):
+        g=guide.Guide()
+        g.exercises={ex_id:['name','desc',[]] for ex_id in ids[i:i+per_guide]}
+        g.filename='guide{0}'.format(i)
+        guides.append(g)
+    def add_all():
+        book=guide.GuideBook()
+        for g in guides:
+            book.add_guide(g)
+    return benchmark.best_time(add_all)
+
+def bench_get_exercise(n):
+    book=guide.GuideBook()
+    ids=corpus.exercise_ids(n)
+    g=guide.Guide()
+    g.exercises={ex_id:['name','desc',[]] for ex_id in ids}
+    g.filename='guide'
+    book.add_guide(g)
+    rng=random.Random(0)
+    wanted=[rng.choice(ids) for i in range(lookups)]
+    def look_up():
+        for ex_id in wanted:
+            book.get_exercise(ex_id)
+    return benchmark.best_time(look_up)
+
+def bench_routine_load(n):
+    g=load_guide(corpus.guide_text(100))
+    text=corpus.routine_text(n,corpus.exercise_ids(100))
+    rf=routine.RoutineFile()
+    rf.add_guide(g)
+    return benchmark.best_time(lambda: rf.load_io(io.StringIO(text)))
+
+# name: (function, expected exponent)
+benchmarks={
+  'guide_load':(bench_guide_load,1),
+  'guidebook_add':(bench_guidebook_add,1),
+  'get_exercise':(bench_get_exercise,0),
+  'routine_load':(bench_routine_load,1),
+}
+
+def main(argv):
+    try:
+        (opts,args)=getopt.getopt(argv,"ho:",["help","min=","max="])
+    except getopt.GetoptError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    smallest=10
+    largest=10000
+    output=None
+    for (opt,val) in opts:
+        if opt in ('-h','--help'):
+            print(helptext)
+            return 0
+        elif opt=='--min':
+            smallest=int(val)
+        elif opt=='--max':
+            largest=int(val)
+        elif opt=='-o':
+            output=val
+
+    sizes=[]
+    n=smallest
+    while n<=largest:
+        sizes.append(n)
+        n*=10
+
+    results={}
+    status=0
+    for name in sorted(benchmarks):
+        (func,expected)=benchmarks[name]
+        times=[]
+        for n in sizes:
+            taken=func(n)
+            times.append(taken)
+            items=lookups if expected==0 else n
+            print("{0:14} n={1:<8} {2:10.6f}s {3:12.0f}/s".format(
+              name,n,taken,items/taken
+            ))
+        exponent=benchmark.fit_exponent(sizes,times)
+        results[name]={
+          'sizes':sizes,
+          'seconds':times,
+          'exponent':exponent,
+          'expected_exponent':expected
+        }
+        if exponent>expected+margin:
+            print("SUPERLINEAR {0}: time grows as n**{1:.2f}".format(
+              name,exponent
+            ))
+            status=1
+    print(json.dumps({name:round(results[name]['exponent'],2)
+      for name in results},sort_keys=True))
+    if output:
+        benchmark.save_results(results,output)
+    return status
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+helptext="""\
+Usage: timing.py [-h] [-d seconds] [-e exercises] [--cpu n] [--cpu-threads n]
+                 [--io n] [-o results.json] [-b baseline.json] [--save]
+
+Measure the timing accuracy of a Countdown and of a short routine, in real
+time and under optional synthetic load: per-tick error and jitter, cue
+latency and cumulative drift.  Results are printed as JSON, and compared
+against a baseline; the exit status is 1 if any have regressed.
+
+Optional arguments:
+ -d seconds       How long a countdown to time (default 10)
+ -e exercises     How many 4s exercises the routine has (default 3)
+ --cpu n          Run n CPU-spinning processes alongside
+ --cpu-threads n  Run n CPU-spinning threads in this process alongside
+ --io n           Run n threads writing and syncing a scratch file alongside
+ -o file          Also write the results to file
+ -b file          The baseline to compare against
+                  (default bench/baselines/timing.json)
+ --save           Save these results as the new baseline instead
+"""
+
+import sys,os,io,json,getopt
+
+root=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+sys.path.append(os.path.join(root,'lib'))
+import benchmark,guide,routine
+
+# Allow this much worse than the baseline before calling it a regression:
+# half as much again, plus 20ms
+tolerance=0.5
+slack_ms=20
+
+def make_routine(exercises):
+    g=guide.Guide()
+    g.load_file(os.path.join(root,"data/exercises/kettlebell.yaml"))
+    rf=routine.RoutineFile()
+    rf.add_guide(g)
+    return rf.load_io(io.StringIO("kettle_swing,4,1,1\n"*exercises))
+
+def main(argv):
+    try:
+        (opts,args)=getopt.getopt(argv,"hd:e:o:b:",
+          ["help","cpu=","cpu-threads=","io=","save"]
+        )
+    except getopt.GetoptError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    duration=10
+    exercises=3
+    load={}
+    output=None
+    baseline=os.path.join(root,"bench/baselines/timing.json")
+    save=False
+    for (opt,val) in opts:
+        if opt in ('-h','--help'):
+            print(helptext)
+            return 0
+        elif opt=='-d':
+            duration=float(val)
+        elif opt=='-e':
+            exercises=int(val)
+        elif opt in ('--cpu','--cpu-threads','--io'):
+            load[opt[2:].replace('-','_')]=int(val)
+        elif opt=='-o':
+            output=val
+        elif opt=='-b':
+            baseline=val
+        elif opt=='--save':
+            save=True
+
+    r=make_routine(exercises)
+    with benchmark.Load(**load) as background:
+        results={
+          'load':background.describe(),
+          'countdown':benchmark.measure_countdown(duration),
+          'routine':benchmark.measure_routine(r)
+        }
+    print(json.dumps(results,indent=2,sort_keys=True))
+    if output:
+        benchmark.save_results(results,output)
+    if save:
+        benchmark.save_results(results,baseline)
+        return 0
+    if not os.path.exists(baseline):
+        print("No baseline to compare against at",baseline)
+        return 0
+    regressions=benchmark.compare(results,benchmark.load_results(baseline),
+      tolerance,slack_ms,
+      ignore=('load','count','tick_error_histogram','cue_latency_histogram')
+    )
+    for (key,base,result) in regressions:
+        print("REGRESSION {0}: baseline {1}, now {2}".format(key,base,result))
+    return 1 if regressions else 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
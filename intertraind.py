@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+helptext="""\
+Usage: intertraind.py [-h] [-s socket] [-t cache] [--stats] [--stop]
+
+Run the intertrain daemon, which keeps parsed guides and routines in memory
+so that entry points run with --daemon can start their routines straight
+away.
+
+Optional arguments:
+ -s socket  The Unix socket to listen on (or talk to, with --stats/--stop)
+ -t cache   Keep each set of guides' tag index in a file named after cache,
+              so a restarted daemon needn't build it again
+ --stats    Print the cache statistics of a running daemon, and exit
+ --stop     Ask a running daemon to shut down
+"""
+
+import sys,getopt,json,logging
+
+sys.path.append('./lib')
+import daemonclient
+
+def main(argv):
+    try:
+        (opts,args)=getopt.getopt(argv,"hs:t:",["help","stats","stop"])
+    except getopt.GetoptError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    path=daemonclient.DEFAULT_SOCKET
+    index_cache=None
+    command=None
+    for (opt,val) in opts:
+        if opt in ('-h','--help'):
+            print(helptext)
+            return 0
+        elif opt=='-s':
+            path=val
+        elif opt=='-t':
+            index_cache=val
+        else:
+            command=opt[2:]
+
+    if command:
+        client=daemonclient.DaemonClient(path)
+        try:
+            if command=='stats':
+                print(json.dumps(client.stats(),indent=2))
+            else:
+                client.shutdown()
+        except OSError as e:
+            print("No daemon listening on {0}: {1}".format(path,e))
+            return 1
+        return 0
+
+    import daemon
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('exercise').setLevel(logging.INFO)
+    try:
+        d=daemon.Daemon(path,index_cache)
+    except OSError as e:
+        print(str(e))
+        return 1
+    print("Listening on",path)
+    d.serve()
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+"""
+Helpers for the benchmark suites in bench/: summary statistics, synthetic
+background load, timing measurements, and machine-readable results which
+can be compared against a stored baseline.
+"""
+
+import os, io, sys, gc, json, math, time, tempfile, threading, unittest
+import multiprocessing, tracemalloc
+import clocks, countdown, cueplan, simulate
+
+def percentile(values, p):
+    """Return the p'th percentile (0-100) of values, by linear interpolation"""
+    if not values:
+        return 0.0
+    ordered=sorted(values)
+    rank=(len(ordered)-1)*p/100
+    lo=int(math.floor(rank))
+    hi=min(lo+1, len(ordered)-1)
+    return ordered[lo]+(ordered[hi]-ordered[lo])*(rank-lo)
+
+def summarise(values):
+    """Summarise a list of measurements: count, mean, p50, p99 and max"""
+    return {
+      'count':len(values),
+      'mean':sum(values)/len(values) if values else 0.0,
+      'p50':percentile(values, 50),
+      'p99':percentile(values, 99),
+      'max':max(values) if values else 0.0
+    }
+
+def histogram(values, width):
+    """Count values into buckets 'width' wide, keyed by each bucket's floor"""
+    buckets={}
+    for value in values:
+        floor=math.floor(value/width)*width
+        buckets[floor]=buckets.get(floor, 0)+1
+    return dict(sorted(buckets.items()))
+
+def fit_exponent(sizes, times):
+    """
+    Fit times=c*sizes**k by least squares on a log-log scale, and return k:
+    roughly 0 for constant cost, 1 for linear, 2 for quadratic
+    """
+    points=[(math.log(n), math.log(t)) for (n, t) in zip(sizes, times)
+      if n>0 and t>0]
+    if len(points)<2:
+        return 0.0
+    mean_x=sum(x for (x, y) in points)/len(points)
+    mean_y=sum(y for (x, y) in points)/len(points)
+    var=sum((x-mean_x)**2 for (x, y) in points)
+    cov=sum((x-mean_x)*(y-mean_y) for (x, y) in points)
+    return cov/var
+
+def best_time(func, repeat=3):
+    """Run func repeat times, returning the fastest time in seconds"""
+    best=None
+    for i in range(repeat):
+        started=time.perf_counter()
+        func()
+        taken=time.perf_counter()-started
+        if best==None or taken<best:
+            best=taken
+    return best
+
+def measure_memory(func, top=0):
+    """
+    Call func, and measure how many bytes of memory the objects it created
+    and kept hold of (typically those reachable from its return value)
+    occupy, using tracemalloc.  Returns (result, bytes, sites), where sites
+    lists the top allocating source lines as (filename:line, bytes) when top
+    is non-zero.
+    """
+    gc.collect()
+    tracing=tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before=tracemalloc.take_snapshot()
+        result=func()
+        gc.collect()
+        after=tracemalloc.take_snapshot()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    diff=after.compare_to(before, 'lineno')
+    size=sum(stat.size_diff for stat in diff)
+    sites=[("{0}:{1}".format(os.path.basename(stat.traceback[0].filename),
+      stat.traceback[0].lineno), stat.size_diff) for stat in diff[:top]]
+    return (result, size, sites)
+
+def burn(stop):
+    while not stop.is_set():
+        sum(i*i for i in range(10000))
+
+def churn(stop, directory):
+    with tempfile.TemporaryFile(dir=directory) as f:
+        block=os.urandom(64*1024)
+        while not stop.is_set():
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+            if f.tell()>16*1024*1024:
+                f.seek(0)
+
+class Load(object):
+    """
+    Synthetic background load, for use as a context manager:
+
+        cpu         number of processes spinning on the CPU
+        cpu_threads number of threads spinning in this process, competing
+                      with the timing loop for the interpreter
+        io          number of threads writing and syncing a scratch file
+    """
+
+    def __init__(self, cpu=0, cpu_threads=0, io=0):
+        self.cpu=cpu
+        self.cpu_threads=cpu_threads
+        self.io=io
+
+    def __enter__(self):
+        self.process_stop=multiprocessing.Event()
+        self.thread_stop=threading.Event()
+        self.scratch=tempfile.TemporaryDirectory()
+        self.workers=[
+          multiprocessing.Process(target=burn, args=(self.process_stop,))
+          for i in range(self.cpu)
+        ]+[
+          threading.Thread(target=burn, args=(self.thread_stop,))
+          for i in range(self.cpu_threads)
+        ]+[
+          threading.Thread(target=churn,
+            args=(self.thread_stop, self.scratch.name)
+          )
+          for i in range(self.io)
+        ]
+        for worker in self.workers:
+            worker.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.process_stop.set()
+        self.thread_stop.set()
+        for worker in self.workers:
+            worker.join()
+        self.scratch.cleanup()
+        return False
+
+    def describe(self):
+        return {'cpu':self.cpu, 'cpu_threads':self.cpu_threads, 'io':self.io}
+
+def measure_countdown(duration, interval=1, clock=None):
+    """
+    Run a Countdown, measuring how late each tick callback ran against its
+    ideal time, the jitter between successive ticks, and the drift at the
+    finish.  All results are in milliseconds.
+    """
+    if clock==None:
+        clock=clocks.default
+    ticks=[]
+    finished=[]
+    timer=countdown.Countdown(duration,
+      lambda: finished.append(clock.time()),
+      lambda t: ticks.append((t, clock.time())),
+      interval=interval, clock=clock
+    )
+    timer.start()
+    errors=[(at-timer.started-t)*1000 for (t, at) in ticks]
+    jitter=[abs(b-a) for (a, b) in zip(errors, errors[1:])]
+    return {
+      'tick_error_ms':summarise(errors),
+      'tick_jitter_ms':summarise(jitter),
+      'tick_error_histogram':histogram(errors, 10),
+      'drift_ms':(finished[0]-timer.started-duration)*1000
+    }
+
+def measure_routine(routine, clock=None):
+    """
+    Run a prepared routine with silent, recording sounders, measuring how
+    late each cue sounded against its compiled plan (see cueplan.py), and
+    the drift at the end of the routine.  Results are in milliseconds.
+    """
+    if clock==None:
+        clock=clocks.default
+    plan=cueplan.compile_plan(routine)
+    # Run just as simulate() runs it, only against the given clock
+    (cues, started, finished)=simulate.run(routine, clock)
+    latency=[(at-started-planned)*1000
+      for ((at, s1), (planned, s2)) in zip(cues, plan.get_cues())]
+    return {
+      'cue_latency_ms':summarise(latency),
+      'cue_latency_histogram':histogram(latency, 10),
+      'missing_cues':len(plan.get_cues())-len(cues),
+      'drift_ms':(finished-started-plan.get_total_time())*1000
+    }
+
+def save_results(results, filename):
+    with io.open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def load_results(filename):
+    with io.open(filename) as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance=0.5, slack=0, ignore=()):
+    """
+    Compare numeric results against a baseline, where lower is better.
+    Returns a list of (key path, baseline, result) for every result that
+    has got worse by more than the tolerance (a fraction of the baseline)
+    plus slack (an absolute amount).  Keys missing from the results are
+    reported too.  Keys named in ignore are skipped, wherever they appear.
+    """
+    regressions=[]
+    def walk(path, base, result):
+        if isinstance(base, dict):
+            for key in base:
+                if key in ignore:
+                    continue
+                if isinstance(result, dict) and key in result:
+                    walk(path+[key], base[key], result[key])
+                else:
+                    regressions.append(('.'.join(path+[key]), base[key], None))
+        elif isinstance(base, (int, float)) and not isinstance(base, bool):
+            if abs(result)>abs(base)*(1+tolerance)+slack:
+                regressions.append(('.'.join(path), base, result))
+    walk([], baseline, results)
+    return regressions
+
+#####################################################################
+# Test code
+
+import guide, routine
+
+class TestStatistics(unittest.TestCase):
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(percentile([3], 99), 3)
+        self.assertEqual(percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertEqual(percentile(list(range(101)), 99), 99)
+        self.assertEqual(percentile([1, 2], 100), 2)
+
+    def test_summarise(self):
+        s=summarise([1, 2, 3, 4])
+        self.assertEqual(s['count'], 4)
+        self.assertEqual(s['mean'], 2.5)
+        self.assertEqual(s['max'], 4)
+        self.assertEqual(summarise([])['p99'], 0.0)
+
+    def test_histogram(self):
+        self.assertEqual(histogram([1, 9, 10, 25, -3], 10),
+          {-10:1, 0:2, 10:1, 20:1}
+        )
+
+    def test_fit_exponent(self):
+        sizes=[10, 100, 1000, 10000]
+        self.assertAlmostEqual(fit_exponent(sizes, [3*n for n in sizes]), 1)
+        self.assertAlmostEqual(fit_exponent(sizes, [n*n for n in sizes]), 2)
+        self.assertAlmostEqual(fit_exponent(sizes, [5 for n in sizes]), 0)
+        self.assertEqual(fit_exponent([10], [1]), 0.0)
+
+    def test_best_time(self):
+        calls=[]
+        self.assertGreaterEqual(best_time(lambda: calls.append(1), 4), 0)
+        self.assertEqual(len(calls), 4)
+
+    def test_measure_memory(self):
+        (result, size, sites)=measure_memory(
+          lambda: [bytearray(1000) for i in range(2)], top=1
+        )
+        self.assertEqual(len(result), 2)
+        self.assertGreaterEqual(size, 2000)
+        self.assertLess(size, 4000)
+        self.assertEqual(len(sites), 1)
+        self.assertTrue(sites[0][0].startswith('benchmark.py:'))
+        (result, size, sites)=measure_memory(lambda: None)
+        self.assertLess(size, 1000)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_compare(self):
+        baseline={'a':{'p99':10, 'max':20}, 'drift':5, 'name':'x'}
+        self.assertEqual(compare(
+          {'a':{'p99':14, 'max':20}, 'drift':-7, 'name':'y'}, baseline
+        ), [])
+        self.assertEqual(compare(
+          {'a':{'p99':16}, 'drift':5}, baseline
+        ), [('a.p99', 10, 16), ('a.max', 20, None), ('name', 'x', None)])
+        self.assertEqual(compare({'drift':9}, {'drift':5}, 0.5, 2), [])
+        self.assertEqual(compare({}, {'drift':5}, ignore=('drift',)), [])
+        self.assertEqual(compare({'drift':10}, {'drift':5}, 0.5, 2),
+          [('drift', 5, 10)]
+        )
+
+class TestMeasure(unittest.TestCase):
+    def test_countdown(self):
+        results=measure_countdown(30, clock=clocks.VirtualClock())
+        self.assertEqual(results['tick_error_ms']['count'], 30)
+        self.assertEqual(results['tick_error_ms']['max'], 0)
+        self.assertEqual(results['drift_ms'], 0)
+
+        results=measure_countdown(0.3, 0.1)
+        self.assertEqual(results['tick_error_ms']['count'], 0)
+        self.assertLess(abs(results['drift_ms']), 50)
+
+    def test_routine(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        r=rf.load_file("data/routines/upperbody2")
+        results=measure_routine(r, clocks.VirtualClock())
+        self.assertEqual(results['cue_latency_ms']['count'], 42)
+        self.assertEqual(results['cue_latency_ms']['max'], 0)
+        self.assertEqual(results['missing_cues'], 0)
+        self.assertEqual(results['drift_ms'], 0)
+        self.assertNotIsInstance(r.exercises[0].sounder,
+          simulate.RecordingSounder
+        )
+
+    def test_load(self):
+        with Load(cpu=1, cpu_threads=1, io=1) as load:
+            self.assertEqual(len(load.workers), 3)
+            time.sleep(0.1)
+        self.assertEqual(load.describe(), {'cpu':1, 'cpu_threads':1, 'io':1})
+        for worker in load.workers:
+            self.assertFalse(worker.is_alive())
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,384 @@
+#!/usr/bin/python3
+"""
+Fan-out of live routine events to many displays on the local network.
+
+A Broadcaster is a tracing sink (see tracing.py) serving a TCP port:
+
+    b=broadcast.Broadcaster(port=8765)
+    b.start()
+    tracing.add_sink(b)
+    r.start()
+
+Each phase change, tick and cue is encoded once, as a line of JSON, and the
+same bytes are queued for every subscriber.  An asyncio loop in a thread of
+its own writes each subscriber's queue out at whatever pace that subscriber
+reads; the queues are bounded, so a subscriber that falls behind loses its
+oldest events rather than holding up the routine or the other subscribers.
+How long each event waits to be written is recorded per subscriber, and
+overall in the default metrics registry.
+
+Where the network allows it, a Multicaster sends each event as one UDP
+datagram to a multicast group instead, however many are listening; there's
+no back-pressure to handle then, but nor is delivery guaranteed.
+"""
+
+import json, time, socket, asyncio, threading, collections, unittest
+import tracing, metrics
+
+lag=metrics.registry.histogram('broadcast_lag_seconds',
+  "How long each event waited to be written to a subscriber"
+)
+dropped=metrics.registry.counter('broadcast_dropped_total',
+  "Events dropped for subscribers that fell behind"
+)
+subscribers=metrics.registry.gauge('broadcast_subscribers',
+  "Subscribers currently connected"
+)
+
+def encode(event, fields):
+    """Encode a trace event as a line of JSON, with its fields by name"""
+    message=dict(zip(tracing.FIELDS.get(event, ()), fields))
+    message['event']=event
+    message['time']=time.time()
+    return (json.dumps(message, separators=(',', ':'))+"\n").encode()
+
+class Subscriber(object):
+    """One connected display: its queue of waiting events, and its lag"""
+
+    def __init__(self, writer, queue_size):
+        self.writer=writer
+        self.queue=collections.deque(maxlen=queue_size)
+        self.ready=asyncio.Event()
+        self.sent=0
+        self.dropped=0
+        self.lag=0
+        self.max_lag=0
+
+    def put(self, queued, data):
+        if len(self.queue)==self.queue.maxlen:
+            self.dropped+=1
+            dropped.inc()
+        self.queue.append((queued, data))
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                (queued, data)=self.queue.popleft()
+                self.writer.write(data)
+                await self.writer.drain()
+                self.sent+=1
+                self.lag=time.monotonic()-queued
+                self.max_lag=max(self.max_lag, self.lag)
+                lag.observe(self.lag)
+
+    def get_stats(self):
+        return {'sent':self.sent, 'dropped':self.dropped,
+          'queued':len(self.queue), 'lag':self.lag, 'max_lag':self.max_lag}
+
+class Broadcaster(object):
+    def __init__(self, port=0, host='127.0.0.1', queue_size=256,
+      write_buffer=65536):
+        """
+        Optional parameters:
+            port, host  Where to listen; port 0 picks a free port, which
+                        get_port() gives once started
+            queue_size  How many events to hold for a subscriber that's
+                        behind, before dropping its oldest
+            write_buffer How many bytes may sit unsent in a subscriber's
+                        socket before its queue starts to fill
+        """
+        self.host=host
+        self.port=port
+        self.queue_size=queue_size
+        self.write_buffer=write_buffer
+        self.subscribers={}     # Subscriber -> the task writing to it
+        self.loop=None
+        self.thread=None
+        # Held while the loop is handed over, so nothing's published to a
+        # loop that's stopping or closed
+        self.lock=threading.Lock()
+
+    def start(self):
+        """
+        Start serving in a background thread
+
+        Throws: OSError if the port can't be listened on
+        """
+        started=threading.Event()
+        failed=[]
+        def serve():
+            loop=asyncio.new_event_loop()
+            try:
+                self.server=loop.run_until_complete(
+                  asyncio.start_server(self.__subscribe, self.host, self.port)
+                )
+            except OSError as e:
+                failed.append(e)
+                started.set()
+                loop.close()
+                return
+            self.port=self.server.sockets[0].getsockname()[1]
+            with self.lock:
+                self.loop=loop
+            started.set()
+            loop.run_forever()
+            loop.run_until_complete(self.__close())
+            loop.close()
+        self.thread=threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        if failed:
+            self.thread.join()
+            self.thread=None
+            raise failed[0]
+
+    def get_port(self):
+        return self.port
+
+    async def __subscribe(self, reader, writer):
+        writer.transport.set_write_buffer_limits(self.write_buffer)
+        subscriber=Subscriber(writer, self.queue_size)
+        task=asyncio.current_task()
+        self.subscribers[subscriber]=task
+        subscribers.set(len(self.subscribers))
+        try:
+            await subscriber.run()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            del self.subscribers[subscriber]
+            subscribers.set(len(self.subscribers))
+            writer.close()
+
+    def __publish(self, queued, data):
+        for subscriber in self.subscribers:
+            subscriber.put(queued, data)
+
+    def __call__(self, event, fields):
+        """Publish a trace event to every subscriber, from any thread"""
+        self.publish(encode(event, fields))
+
+    def publish(self, data):
+        """Publish bytes to every subscriber, from any thread"""
+        with self.lock:
+            if self.loop:
+                self.loop.call_soon_threadsafe(self.__publish,
+                  time.monotonic(), data
+                )
+
+    def get_stats(self):
+        """Return a list of each subscriber's sent, dropped and lag stats"""
+        return self.__call(lambda: [s.get_stats() for s in self.subscribers])
+
+    def __call(self, func):
+        return asyncio.run_coroutine_threadsafe(self.__async(func),
+          self.loop
+        ).result()
+
+    async def __async(self, func):
+        return func()
+
+    async def __close(self):
+        self.server.close()
+        tasks=list(self.subscribers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def stop(self):
+        """Disconnect every subscriber and stop serving"""
+        if self.thread:
+            with self.lock:
+                (loop, self.loop)=(self.loop, None)
+            if loop:
+                loop.call_soon_threadsafe(loop.stop)
+            self.thread.join()
+            self.thread=None
+
+class Multicaster(object):
+    """
+    A tracing sink sending each event as a single UDP datagram, to a
+    multicast group (or any address) and port
+    """
+
+    def __init__(self, group, port, ttl=1):
+        self.address=(group, port)
+        self.socket=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+    def __call__(self, event, fields):
+        self.socket.sendto(encode(event, fields), self.address)
+
+    def close(self):
+        self.socket.close()
+
+#####################################################################
+# Test code
+
+import sys, clocks, exercise
+from sounderinterface import QuietSounder
+
+class TestBroadcast(unittest.TestCase):
+    def setUp(self):
+        self.broadcaster=Broadcaster()
+        self.broadcaster.start()
+
+    def tearDown(self):
+        self.broadcaster.stop()
+
+    def wait_for(self, count):
+        # Subscribers connect asynchronously; wait until they all have
+        deadline=time.monotonic()+10
+        while len(self.broadcaster.get_stats())<count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_many(self):
+        clients=300
+        events=50
+        async def client(received):
+            (reader, writer)=await asyncio.open_connection('127.0.0.1',
+              self.broadcaster.get_port()
+            )
+            lines=[]
+            connected.release()
+            while len(lines)<events:
+                lines.append(json.loads(await reader.readline()))
+            writer.close()
+            received.append(lines)
+        async def run_clients():
+            received=[]
+            await asyncio.gather(*(client(received) for i in range(clients)))
+            return received
+
+        connected=threading.Semaphore(0)
+        result=[]
+        thread=threading.Thread(target=lambda: result.append(
+          asyncio.run(run_clients())
+        ))
+        thread.start()
+        for i in range(clients):
+            self.assertTrue(connected.acquire(timeout=10))
+        self.wait_for(clients)
+        for clock in range(events):
+            self.broadcaster(tracing.TICK, (1, clock))
+        thread.join(30)
+        self.assertEqual(len(result[0]), clients)
+        for lines in result[0]:
+            self.assertEqual([m['clock'] for m in lines], list(range(events)))
+            self.assertEqual(lines[0]['event'], 'tick')
+        for stats in self.broadcaster.get_stats():
+            self.assertEqual(stats['dropped'], 0)
+
+    def test_slow_subscriber(self):
+        self.broadcaster.stop()
+        self.broadcaster=Broadcaster(queue_size=4, write_buffer=1024)
+        self.broadcaster.start()
+        port=self.broadcaster.get_port()
+        # One subscriber never reads; the other reads everything
+        stalled=socket.create_connection(('127.0.0.1', port))
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        reader=socket.create_connection(('127.0.0.1', port))
+        self.wait_for(2)
+        data=b"x"*65535+b"\n"
+        count=100
+        received=[0]
+        def read():
+            with reader.makefile('rb') as f:
+                while received[0]<count and f.readline():
+                    received[0]+=1
+        thread=threading.Thread(target=read)
+        thread.start()
+        started=time.monotonic()
+        for i in range(count):
+            self.broadcaster.publish(data)
+            time.sleep(0.001)
+        thread.join(10)
+        self.assertEqual(received[0], count)
+        self.assertLess(time.monotonic()-started, 10)
+        stats=sorted(self.broadcaster.get_stats(), key=lambda s: s['sent'])
+        self.assertGreater(stats[0]['dropped'], 0)
+        self.assertEqual(stats[1]['dropped'], 0)
+        self.assertGreaterEqual(stats[1]['max_lag'], stats[1]['lag'])
+        stalled.close()
+        reader.close()
+
+    def test_stop_while_publishing(self):
+        errors=[]
+        def publish():
+            try:
+                while not done.is_set():
+                    broadcaster.publish(b"tick\n")
+            except Exception as e:
+                errors.append(e)
+        # Switch threads often, so publishing overlaps the loop closing
+        interval=sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        for i in range(50):
+            broadcaster=Broadcaster()
+            broadcaster.start()
+            done=threading.Event()
+            thread=threading.Thread(target=publish)
+            thread.start()
+            time.sleep(0.001)
+            broadcaster.stop()
+            time.sleep(0.001)
+            done.set()
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_failed_start(self):
+        taken=Broadcaster(self.broadcaster.get_port())
+        self.assertRaises(OSError, taken.start)
+        self.assertEqual(taken.thread, None)
+        # Nothing to stop, or publish to
+        taken.stop()
+        taken.publish(b"tick\n")
+
+    def test_routine_events(self):
+        sock=socket.create_connection(('127.0.0.1',
+          self.broadcaster.get_port()
+        ))
+        self.wait_for(1)
+        ex=exercise.Exercise("Swing")
+        ex.sounder=QuietSounder()
+        ex.set_clock(clocks.VirtualClock())
+        ex.prep(2, 1, 1)
+        tracing.add_sink(self.broadcaster)
+        try:
+            ex.start()
+        finally:
+            tracing.remove_sink(self.broadcaster)
+        with sock.makefile('rb') as f:
+            messages=[json.loads(f.readline()) for i in range(13)]
+        sock.close()
+        # The read and work countdowns each start, tick and finish too
+        self.assertEqual([m['event'] for m in messages], ['phase', 'start',
+          'tick', 'finish', 'phase', 'cue', 'start', 'tick', 'cue', 'tick',
+          'finish', 'phase', 'cue'
+        ])
+        self.assertEqual([m['phase'] for m in messages if 'phase' in m],
+          ['read', 'work', 'rest']
+        )
+        self.assertEqual(messages[5]['sound'], 'sounds/boop.ogg')
+
+    def test_multicast(self):
+        # Unicast to localhost: the same datagrams, without needing a route
+        # for multicast in the test environment
+        listener=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        m=Multicaster('127.0.0.1', listener.getsockname()[1])
+        m(tracing.CUE, ("Swing", 'sounds/beep.ogg'))
+        message=json.loads(listener.recv(65536))
+        self.assertEqual(message['sound'], 'sounds/beep.ogg')
+        m.close()
+        listener.close()
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+"""
+Crash-safe progress checkpoints for running routines.
+
+A checkpoint file is a run of fixed-size records, each the wall clock time it
+was written and how many seconds into the routine it had got.  Recording
+progress appends one record with a single write, so a crash can at worst
+lose the record being written; finding where to resume reads just the last
+complete record, however long the file has grown.
+
+    cp=checkpoint.Checkpoint("upperbody.checkpoint")
+    with checkpoint.Checkpointer(routine, cp):
+        routine.start(cp.get_offset())
+"""
+
+import os, struct, threading, time, unittest
+
+class Checkpoint(object):
+    # Wall clock time written, offset into the routine in seconds
+    RECORD=struct.Struct('<dd')
+
+    def __init__(self, filename, sync=True):
+        """
+        Open the checkpoint file, which needn't exist yet.  With sync set,
+        each record is flushed to disk as it's written, to survive power
+        failures as well as crashes.
+        """
+        self.filename=filename
+        self.sync=sync
+        self.fd=None
+
+    def record(self, offset):
+        """Append a record of having got offset seconds into the routine"""
+        if self.fd==None:
+            self.fd=os.open(self.filename,
+              os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644
+            )
+        os.write(self.fd, self.RECORD.pack(time.time(), offset))
+        if self.sync:
+            getattr(os, 'fdatasync', os.fsync)(self.fd)
+
+    def get_last(self):
+        """
+        Return (time written, offset) from the last complete record, or None
+        if there isn't one
+        """
+        try:
+            with open(self.filename, 'rb') as f:
+                size=os.fstat(f.fileno()).st_size
+                # Ignore any partly written record at the end
+                end=size-size%self.RECORD.size
+                if end==0:
+                    return None
+                f.seek(end-self.RECORD.size)
+                return self.RECORD.unpack(f.read(self.RECORD.size))
+        except FileNotFoundError:
+            return None
+
+    def get_offset(self):
+        """Return the offset to resume from: 0 if there's no checkpoint"""
+        last=self.get_last()
+        return last[1] if last else 0
+
+    def clear(self):
+        """Remove the checkpoint, once the routine is done with"""
+        self.close()
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self.fd!=None:
+            os.close(self.fd)
+            self.fd=None
+
+class Checkpointer(threading.Thread):
+    """
+    Records a running routine's progress to a Checkpoint every interval
+    seconds, whenever it has moved on.  Used as a context manager, it runs for
+    the duration of the with block and clears the checkpoint if the block
+    completes, leaving it in place to resume from if it raised.
+    """
+
+    def __init__(self, routine, checkpoint, interval=1):
+        super().__init__(daemon=True)
+        self.routine=routine
+        self.checkpoint=checkpoint
+        self.interval=interval
+        self.stopping=threading.Event()
+        self.last=None
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.save()
+
+    def save(self):
+        """Record the routine's progress now, if it's running and has moved"""
+        offset=self.routine.get_offset()
+        if offset!=None and offset!=self.last:
+            self.checkpoint.record(offset)
+            self.last=offset
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        if exc_type==None:
+            self.checkpoint.clear()
+        else:
+            self.checkpoint.close()
+        return False
+
+#####################################################################
+# Test code
+
+import tempfile
+import routine, clocks, guide, io
+from sounderinterface import QuietSounder
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.filename=os.path.join(self.dir.name, 'test.checkpoint')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_records(self):
+        cp=Checkpoint(self.filename, sync=False)
+        self.assertEqual(cp.get_last(), None)
+        self.assertEqual(cp.get_offset(), 0)
+        for offset in range(100):
+            cp.record(offset+0.5)
+        cp.close()
+        self.assertEqual(os.path.getsize(self.filename),
+          100*Checkpoint.RECORD.size
+        )
+        self.assertEqual(cp.get_offset(), 99.5)
+        self.assertLess(abs(cp.get_last()[0]-time.time()), 5)
+        # A torn final record is ignored
+        with open(self.filename, 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        self.assertEqual(Checkpoint(self.filename).get_offset(), 99.5)
+        cp.clear()
+        self.assertFalse(os.path.exists(self.filename))
+        cp.clear()
+
+    def test_resume_fast(self):
+        cp=Checkpoint(self.filename, sync=False)
+        for offset in range(3600*4):
+            cp.record(offset)
+        cp.close()
+        started=time.perf_counter()
+        self.assertEqual(Checkpoint(self.filename).get_offset(), 3600*4-1)
+        self.assertLess(time.perf_counter()-started, 0.005)
+
+    def test_checkpointer(self):
+        g=guide.Guide()
+        g.load_io(io.StringIO("ex:\n  Name: Test\n  Description: Test\n"))
+        r=routine.Routine()
+        r.get_guidebook().add_guide(g)
+        r.add_exercise("ex", 1, 0.2, 0)
+        r.add_exercise("ex", 1, 0.2, 0)
+        for ex in r.exercises:
+            ex.sounder=QuietSounder()
+        cp=Checkpoint(self.filename)
+        crash=Exception("Test crash")
+        def tick(clock):
+            raise crash
+        r.exercises[1].countdown.func_tick=tick
+        try:
+            with Checkpointer(r, cp, 0.05):
+                r.start()
+        except Exception as e:
+            self.assertIs(e, crash)
+        # Left a checkpoint part way through the second exercise
+        offset=cp.get_offset()
+        self.assertGreater(offset, 1)
+        self.assertLess(offset, 2.4)
+
+        r.exercises[1].countdown.func_tick=r.exercises[1].tick
+        started=time.time()
+        with Checkpointer(r, cp, 0.05):
+            r.start(cp.get_offset())
+        self.assertLess(time.time()-started, 2.4-offset+0.3)
+        self.assertFalse(os.path.exists(self.filename))
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+"""
+Clocks for Countdowns, Exercises and Routines to time themselves against.
+
+RealClock follows the system clock, sleeping in small steps just as the
+Countdown loop always has.  VirtualClock never sleeps: waiting on it jumps
+straight to the deadline, so a routine can be run through its exact event
+sequence, with the same callbacks, in no time at all.  OffsetClock runs a
+set amount ahead of (or behind) another clock, such as one synchronised
+with another machine's (see clocksync.py).
+"""
+
+import time, threading, unittest
+import exceptions
+
+class Interrupted(Exception):
+    """Raised out of a PausableClock's sleep_until when it is interrupted"""
+    pass
+
+class Clock(object):
+    def time(self):
+        """Return the current time in seconds"""
+        raise exceptions.ProtocolError("Clock classes must redefine time()")
+
+    def sleep(self, seconds):
+        """Wait for the given number of seconds"""
+        raise exceptions.ProtocolError("Clock classes must redefine sleep()")
+
+    def sleep_until(self, deadline, poll=0.1):
+        """
+        Wait until time() reaches deadline, checking the time every poll
+        seconds
+        """
+        while self.time()<deadline:
+            self.sleep(poll)
+
+class RealClock(Clock):
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def sleep_until(self, deadline, poll=0.1):
+        # Never sleep past the deadline, so that waits end on time to well
+        # within a poll
+        while True:
+            remaining=deadline-time.time()
+            if remaining<=0:
+                return
+            time.sleep(min(poll, remaining))
+
+class VirtualClock(Clock):
+    def __init__(self, start=0):
+        self.now=start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now+=seconds
+
+    def sleep_until(self, deadline, poll=None):
+        if deadline>self.now:
+            self.now=deadline
+
+class PausableClock(Clock):
+    """
+    Wraps another clock, adding the ability to pause time: while paused,
+    time() stands still and sleep_until waits.  Any thread may pause, resume
+    or interrupt the clock; interrupting it makes the current (or next)
+    sleep_until raise Interrupted, so that whatever is being timed can be
+    abandoned.
+    """
+
+    def __init__(self, clock=None):
+        self.clock=clock if clock else default
+        self.lock=threading.Lock()
+        self.paused_at=None
+        self.paused_total=0
+        self.interrupted=False
+
+    def time(self):
+        with self.lock:
+            now=self.paused_at
+            if now==None:
+                now=self.clock.time()
+            return now-self.paused_total
+
+    def sleep(self, seconds):
+        self.sleep_until(self.time()+seconds, seconds)
+
+    def sleep_until(self, deadline, poll=0.1):
+        while True:
+            if self.interrupted:
+                self.interrupted=False
+                raise Interrupted()
+            if self.paused_at==None:
+                now=self.time()
+                if now>=deadline:
+                    return
+                self.clock.sleep_until(self.clock.time()+min(poll,
+                  deadline-now
+                ), poll)
+            else:
+                self.clock.sleep(poll)
+
+    def pause(self):
+        with self.lock:
+            if self.paused_at==None:
+                self.paused_at=self.clock.time()
+
+    def resume(self):
+        with self.lock:
+            if self.paused_at!=None:
+                self.paused_total+=self.clock.time()-self.paused_at
+                self.paused_at=None
+
+    def is_paused(self):
+        return self.paused_at!=None
+
+    def interrupt(self):
+        self.interrupted=True
+
+class OffsetClock(Clock):
+    """Wraps another clock, running offset seconds ahead of it"""
+
+    def __init__(self, clock=None, offset=0):
+        self.clock=clock if clock else default
+        self.offset=offset
+
+    def set_offset(self, offset):
+        self.offset=offset
+
+    def get_offset(self):
+        return self.offset
+
+    def time(self):
+        return self.clock.time()+self.offset
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def sleep_until(self, deadline, poll=0.1):
+        self.clock.sleep_until(deadline-self.offset, poll)
+
+# The clock used by anything not given one explicitly
+default=RealClock()
+
+class TestRealClock(unittest.TestCase):
+    def test_sleep_until(self):
+        clock=RealClock()
+        started=clock.time()
+        clock.sleep_until(started+0.2, 0.01)
+        self.assertLess(abs(clock.time()-started-0.2), 0.05)
+        # However coarse the polling, the wait ends on time
+        started=clock.time()
+        clock.sleep_until(started+0.05, 10)
+        self.assertLess(abs(clock.time()-started-0.05), 0.02)
+        # Deadlines in the past return straight away
+        clock.sleep_until(started)
+        self.assertLess(clock.time()-started, 0.3)
+
+    def test_abstract(self):
+        self.assertRaises(exceptions.ProtocolError, Clock().time)
+        self.assertRaises(exceptions.ProtocolError, Clock().sleep, 1)
+
+class TestVirtualClock(unittest.TestCase):
+    def test_time(self):
+        clock=VirtualClock()
+        self.assertEqual(clock.time(), 0)
+        clock.sleep(3600)
+        self.assertEqual(clock.time(), 3600)
+        clock.sleep_until(3601.5)
+        self.assertEqual(clock.time(), 3601.5)
+        clock.sleep_until(10)
+        self.assertEqual(clock.time(), 3601.5)
+        self.assertEqual(VirtualClock(25).time(), 25)
+
+class TestOffsetClock(unittest.TestCase):
+    def test_offset(self):
+        base=VirtualClock(100)
+        clock=OffsetClock(base, -40.5)
+        self.assertEqual(clock.time(), 59.5)
+        clock.sleep_until(70)
+        self.assertEqual(base.time(), 110.5)
+        clock.set_offset(10)
+        self.assertEqual(clock.time(), 120.5)
+        self.assertEqual(clock.get_offset(), 10)
+
+class TestPausableClock(unittest.TestCase):
+    def test_pause(self):
+        base=VirtualClock(10)
+        clock=PausableClock(base)
+        self.assertEqual(clock.time(), 10)
+        clock.pause()
+        self.assertTrue(clock.is_paused())
+        base.sleep(5)
+        self.assertEqual(clock.time(), 10)
+        clock.resume()
+        self.assertFalse(clock.is_paused())
+        base.sleep(1)
+        self.assertEqual(clock.time(), 11)
+        clock.sleep_until(20)
+        self.assertEqual(clock.time(), 20)
+        self.assertEqual(base.time(), 25)
+
+    def test_interrupt(self):
+        clock=PausableClock(VirtualClock())
+        clock.interrupt()
+        self.assertRaises(Interrupted, clock.sleep_until, 5)
+        # Only the once
+        clock.sleep_until(5)
+        self.assertEqual(clock.time(), 5)
+
+    def test_threads(self):
+        clock=PausableClock(RealClock())
+        started=clock.time()
+        clock.pause()
+        timer=threading.Timer(0.2, clock.resume)
+        timer.start()
+        clock.sleep_until(started+0.1, 0.01)
+        # The pause held things up
+        self.assertGreater(time.time()-started, 0.25)
+        self.assertLess(abs(clock.time()-started-0.1), 0.05)
+        threading.Timer(0.1, clock.interrupt).start()
+        self.assertRaises(Interrupted, clock.sleep_until,
+          clock.time()+10, 0.01
+        )
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+"""
+Keeping stations that run the same routine in step.
+
+One machine runs a TimeServer; every station asks it the time over UDP a
+few times, NTP fashion, and runs its routine against an OffsetClock which
+keeps the server's time.  The server also hands out the agreed start
+instant, so the stations all begin together:
+
+    client=clocksync.TimeClient(clocksync.UDPTransport((host, port)))
+    clock=client.sync()
+    r.set_clock(clocks.PausableClock(clock))
+    clocksync.start_at(r, client.get_start())
+
+Each exchange timestamps the request leaving (t0) and the reply arriving
+(t3) by the station's clock, and the request arriving (t1) and the reply
+leaving (t2) by the server's.  Assuming the trip took as long each way, the
+server's clock is ((t1-t0)+(t2-t3))/2 ahead; any error comes from the trips
+differing, and can be no more than half the round trip.  So only the
+exchanges with the shortest round trips are used, and of those the median
+offset, which a single odd reply can't drag off.  On a local network that
+puts stations within a millisecond or two of each other.
+"""
+
+import math, time, socket, struct, statistics, threading, socketserver
+import collections, unittest
+import clocks, exceptions
+
+REQUEST=struct.Struct('!d')         # t0
+REPLY=struct.Struct('!dddd')        # t0, t1, t2, start (NaN if not set)
+
+Sample=collections.namedtuple('Sample', 'offset delay')
+
+def measure(t0, t1, t2, t3):
+    """
+    Return the Sample given by one exchange: the server clock's offset from
+    the station's, and the round trip's delay
+    """
+    return Sample(((t1-t0)+(t2-t3))/2, (t3-t0)-(t2-t1))
+
+def estimate(samples, best=0.25):
+    """
+    Estimate the offset from the median of the best fraction of samples,
+    those with the shortest round trips
+
+    Throws: ValueError if there are no samples
+    """
+    if not samples:
+        raise ValueError("No samples to estimate an offset from")
+    ranked=sorted(samples, key=lambda s: s.delay)
+    return statistics.median(s.offset
+      for s in ranked[:max(1, int(len(ranked)*best))])
+
+class TimeServer(socketserver.UDPServer):
+    """Answers stations' requests for the time, and the start instant"""
+
+    def __init__(self, port=0, host='127.0.0.1', clock=None):
+        """
+        Optional parameters:
+            port, host  Where to listen; port 0 picks a free port
+            clock       The clock the stations will keep, by default the
+                        system clock
+        """
+        self.clock=clock if clock else clocks.default
+        self.start=math.nan
+        server=self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                t1=server.clock.time()
+                (data, sock)=self.request
+                if len(data)!=REQUEST.size:
+                    return
+                (t0,)=REQUEST.unpack(data)
+                sock.sendto(REPLY.pack(t0, t1, server.clock.time(),
+                  server.start), self.client_address
+                )
+
+        super().__init__((host, port), Handler)
+        self.thread=None
+
+    def get_port(self):
+        return self.server_address[1]
+
+    def set_start(self, start):
+        """Set the instant, by the server's clock, routines start at"""
+        self.start=start
+
+    def serve_in_background(self):
+        self.thread=threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+class UDPTransport(object):
+    """Sends a station's requests to a TimeServer"""
+
+    def __init__(self, address, timeout=0.5):
+        self.address=address
+        self.socket=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+
+    def __call__(self, t0):
+        """
+        Ask the server the time, returning (t1, t2, start)
+
+        Throws: OSError (socket.timeout) if no reply comes in time
+        """
+        self.socket.sendto(REQUEST.pack(t0), self.address)
+        while True:
+            data=self.socket.recv(REPLY.size)
+            if len(data)!=REPLY.size:
+                continue
+            reply=REPLY.unpack(data)
+            # Ignore late replies to earlier requests
+            if reply[0]==t0:
+                return reply[1:]
+
+    def close(self):
+        self.socket.close()
+
+class TimeClient(object):
+    def __init__(self, transport, clock=None):
+        """
+        Parameters:
+            transport   A function taking t0 and returning the server's
+                        (t1, t2, start), such as a UDPTransport
+            clock       The station's own clock, by default the system clock
+        """
+        self.transport=transport
+        self.clock=clock if clock else clocks.default
+        self.synced=clocks.OffsetClock(self.clock)
+        self.start=None
+        self.samples=[]
+
+    def sample(self):
+        """Make one exchange with the server, returning its Sample"""
+        t0=self.clock.time()
+        (t1, t2, start)=self.transport(t0)
+        t3=self.clock.time()
+        if not math.isnan(start):
+            self.start=start
+        return measure(t0, t1, t2, t3)
+
+    def sync(self, samples=8, interval=0.01):
+        """
+        Estimate the server's clock from a number of exchanges, interval
+        seconds apart, returning an OffsetClock which keeps it.  The same
+        clock is returned, and adjusted, by every sync.
+
+        Throws: ProtocolError if the server never replied
+        """
+        self.samples=[]
+        for i in range(samples):
+            if i:
+                self.clock.sleep(interval)
+            try:
+                self.samples.append(self.sample())
+            except OSError:
+                pass
+        if not self.samples:
+            raise exceptions.ProtocolError("No reply from the time server")
+        self.synced.set_offset(estimate(self.samples))
+        return self.synced
+
+    def get_clock(self):
+        return self.synced
+
+    def get_start(self):
+        """The start instant last given by the server, or None"""
+        return self.start
+
+def start_at(routine, start):
+    """
+    Run a routine from the instant start, by its clock.  A station that's
+    late joins in step with the others, part way through.
+    """
+    now=routine.get_clock().time()
+    if now<start:
+        routine.get_clock().sleep_until(start, 0.01)
+        routine.start()
+    else:
+        routine.start(now-start)
+
+#####################################################################
+# Test code
+
+import random, guide, routine
+from simulate import RecordingSounder
+
+class SimulatedNetwork(object):
+    """
+    A transport to a server whose clock is an OffsetClock of the station's
+    base clock, with random, lopsided delays each way
+    """
+
+    def __init__(self, server, station, rand, start=math.nan):
+        self.server=server
+        self.station=station
+        self.rand=rand
+        self.start=start
+
+    def delay(self):
+        delay=0.0005+self.rand.expovariate(1/0.001)
+        if self.rand.random()<0.2:
+            # A burst of congestion
+            delay+=self.rand.uniform(0.05, 0.5)
+        return delay
+
+    def __call__(self, t0):
+        self.station.sleep(self.delay())
+        t1=self.server.time()
+        self.station.sleep(0.0001)
+        t2=self.server.time()
+        self.station.sleep(self.delay())
+        return (t1, t2, self.start)
+
+class TestClockSync(unittest.TestCase):
+    def test_measure(self):
+        # Server 10s ahead; 1s each way; 0.5s to answer
+        sample=measure(100, 111, 111.5, 102.5)
+        self.assertEqual(sample, Sample(10, 2))
+        self.assertEqual(estimate([Sample(5, 0.1), Sample(1, 9),
+          Sample(6, 0.2), Sample(4, 0.3)], 0.75), 5)
+        self.assertRaises(ValueError, estimate, [])
+
+    def test_simulated(self):
+        for seed in range(20):
+            rand=random.Random(seed)
+            base=clocks.VirtualClock(1000)
+            station=clocks.OffsetClock(base, rand.uniform(-100, 100))
+            server=clocks.OffsetClock(base)
+            client=TimeClient(SimulatedNetwork(server, station, rand),
+              station
+            )
+            clock=client.sync(16)
+            self.assertLess(abs(clock.time()-server.time()), 0.005)
+            self.assertIs(client.sync(16), clock)
+
+    def test_lockstep(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        rand=random.Random(42)
+        start=5000
+        timelines=[]
+        # Stations with their own idea of the time, one joining late
+        for (offset, late) in ((-3.2, 0), (71.9, 0), (-250, 12.5)):
+            base=clocks.VirtualClock(1000)
+            station=clocks.OffsetClock(base, offset)
+            server=clocks.OffsetClock(base)
+            client=TimeClient(SimulatedNetwork(server, station, rand, start),
+              station
+            )
+            clock=client.sync()
+            r=rf.load_file("data/routines/upperbody2")
+            r.set_clock(clocks.PausableClock(clock))
+            cues=[]
+            for ex in r.get_exercises():
+                ex.sounder=RecordingSounder(clock, cues)
+            if late:
+                base.sleep_until(base.time()+start-server.time()+late)
+            start_at(r, client.get_start())
+            # When each cue really sounded, by the server's clock
+            timelines.append([(t+server.time()-clock.time(), s)
+              for (t, s) in cues])
+        def assertInStep(a, b):
+            self.assertEqual([s for (t, s) in a], [s for (t, s) in b])
+            for ((t1, s1), (t2, s2)) in zip(a, b):
+                self.assertLess(abs(t1-t2), 0.01)
+        assertInStep(timelines[0], timelines[1])
+        # Bar the boop as it joins
+        assertInStep(timelines[2][1:], [cue for cue in timelines[0]
+          if cue[0]>start+13])
+        self.assertLess(abs(timelines[0][0][0]-start-5), 0.005)
+
+    def test_udp(self):
+        server=TimeServer(clock=clocks.OffsetClock(clocks.RealClock(), 5))
+        server.serve_in_background()
+        transport=UDPTransport(('127.0.0.1', server.get_port()))
+        try:
+            client=TimeClient(transport, clocks.RealClock())
+            self.assertEqual(client.get_start(), None)
+            server.set_start(12345.5)
+            clock=client.sync()
+            self.assertLess(abs(clock.time()-server.clock.time()), 0.01)
+            self.assertEqual(client.get_start(), 12345.5)
+        finally:
+            transport.close()
+            server.stop()
+        self.assertRaises(exceptions.ProtocolError, client.sync, 2, 0)
+
+if __name__=="__main__":
+    unittest.main()
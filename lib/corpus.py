@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""
+Generate synthetic guides and routine files of any size, for benchmarking
+the loaders.  The content is shaped like the real data: guide exercises come
+in right/left pairs sharing their description and tips through YAML anchors
+and aliases, as kettlebell.yaml's do, and routines mix single and
+multi-line settings, escaped characters, and exercise lines with and
+without explicit rests and read delays.
+"""
+
+import io, random, unittest
+
+WORDS=("kettlebell swing press clean lunge squat arm leg core back shoulder "
+  "hip knee keep straight slowly breathe stand crouch lift lower hold "
+  "extend return start position weight balance thigh chest").split()
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for i in range(words)).capitalize()+"."
+
+def exercise_ids(n, prefix='synthetic'):
+    """The ids guide_text(n, prefix=prefix) generates, in order"""
+    return ["{0}_{1}_{2}".format(prefix, i//2, ('right', 'left')[i%2])
+      for i in range(n)]
+
+def guide_text(n, seed=0, prefix='synthetic'):
+    """
+    Return the YAML text of a guide defining n exercises, with ids starting
+    with prefix
+    """
+    rng=random.Random(seed)
+    out=io.StringIO()
+    out.write("%YAML 1.1\n---\n")
+    for (i, ex_id) in enumerate(exercise_ids(n, prefix)):
+        pair=i//2
+        out.write("{0}:\n".format(ex_id))
+        out.write("    Name: Synthetic exercise {0} ({1})\n".format(
+          pair, ex_id.rsplit('_', 1)[1]
+        ))
+        if i%2==0:
+            out.write("    Description:\n        &desc_{0}\n        {1}\n".
+              format(pair, sentence(rng, 30))
+            )
+            out.write("    Tips:\n        &tips_{0}\n".format(pair))
+            tips=['"{0}"'.format(sentence(rng)) for t in range(3)]
+            out.write("        [{0}]\n".format(",\n        ".join(tips)))
+        else:
+            out.write("    Description: *desc_{0}\n".format(pair))
+            out.write("    Tips: *tips_{0}\n".format(pair))
+    return out.getvalue()
+
+def routine_text(m, ids, seed=0):
+    """
+    Return the text of a routine file with m exercise lines, drawn from the
+    exercise ids given
+    """
+    rng=random.Random(seed)
+    out=io.StringIO()
+    out.write("# Synthetic routine\nrest=10\nread_delay=5\n")
+    out.write("name=Synthetic routine {0}: 1+1\\=2\n".format(m))
+    out.write("description=\n")
+    for i in range(3):
+        out.write("    {0}\n".format(sentence(rng)))
+    out.write("\n")
+    for i in range(m):
+        if i%50==0:
+            out.write("# Block {0}\n".format(i//50))
+        fields=[rng.choice(ids), str(rng.randint(10, 90))]
+        extra=i%3
+        if extra>0:
+            fields.append(str(rng.randint(0, 30)))
+        if extra>1:
+            fields.append(str(rng.randint(0, 10)))
+        out.write("    {0}\n".format(",".join(fields)))
+    return out.getvalue()
+
+#####################################################################
+# Test code
+
+import guide, routine
+
+class TestCorpus(unittest.TestCase):
+    def test_guide(self):
+        g=guide.Guide()
+        g.load_io(io.StringIO(guide_text(5)))
+        self.assertEqual(g.get_exercise_ids(), set(exercise_ids(5)))
+        right=g.get_exercise('synthetic_1_right')
+        left=g.get_exercise('synthetic_1_left')
+        self.assertEqual(right.name, 'Synthetic exercise 1 (right)')
+        self.assertEqual(right.desc, left.desc)
+        self.assertEqual(len(left.tips), 3)
+        # Deterministic for a given seed
+        self.assertEqual(guide_text(5), guide_text(5))
+        self.assertNotEqual(guide_text(5), guide_text(5, seed=1))
+        g.load_io(io.StringIO(guide_text(3, prefix='other')))
+        self.assertEqual(g.get_exercise_ids(), set(exercise_ids(3, 'other')))
+
+    def test_routine(self):
+        g=guide.Guide()
+        g.load_io(io.StringIO(guide_text(4)))
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        r=rf.load_io(io.StringIO(routine_text(120, exercise_ids(4))))
+        self.assertEqual(len(r.exercises), 120)
+        self.assertEqual(r.get_name(),
+          "Synthetic routine 120: 1+1=2"
+        )
+        self.assertEqual(len(r.get_description().split('.')), 4)
+        self.assertEqual(r.exercises[0].rest, 10)
+        self.assertEqual(r.exercises[0].read_delay, 5)
+
+if __name__=="__main__":
+    unittest.main()
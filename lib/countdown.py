@@ -1,50 +1,80 @@
 #!/usr/bin/python3
 
 import time, os, logging, unittest
+import clocks, metrics, tracing
+
+tick_lateness=metrics.registry.histogram('countdown_tick_lateness_seconds',
+  "How long after its due time each countdown tick fired"
+)
+finish_lateness=metrics.registry.histogram(
+  'countdown_finish_lateness_seconds',
+  "How long after its due time each countdown finished"
+)
+aborts=metrics.registry.counter('countdown_aborts_total',
+  "Countdowns aborted by their tick function"
+)
 
 class AbortCountdownException(Exception):
     pass
 
 class Countdown(object):
-    def __init__(self, duration, finish_func, tick_func = False,interval=1):
+    def __init__(self, duration, finish_func, tick_func = False,interval=1,
+      clock=None):
         self.logger = logging.getLogger(__name__)
         self.duration = duration
         self.func_tick = tick_func
         self.func_finish = finish_func
         self.interval = interval
-        self.logger.info("Countdown object created, duration {0}".format(
-          duration
-        ))
+        self.clock = clock if clock else clocks.default
+        self.logger.info("Countdown object created, duration %s", duration)
 
-    def start(self):
-        self.logger.info("Countdown started, duration {0}".format(
-          self.duration
-        ))
-        self.started = time.time()
+    def start(self, offset=0):
+        """
+        Count down, calling the tick function each interval and the finish
+        function at the end.  Given an offset, start that many seconds in, as
+        if it had been running all along.
+        """
+        self.logger.info("Countdown started, duration %s", self.duration)
+        self.started = self.clock.time()-offset
+        if tracing.enabled:
+            tracing.emit(tracing.START, id(self), self.duration)
 
-        clock = 0
+        clock = int(offset)
         try:
             while clock < int(self.duration)-self.interval/2:
-                while time.time() < self.started + clock + 1:
-                    time.sleep(self.interval/10)
-                clock = int(time.time()-self.started)
-                self.logger.debug("Tick {0}".format(clock))
+                due = self.started + clock + 1
+                self.clock.sleep_until(due, self.interval/10)
+                now = self.clock.time()
+                tick_lateness.observe(now-due)
+                clock = int(now-self.started)
+                self.logger.debug("Tick %d", clock)
+                if tracing.enabled:
+                    tracing.emit(tracing.TICK, id(self), clock)
                 if self.func_tick:
                     self.func_tick(clock)
 
             if int(self.duration) < self.duration:
                 self.logger.debug("Counting down for remaining subsecond")
-                while time.time() < self.started + self.duration:
-                    time.sleep(self.interval/20)
-            self.logger.info("Countdown finished (duration {0})".format(
+                self.clock.sleep_until(self.started + self.duration,
+                  self.interval/20
+                )
+            finish_lateness.observe(
+              self.clock.time()-self.started-self.duration
+            )
+            self.logger.info("Countdown finished (duration %s)",
               self.duration
-            ))
+            )
+            if tracing.enabled:
+                tracing.emit(tracing.FINISH, id(self), self.duration)
             self.func_finish()
         except AbortCountdownException as e:
             # Tick function aborted the countdown.  Return now, do not pass go
-            self.logger.info("Countdown aborted (was duration {0})".format(
+            aborts.inc()
+            if tracing.enabled:
+                tracing.emit(tracing.ABORT, id(self), self.duration)
+            self.logger.info("Countdown aborted (was duration %s)",
               self.duration
-            ))
+            )
 
 class TestCountdown(unittest.TestCase):
     def test_start(self):
@@ -77,7 +107,8 @@ class TestCountdown(unittest.TestCase):
         timer=Countdown(dur, finish, tick, interval=interval)
         
         started=time.time()
-        self.assertRaises(AbortCountdownException, timer.start())
+        # The abort is caught by the countdown; it just returns early
+        timer.start()
         duration=time.time()-started
 
         self.assertFalse(finished)
@@ -95,6 +126,64 @@ class TestCountdown(unittest.TestCase):
         self.assertTrue(finished)
         self.assertLess(abs(duration-dur),interval/2)
 
+    def test_offset(self):
+        ticks=[]
+        clock=clocks.VirtualClock()
+        timer=Countdown(10, lambda: ticks.append('finish'), ticks.append,
+          clock=clock
+        )
+        timer.start(6.5)
+        self.assertEqual(ticks, [7, 8, 9, 10, 'finish'])
+        self.assertEqual(clock.time(), 3.5)
+
+    def test_virtual_clock(self):
+        ticks=[]
+        finished=[]
+        clock=clocks.VirtualClock(100)
+        timer=Countdown(3600, lambda: finished.append(clock.time()),
+          ticks.append, clock=clock
+        )
+        started=time.time()
+        timer.start()
+        self.assertLess(time.time()-started, 1)
+        self.assertEqual(ticks, list(range(1,3601)))
+        self.assertEqual(finished, [3700])
+
+        ticks=[]
+        finished=[]
+        timer=Countdown(2.5, lambda: finished.append(clock.time()),
+          ticks.append, clock=clock
+        )
+        timer.start()
+        self.assertEqual(ticks, [1,2])
+        self.assertEqual(finished, [3702.5])
+
+    def test_metrics(self):
+        ticks=tick_lateness.count
+        finishes=finish_lateness.count
+        Countdown(5, lambda: None, clock=clocks.VirtualClock()).start()
+        self.assertEqual(tick_lateness.count, ticks+5)
+        self.assertEqual(finish_lateness.count, finishes+1)
+
+    def test_tracing(self):
+        ring=tracing.RingBuffer()
+        tracing.add_sink(ring)
+        try:
+            timer=Countdown(2, lambda: None, clock=clocks.VirtualClock())
+            timer.start()
+            def abort(t):
+                raise AbortCountdownException("Test stop")
+            Countdown(3, lambda: None, abort, clock=timer.clock).start()
+        finally:
+            tracing.remove_sink(ring)
+        events=[(event, fields[1]) for (when, event, fields)
+          in ring.get_events()]
+        self.assertEqual(events, [(tracing.START, 2), (tracing.TICK, 1),
+          (tracing.TICK, 2), (tracing.FINISH, 2), (tracing.START, 3),
+          (tracing.TICK, 1), (tracing.ABORT, 3)
+        ])
+        self.assertEqual(ring.get_events()[0][2][0], id(timer))
+
 if __name__=="__main__":
 #    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
     logging.getLogger(__name__).setLevel(logging.ERROR)
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+"""
+Compile a prepared Routine into a CuePlan: every event the routine will
+produce (phase changes, ticks, beeps and boops), with its offset in seconds
+from the start of the routine, held in flat arrays.
+
+The plan reproduces the decisions Countdown and Exercise make as they run,
+so it can be inspected, diffed and exported without running anything, and
+play() can run it directly.
+"""
+
+import io, array, difflib, collections, itertools, operator, unittest
+import clocks, sounder
+
+READ, WORK, REST, TICK, BEEP, BOOP = range(6)
+KINDS=('read', 'work', 'rest', 'tick', 'beep', 'boop')
+SOUNDS={BEEP:'sounds/beep.ogg', BOOP:'sounds/boop.ogg'}
+
+Event=collections.namedtuple('Event', 'offset kind exercise value')
+
+class CuePlan(object):
+    """
+    An immutable, array-backed list of events.  Each event has an offset,
+    a kind (one of KINDS), the index of the exercise it belongs to, and a
+    value: the countdown clock for ticks and beeps, the phase length for
+    phase changes.
+    """
+
+    def __init__(self, names, offsets, kinds, exercises, values, total_time):
+        self.__names=tuple(names)
+        self.__total_time=total_time
+        self.__offsets=offsets
+        self.__kinds=kinds
+        self.__exercises=exercises
+        self.__values=values
+
+    def __len__(self):
+        return len(self.__kinds)
+
+    def __getitem__(self, i):
+        return Event(self.__offsets[i], KINDS[self.__kinds[i]],
+          self.__exercises[i], self.__values[i]
+        )
+
+    def __eq__(self, other):
+        return (isinstance(other, CuePlan) and
+          self.to_rows()==other.to_rows()
+        )
+
+    def get_names(self):
+        """The names of the plan's exercises, indexed as in its events"""
+        return self.__names
+
+    def get_column(self, column):
+        """
+        Return a read-only view of one of the plan's columns: 'offset',
+        'kind', 'exercise' or 'value'
+        """
+        return memoryview(getattr(self, '_CuePlan__'+column+'s')).toreadonly()
+
+    def get_total_time(self):
+        """The plan's length, including the last exercise's rest"""
+        return self.__total_time
+
+    def count(self, kind):
+        """Count the events of one kind"""
+        return self.__kinds.count(KINDS.index(kind))
+
+    def get_cues(self):
+        """Return the (offset, soundfile) of each sound the plan plays"""
+        return [(self.__offsets[i], SOUNDS[k])
+          for (i, k) in enumerate(self.__kinds) if k in SOUNDS]
+
+    def to_rows(self):
+        """Return the events as text rows: offset, kind, exercise, value"""
+        return ["{0:g},{1},{2},{3:g}".format(*self[i])
+          for i in range(len(self))]
+
+    def dump(self, out):
+        """Write the plan to a text stream as CSV, one event per line"""
+        out.write("offset,kind,exercise,value\n")
+        for row in self.to_rows():
+            out.write(row+"\n")
+
+    def diff(self, other, before='before', after='after'):
+        """Return a unified diff of this plan's rows against another's"""
+        return list(difflib.unified_diff(self.to_rows(), other.to_rows(),
+          before, after, lineterm=''
+        ))
+
+def compile_phases(phases):
+    """
+    Compile a sequence of (name, read_delay, duration, rest) tuples into a
+    CuePlan.  Per exercise this only does a constant amount of work in
+    Python; the per-second ticks are generated in bulk.
+    """
+    names=[]
+    offsets=array.array('d')
+    kinds=array.array('B')
+    exercises=array.array('L')
+    values=array.array('d')
+    add=operator.add
+    repeat=itertools.repeat
+
+    def bulk(kind, ex, base, first, last):
+        # Ticks first..last (inclusive) of a countdown started at base
+        n=last-first+1
+        if n<=0:
+            return
+        offsets.extend(map(add, repeat(base, n), range(first, last+1)))
+        kinds.extend(repeat(kind, n))
+        exercises.extend(repeat(ex, n))
+        values.extend(range(first, last+1))
+
+    def event(offset, kind, ex, value):
+        offsets.append(offset)
+        kinds.append(kind)
+        exercises.append(ex)
+        values.append(value)
+
+    start=0
+    for (ex, (name, read_delay, duration, rest)) in enumerate(phases):
+        names.append(name)
+        event(start, READ, ex, read_delay)
+        work=start+read_delay
+        event(work, WORK, ex, duration)
+        event(work, BOOP, ex, 0)
+        # Countdown ticks once a second up to int(duration); Exercise beeps
+        # on the ticks in the last five seconds
+        ticks=int(duration)
+        first_beep=max(1, int(duration-5)+1)
+        bulk(TICK, ex, work, 1, min(ticks, first_beep-1))
+        for clock in range(first_beep, ticks+1):
+            event(work+clock, TICK, ex, clock)
+            if 0<duration-clock<5:
+                event(work+clock, BEEP, ex, clock)
+        finish=work+duration
+        event(finish, REST, ex, rest)
+        event(finish, BOOP, ex, 0)
+        start=finish+rest
+    return CuePlan(names, offsets, kinds, exercises, values, start)
+
+def compile_plan(routine):
+    """
+    Compile a prepared Routine into a CuePlan, expanding any repeated blocks
+    """
+    return compile_phases((e.name, e.read_delay, e.duration, e.rest)
+      for (start, e) in routine.phases())
+
+def play(plan, clock=None, player=None, handlers={}):
+    """
+    Play a plan in real time (or against any clock), sounding its beeps and
+    boops.  handlers optionally maps a kind of event to a function to call
+    with each Event of that kind, as it falls due.
+    """
+    if clock==None:
+        clock=clocks.default
+    if player==None:
+        player=sounder.Sounder()
+    started=clock.time()
+    for i in range(len(plan)):
+        e=plan[i]
+        clock.sleep_until(started+e.offset, 0.1)
+        if e.kind in handlers:
+            handlers[e.kind](e)
+        if e.kind in ('beep', 'boop'):
+            player.play(SOUNDS[KINDS.index(e.kind)])
+    # Sit out the final rest, as the last Exercise would
+    clock.sleep_until(started+plan.get_total_time(), 0.1)
+
+#####################################################################
+# Test code
+
+import time, guide, routine, exercise, simulate
+
+class TestCuePlan(unittest.TestCase):
+    def setUp(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        self.routine=rf.load_file("data/routines/upperbody2")
+
+    def test_matches_simulation(self):
+        plan=compile_plan(self.routine)
+        self.assertEqual(plan.get_cues(), simulate.simulate(self.routine))
+        self.assertEqual(plan.get_total_time(), self.routine.get_total_time())
+        self.assertEqual(plan.count('tick'), 7*60)
+        self.assertEqual(plan.count('beep'), 7*4)
+        self.assertEqual(len(plan.get_names()), 7)
+
+        # Odd durations: short, sub-second and fractional
+        for phases in ([('a', 0, 3, 1)], [('b', 1, 0.5, 0)],
+          [('c', 2, 7.5, 1), ('d', 0, 0, 0)]):
+            r=routine.Routine()
+            for (name, read_delay, duration, rest) in phases:
+                r.exercises.append(exercise.Exercise(name))
+                r.exercises[-1].prep(duration, rest, read_delay)
+            self.assertEqual(compile_plan(r).get_cues(),
+              simulate.simulate(r)
+            )
+
+        # Repeated blocks, with round overrides
+        rf=routine.RoutineFile()
+        rf.add_guide(self.routine.get_guidebook().get_guides())
+        r=rf.load_file("data/routines/circuit1")
+        plan=compile_plan(r)
+        self.assertEqual(plan.get_cues(), simulate.simulate(r))
+        self.assertEqual(plan.get_total_time(), r.get_total_time())
+
+    def test_events(self):
+        plan=compile_phases([('x', 1, 2, 3)])
+        self.assertEqual([tuple(plan[i]) for i in range(len(plan))], [
+          (0, 'read', 0, 1), (1, 'work', 0, 2), (1, 'boop', 0, 0),
+          (2, 'tick', 0, 1), (2, 'beep', 0, 1), (3, 'tick', 0, 2),
+          (3, 'rest', 0, 3), (3, 'boop', 0, 0)
+        ])
+        offsets=plan.get_column('offset')
+        self.assertEqual(list(offsets), [0, 1, 1, 2, 2, 3, 3, 3])
+        self.assertRaises(TypeError, offsets.__setitem__, 0, 5)
+
+    def test_export_diff(self):
+        plan=compile_phases([('x', 1, 2, 3)])
+        out=io.StringIO()
+        plan.dump(out)
+        self.assertEqual(out.getvalue().split('\n')[:3],
+          ['offset,kind,exercise,value', '0,read,0,1', '1,work,0,2']
+        )
+        self.assertEqual(plan.diff(compile_phases([('y', 1, 2, 3)])), [])
+        self.assertEqual(plan, compile_phases([('y', 1, 2, 3)]))
+        diff=plan.diff(compile_phases([('x', 1, 2, 4)]))
+        self.assertIn('-3,rest,0,3', diff)
+        self.assertIn('+3,rest,0,4', diff)
+
+    def test_play(self):
+        plan=compile_phases([('x', 1, 6, 3), ('y', 0, 2, 0)])
+        clock=clocks.VirtualClock()
+        player=simulate.RecordingSounder(clock)
+        phases=[]
+        play(plan, clock, player, {'work':phases.append})
+        self.assertEqual(player.cues, plan.get_cues())
+        self.assertEqual([e.exercise for e in phases], [0, 1])
+        self.assertEqual(clock.time(), 12)
+
+    def test_scale(self):
+        started=time.time()
+        plan=compile_phases(('x', 5, 10, 5) for i in range(100000))
+        self.assertLess(time.time()-started, 10)
+        self.assertEqual(plan.get_total_time(), 2000000)
+        self.assertEqual(plan.count('tick'), 1000000)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+"""
+A long-lived local daemon which keeps parsed guides and loaded routines
+resident, so that repeat runs don't pay for parsing before the first cue.
+
+Clients talk to it over a Unix socket, one JSON request per connection (see
+daemonclient.py for the client side).
+"""
+
+import os, io, sys, json, errno, socket, logging, socketserver, contextlib
+import hashlib
+import unittest
+import guide, routine, tagindex, stringtable, exceptions, daemonclient
+
+class GuideCache(object):
+    """
+    Parsed Guides and loaded Routines, keyed by filename.  Every lookup
+    stats the files involved, so that anything changed on disk since it was
+    cached is loaded afresh.
+    """
+
+    def __init__(self, index_cache=None):
+        """
+        With index_cache, each set of guides' tag index is also kept in a
+        file of its own, named index_cache with a suffix for the set, so a
+        new daemon needn't rebuild it
+        """
+        self.guides={}      # filename -> (stamp, Guide)
+        self.routines={}    # (filename, guide filenames) -> (stamps, Routine)
+        self.indexes={}     # guide filenames -> (stamps, TagIndex)
+        # The text of every guide loaded, shared between them
+        self.strings=stringtable.StringTable()
+        self.index_cache=index_cache
+        self.stats={
+          'guides':{'hits':0, 'misses':0},
+          'routines':{'hits':0, 'misses':0},
+          'tags':{'hits':0, 'misses':0}
+        }
+
+    def stamp(self, filename):
+        st=os.stat(filename)
+        return (st.st_mtime_ns, st.st_size)
+
+    def get_guide(self, filename):
+        """
+        Return the Guide loaded from filename, parsing it only if it isn't
+        cached or has changed since
+
+        Throws:
+            OSError     if the file can't be read
+            ParseError  if the guide doesn't parse
+        """
+        stamp=self.stamp(filename)
+        cached=self.guides.get(filename)
+        if cached and cached[0]==stamp:
+            self.stats['guides']['hits']+=1
+            return cached[1]
+        self.stats['guides']['misses']+=1
+        g=guide.Guide(self.strings)
+        g.load_file(filename)
+        self.guides[filename]=(stamp, g)
+        return g
+
+    def get_routine(self, filename, guide_filenames):
+        """
+        Return the Routine loaded from filename using the named guides,
+        loading it only if it, or any of its guides, has changed
+
+        Throws:
+            OSError, ParseError, DefaultError or KeyError as per
+            RoutineFile.load_file
+        """
+        guides=[self.get_guide(g) for g in guide_filenames]
+        key=(filename, tuple(guide_filenames))
+        stamps=(self.stamp(filename),)+tuple(
+          self.guides[g][0] for g in guide_filenames
+        )
+        cached=self.routines.get(key)
+        if cached and cached[0]==stamps:
+            self.stats['routines']['hits']+=1
+            return cached[1]
+        self.stats['routines']['misses']+=1
+        routinefile=routine.RoutineFile()
+        routinefile.add_guide(guides)
+        r=routinefile.load_file(filename)
+        self.routines[key]=(stamps, r)
+        return r
+
+    def get_tag_index(self, guide_filenames):
+        """
+        Return a TagIndex of the named guides, building it only if any of
+        them has changed
+
+        Throws:
+            OSError     if a guide can't be read
+            ParseError  if a guide doesn't parse
+        """
+        key=tuple(guide_filenames)
+        stamps=tagindex.TagIndex.stamp(key)
+        cached=self.indexes.get(key)
+        if cached and cached[0]==stamps:
+            self.stats['tags']['hits']+=1
+            return cached[1]
+        self.stats['tags']['misses']+=1
+        index=None
+        if self.index_cache:
+            cache_file=self.get_index_cache(key)
+            index=tagindex.TagIndex.load_cache(cache_file, key)
+        if index==None:
+            index=tagindex.TagIndex()
+            for filename in key:
+                index.add_guide(self.get_guide(filename))
+            if self.index_cache:
+                index.save_cache(cache_file, key)
+        self.indexes[key]=(stamps, index)
+        return index
+
+    def get_index_cache(self, guide_filenames):
+        """
+        Return the file the tag index of the named guides is cached in; one
+        per set of guides, so sets used in turn don't evict each other
+        """
+        digest=hashlib.sha1("\n".join(os.path.abspath(filename)
+          for filename in guide_filenames).encode()).hexdigest()
+        return "{0}.{1}".format(self.index_cache, digest[:16])
+
+    def get_stats(self):
+        """Return the hit/miss counts, plus hit rates, for both caches"""
+        stats={}
+        for kind in self.stats:
+            counts=dict(self.stats[kind])
+            lookups=counts['hits']+counts['misses']
+            counts['hit_rate']=counts['hits']/lookups if lookups else 0.0
+            stats[kind]=counts
+        return stats
+
+def check_criteria(criteria, what):
+    """
+    Check a client's criteria for TagIndex.select are {attribute: value or
+    list of values}, all strings
+
+    Throws: ProtocolError if they aren't
+    """
+    def valid(values):
+        if isinstance(values, str):
+            return True
+        return isinstance(values, list) and \
+          all(isinstance(value, str) for value in values)
+    if not isinstance(criteria, dict) or not all(valid(values)
+      for values in criteria.values()):
+        raise exceptions.ProtocolError(
+          "Select {0} must map attributes to a value or a list of values, "
+          "not {1}".format(what, json.dumps(criteria))
+        )
+
+def check_guides(guides):
+    """
+    Check a client's guides are a list of filenames
+
+    Throws: ProtocolError if they aren't
+    """
+    if not isinstance(guides, list) or not all(isinstance(filename, str)
+      for filename in guides):
+        raise exceptions.ProtocolError(
+          "Guides must be a list of filenames, not {0}".format(
+            json.dumps(guides)
+          )
+        )
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line=self.rfile.readline()
+        if not line:
+            # Connected and gone again, as another daemon checking it's here
+            return
+        try:
+            request=json.loads(line.decode('utf-8'))
+            command=request['command']
+            if command in ('prepare', 'run', 'select'):
+                check_guides(request['guides'])
+            if command=='prepare':
+                r=self.server.cache.get_routine(
+                  request['routine'], request['guides']
+                )
+                self.reply({
+                  'name':r.get_name(),
+                  'description':r.get_description(),
+                  'total_time':r.get_total_time()
+                })
+            elif command=='run':
+                r=self.server.cache.get_routine(
+                  request['routine'], request['guides']
+                )
+                self.run_routine(r)
+            elif command=='select':
+                check_criteria(request['criteria'], "criteria")
+                if request.get('exclude')!=None:
+                    check_criteria(request['exclude'], "exclusions")
+                index=self.server.cache.get_tag_index(request['guides'])
+                self.reply({'ids':index.select(
+                  request['criteria'], request.get('exclude')
+                )})
+            elif command=='stats':
+                self.reply(self.server.cache.get_stats())
+            elif command=='shutdown':
+                self.reply({'status':'stopping'})
+                self.server.stopping=True
+            else:
+                raise exceptions.ProtocolError(
+                  "Unrecognised command {0}".format(repr(command))
+                )
+        except (OSError, KeyError, ValueError, TypeError, AttributeError,
+          exceptions.BaseTrainingException) as e:
+            # Whatever a malformed request trips over, answer it rather than
+            # hang up
+            self.reply({'error':str(e)})
+
+    def reply(self, message):
+        self.wfile.write(json.dumps(message).encode('utf-8')+b'\n')
+
+    def run_routine(self, r):
+        """
+        Run the routine here in the daemon, sending the exercise output that
+        would normally go to the terminal back to the client instead.
+        """
+        out=io.TextIOWrapper(self.wfile, encoding='utf-8',
+          line_buffering=True, write_through=True
+        )
+        handler=logging.StreamHandler(out)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger=logging.getLogger('exercise')
+        logger.addHandler(handler)
+        try:
+            with contextlib.redirect_stdout(out):
+                r.start()
+        finally:
+            logger.removeHandler(handler)
+            out.detach()
+
+class Daemon(socketserver.UnixStreamServer):
+    """
+    Serve requests from DaemonClients, one at a time, until asked to stop.
+    Routines are run by the daemon itself, so only one can run at once.
+    """
+
+    def __init__(self, path=daemonclient.DEFAULT_SOCKET, index_cache=None):
+        """
+        Throws:
+            OSError (EADDRINUSE) if another daemon is listening on path
+        """
+        self.__remove_stale(path)
+        super().__init__(path, DaemonHandler)
+        self.path=path
+        self.cache=GuideCache(index_cache)
+        self.stopping=False
+
+    @staticmethod
+    def __remove_stale(path):
+        # Only a socket nobody's listening on is a previous daemon's leftover
+        probe=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError as e:
+            if e.errno==errno.ENOENT:
+                return
+            if e.errno!=errno.ECONNREFUSED:
+                raise
+            os.unlink(path)
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE,
+          "A daemon is already listening on {0}".format(path)
+        )
+
+    def serve(self):
+        """Handle requests until a client sends 'shutdown'"""
+        try:
+            while not self.stopping:
+                self.handle_request()
+        finally:
+            self.server_close()
+            os.unlink(self.path)
+
+#####################################################################
+# Test code
+
+import threading, tempfile, time, sounderinterface
+
+class TestGuideCache(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.guide=self.__write('guide.yaml', """\
+exercise1:
+    Name: Test Exercise 1
+    Description: Test description 1
+""")
+        self.routine=self.__write('routine', """\
+rest=0
+read_delay=0
+name=Cached routine
+exercise1,0
+exercise1,3
+""")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def __write(self, name, text):
+        filename=os.path.join(self.dir.name, name)
+        with io.open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def test_hits(self):
+        cache=GuideCache()
+        r=cache.get_routine(self.routine, [self.guide])
+        self.assertEqual(r.get_name(), "Cached routine")
+        self.assertEqual(r.get_total_time(), 3)
+        self.assertIs(cache.get_routine(self.routine, [self.guide]), r)
+        stats=cache.get_stats()
+        self.assertEqual(stats['routines']['hits'], 1)
+        self.assertEqual(stats['routines']['misses'], 1)
+        self.assertEqual(stats['routines']['hit_rate'], 0.5)
+        self.assertEqual(stats['guides']['misses'], 1)
+        self.assertEqual(stats['guides']['hits'], 1)
+
+    def test_changed_file(self):
+        cache=GuideCache()
+        g=cache.get_guide(self.guide)
+        r=cache.get_routine(self.routine, [self.guide])
+        self.__write('guide.yaml', """\
+exercise1:
+    Name: Renamed Exercise 1
+    Description: Test description 1
+""")
+        stat=os.stat(self.guide)
+        # Make sure the change is visible even on coarse mtime filesystems
+        os.utime(self.guide, ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+        self.assertIsNot(cache.get_guide(self.guide), g)
+        r2=cache.get_routine(self.routine, [self.guide])
+        self.assertIsNot(r2, r)
+        self.assertEqual(r2.exercises[0].name, "Renamed Exercise 1")
+
+    def test_tag_index(self):
+        index_cache=os.path.join(self.dir.name, 'tags.cache')
+        cache=GuideCache(index_cache)
+        index=cache.get_tag_index(["data/exercises/kettlebell.yaml"])
+        self.assertIs(cache.get_tag_index(["data/exercises/kettlebell.yaml"]),
+          index
+        )
+        self.assertEqual(index.select({'side':'left', 'muscles':'arms'}),
+          ['kettle_clean_left', 'kettle_press_left']
+        )
+        # A fresh cache reads the index back from the file
+        cache=GuideCache(index_cache)
+        self.assertEqual(cache.get_tag_index(["data/exercises/kettlebell.yaml"]
+          ).select({'muscles':'legs'}), index.select({'muscles':'legs'})
+        )
+        self.assertEqual(cache.get_stats()['guides']['misses'], 0)
+        self.assertEqual(cache.get_stats()['tags']['misses'], 1)
+        # Each set of guides is cached apart, so using them in turn doesn't
+        # rebuild either
+        sets=(["data/exercises/kettlebell.yaml"], [self.guide],
+          [self.guide, "data/exercises/kettlebell.yaml"])
+        for guides in sets[1:]:
+            cache.get_tag_index(guides)
+        for guides in sets:
+            cache=GuideCache(index_cache)
+            cache.get_tag_index(guides)
+            self.assertEqual(cache.get_stats()['guides']['misses'], 0)
+        # A cache file that's been trashed is rebuilt, and rewritten
+        with open(cache.get_index_cache(sets[0]), 'wb') as f:
+            f.write(b"\x80\x04\x95junk")
+        cache=GuideCache(index_cache)
+        self.assertEqual(cache.get_tag_index(sets[0]).select({'muscles':'legs'}
+          ), index.select({'muscles':'legs'})
+        )
+        self.assertEqual(cache.get_stats()['guides']['misses'], 1)
+        cache=GuideCache(index_cache)
+        cache.get_tag_index(sets[0])
+        self.assertEqual(cache.get_stats()['guides']['misses'], 0)
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.guide=os.path.join(self.dir.name, 'guide.yaml')
+        with io.open(self.guide, 'w') as f:
+            f.write("exercise1:\n    Name: Test Exercise 1\n")
+        self.routine=os.path.join(self.dir.name, 'routine')
+        with io.open(self.routine, 'w') as f:
+            f.write("rest=0\nread_delay=0\nname=Daemon routine\nexercise1,0\n")
+        self.sounders=dict(sounderinterface.Sounders().sounders)
+        sounderinterface.Sounders().register(
+          os.name, sounderinterface.QuietSounder
+        )
+        self.path=os.path.join(self.dir.name, 'daemon.sock')
+        self.daemon=Daemon(self.path)
+        self.thread=threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+        self.client=daemonclient.DaemonClient(self.path)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.thread.join()
+        sounderinterface.Sounders().sounders=self.sounders
+        self.dir.cleanup()
+
+    def test_prepare(self):
+        info=self.client.prepare(self.routine, [self.guide])
+        self.assertEqual(info['name'], "Daemon routine")
+        self.assertEqual(info['total_time'], 0)
+        self.client.prepare(self.routine, [self.guide])
+        stats=self.client.stats()
+        self.assertEqual(stats['routines']['hits'], 1)
+        self.assertEqual(stats['guides']['hit_rate'], 0.5)
+
+    def test_errors(self):
+        self.assertRaisesRegex(ValueError, "No such file",
+          self.client.prepare, self.routine+'.missing', [self.guide]
+        )
+        self.assertRaisesRegex(ValueError, "[Uu]nrecognised command",
+          self.client.request, 'bogus'
+        )
+        for guides in (self.guide, 3, [3], [[self.guide]]):
+            self.assertRaisesRegex(ValueError, "^Guides must be",
+              self.client.prepare, self.routine, guides
+            )
+        self.assertRaisesRegex(ValueError, "not list",
+          self.client.prepare, [self.routine], [self.guide]
+        )
+
+    def test_select(self):
+        self.assertEqual(self.client.select(["data/exercises/kettlebell.yaml"],
+          {'muscles':['core']}, {'side':'left'}),
+          ['kettle_lunge_right', 'kettle_swing']
+        )
+        for (criteria, exclude) in (([], None), ({'muscles':3}, None),
+          ({'muscles':['core', None]}, None), ({}, "left")):
+            self.assertRaisesRegex(ValueError, "^Select",
+              self.client.select, ["data/exercises/kettlebell.yaml"],
+              criteria, exclude
+            )
+
+    def test_second_daemon(self):
+        self.assertRaisesRegex(OSError, "already listening", Daemon, self.path)
+        # The first still has its socket
+        self.assertIn('routines', self.client.stats())
+        # A socket left behind by a daemon that's gone is taken over
+        stale=os.path.join(self.dir.name, 'stale.sock')
+        s=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(stale)
+        s.close()
+        Daemon(stale).server_close()
+
+    def test_run(self):
+        level=logging.getLogger('exercise').level
+        logging.getLogger('exercise').setLevel(logging.INFO)
+        try:
+            out=io.StringIO()
+            self.client.run(self.routine, [self.guide], out)
+        finally:
+            logging.getLogger('exercise').setLevel(level)
+        self.assertIn("Exercise: Test Exercise 1", out.getvalue())
+        self.assertIn("Finish", out.getvalue())
+
+if __name__=="__main__":
+    unittest.main()
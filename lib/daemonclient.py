@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+"""
+A thin client for the intertrain daemon (see daemon.py).
+
+This module deliberately imports nothing but the standard library, so that
+a client can reach a warm daemon without paying for the YAML parser or the
+rest of the exercise machinery.
+"""
+
+import os, sys, json, socket, tempfile
+
+DEFAULT_SOCKET=os.path.join(
+  tempfile.gettempdir(), "intertrain-{0}.sock".format(os.getuid())
+)
+
+class DaemonClient(object):
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path=path
+
+    def connect(self):
+        """
+        Open a connection to the daemon
+
+        Throws:
+            OSError if the daemon isn't listening on our socket
+        """
+        conn=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.path)
+        except OSError:
+            conn.close()
+            raise
+        return conn
+
+    def request(self, command, **args):
+        """
+        Send a single command and return the daemon's decoded JSON reply
+
+        Throws:
+            OSError     if the daemon can't be reached
+            ValueError  if the daemon reports an error
+        """
+        args['command']=command
+        with self.connect() as conn:
+            conn.sendall(json.dumps(args).encode('utf-8')+b'\n')
+            reply=conn.makefile('rb').readline()
+        reply=json.loads(reply.decode('utf-8'))
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply
+
+    def prepare(self, routine, guides):
+        """
+        Ask the daemon to load a routine (and the guides it needs) into its
+        cache.  Returns a dict of the routine's name, description and
+        total_time.
+        """
+        return self.request('prepare', routine=routine, guides=guides)
+
+    def run(self, routine, guides, out=sys.stdout):
+        """
+        Ask the daemon to run a routine, copying its progress output to 'out'
+        until the routine finishes.
+        """
+        request={'command':'run', 'routine':routine, 'guides':guides}
+        with self.connect() as conn:
+            conn.sendall(json.dumps(request).encode('utf-8')+b'\n')
+            while True:
+                data=conn.recv(4096)
+                if not data:
+                    break
+                out.write(data.decode('utf-8', 'replace'))
+                out.flush()
+
+    def select(self, guides, criteria, exclude=None):
+        """
+        Return the ids of the exercises in the named guides with the tags in
+        criteria and none of those in exclude (see TagIndex.select)
+        """
+        return self.request('select', guides=guides, criteria=criteria,
+          exclude=exclude
+        )['ids']
+
+    def stats(self):
+        """Return the daemon's cache statistics"""
+        return self.request('stats')
+
+    def shutdown(self):
+        return self.request('shutdown')
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+"""
+A Guide keeping its exercises in an SQLite database, for libraries too big
+to hold in memory when a routine only uses a handful of them.
+
+Guides are imported into the database once, and exercises are then read
+from it as they're asked for, by their indexed id, with the most recently
+used kept in a small cache:
+
+    g=dbguide.DBGuide("exercises.db")
+    g.import_file("data/exercises/kettlebell.yaml")
+    routinefile.add_guide(g)        # alongside any file guides
+
+Each row holds an exercise's name and description, with its tips and tags
+as JSON.  Imports are written in batches, a transaction each, and a guide
+can be exported back to YAML.  Suggestions for a mistyped id are looked up
+by key too, trying each string an edit away, rather than read from an index
+of every id held in memory.
+"""
+
+import io, json, sqlite3, functools, threading, unittest
+import yaml
+import guide, exercise, suggest, exceptions
+
+class DBGuide(guide.Guide):
+    SCHEMA="""
+      CREATE TABLE IF NOT EXISTS exercises (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        description TEXT,
+        tips TEXT,
+        tags TEXT
+      ) WITHOUT ROWID
+    """
+
+    def __init__(self, filename, cache_size=256):
+        """
+        Open (or create) the database in filename; ':memory:' for one that
+        lasts only as long as the guide
+        """
+        super().__init__()
+        self.filename=filename
+        # Shared with whichever thread looks an exercise up, one at a time
+        self.db=sqlite3.connect(filename, check_same_thread=False)
+        self.lock=threading.Lock()
+        with self.lock, self.db:
+            self.db.execute(self.SCHEMA)
+        # Counts imports, so anything built from the exercises can tell
+        # when they've changed
+        self.generation=0
+        self.fetch=functools.lru_cache(cache_size)(self.__fetch)
+
+    def __fetch(self, exercise_id):
+        # The exercise's (name, desc, tips, tags), or None
+        with self.lock:
+            row=self.db.execute("SELECT name, description, tips, tags "
+              "FROM exercises WHERE id=?", (exercise_id,)
+            ).fetchone()
+        if row==None:
+            return None
+        return self.__decode(row)
+
+    @staticmethod
+    def __decode(row):
+        (name, desc, tips, tags)=row
+        tips=json.loads(tips)
+        tags=json.loads(tags) if tags else {}
+        return (name, desc, tips,
+          {attribute:tuple(values) for (attribute, values) in tags.items()})
+
+    def import_entries(self, entries, batch=1000):
+        """
+        Add (ex_id, name, desc, tips, tags) entries to the database,
+        replacing any with the same ids, committing every batch entries
+        """
+        def rows(chunk):
+            for (ex_id, name, desc, tips, tags) in chunk:
+                yield (ex_id, name, desc,
+                  json.dumps(list(tips) if isinstance(tips, tuple) else tips),
+                  json.dumps(tags) if tags else None
+                )
+        try:
+            chunk=[]
+            for entry in entries:
+                chunk.append(entry)
+                if len(chunk)>=batch:
+                    self.__insert(rows(chunk))
+                    chunk=[]
+            if chunk:
+                self.__insert(rows(chunk))
+        finally:
+            # Lookups of ids which weren't there before are cached too
+            self.fetch.cache_clear()
+            self.generation+=1
+
+    def __insert(self, rows):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO exercises "
+              "VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def import_guide(self, g, batch=1000):
+        """Add every exercise in a Guide to the database"""
+        self.import_entries(g.get_entries(), batch)
+
+    def import_io(self, iostream, batch=1000):
+        """
+        Add the exercises in a YAML guide stream to the database
+
+        Throws: ParseError if the guide doesn't parse
+        """
+        g=guide.Guide()
+        g.load_io(iostream)
+        self.import_guide(g, batch)
+
+    def import_file(self, filename, batch=1000):
+        """
+        Add the exercises in a YAML guide file to the database
+
+        Throws: ParseError if the guide doesn't parse, or OSError if it
+        can't be read
+        """
+        with io.open(filename) as f:
+            self.import_io(f, batch)
+
+    # Loading a guide into this one imports it
+    def load_io(self, iostream):
+        self.import_io(iostream)
+
+    def load_file(self, filename):
+        self.import_file(filename)
+
+    def reload(self):
+        raise exceptions.ProtocolError(
+          "Database guides are imported into, not reloaded"
+        )
+
+    def export(self, out):
+        """Write every exercise to out as a YAML guide, ordered by id"""
+        out.write("%YAML 1.1\n---\n")
+        with self.lock:
+            rows=self.db.execute("SELECT id, name, description, tips, tags "
+              "FROM exercises ORDER BY id"
+            ).fetchall()
+        for (ex_id, name, desc, tips, tags) in rows:
+            entry={'Name':name}
+            if tags:
+                entry['Tags']=json.loads(tags)
+            if desc!=None:
+                entry['Description']=desc
+            tips=json.loads(tips)
+            if tips!=None:
+                entry['Tips']=tips
+            yaml.safe_dump({ex_id:entry}, out, sort_keys=False,
+              allow_unicode=True, width=78
+            )
+
+    def export_file(self, filename):
+        with io.open(filename, 'w') as f:
+            self.export(f)
+
+    def share_strings(self, strings):
+        # Its text stays in the database
+        pass
+
+    def get_exercise_ids(self):
+        # Read afresh each time, rather than kept in memory
+        with self.lock:
+            return set(row[0] for row in
+              self.db.execute("SELECT id FROM exercises"))
+
+    def suggest(self, word, count=3, max_distance=2):
+        """
+        Return up to count ids within max_distance edits of word, closest
+        first, as Suggester.suggest does.  Each string an edit from word, or
+        with two of its characters dropped, is looked up by key, so ids two
+        edits away otherwise aren't found.
+        """
+        if max_distance<1:
+            return []
+        probes=suggest.edits(word)
+        if max_distance>1:
+            probes.update(twice for once in suggest.deletes(word)
+              for twice in suggest.deletes(once))
+        probes.discard(word)
+        probes=list(probes)
+        found=[]
+        with self.lock:
+            for i in range(0, len(probes), 500):
+                chunk=probes[i:i+500]
+                found.extend(row[0] for row in self.db.execute(
+                  "SELECT id FROM exercises WHERE id IN ({0})".format(
+                    ", ".join("?"*len(chunk))), chunk))
+        ranked=sorted((suggest.distance(word, ex_id, max_distance), ex_id)
+          for ex_id in found)
+        return [ex_id for (d, ex_id) in ranked[:count] if d<=max_distance]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM exercises").fetchone(
+              )[0]
+
+    def get_tags(self, exercise_id):
+        entry=self.fetch(exercise_id)
+        return dict(entry[3]) if entry else {}
+
+    def get_entry(self, exercise_id):
+        entry=self.fetch(exercise_id)
+        if entry==None:
+            raise KeyError(exercise_id)
+        (name, desc, tips, tags)=entry
+        return (name, desc, tips, dict(tags))
+
+    def get_entries(self):
+        # One pass over the table, rather than a lookup per id
+        with self.lock:
+            rows=self.db.execute("SELECT id, name, description, tips, tags "
+              "FROM exercises ORDER BY id"
+            ).fetchall()
+        for row in rows:
+            yield (row[0],)+self.__decode(row[1:])
+
+    def get_exercise(self, exercise_id):
+        entry=self.fetch(exercise_id)
+        if entry==None:
+            raise KeyError(exercise_id)
+        (name, desc, tips, tags)=entry
+        if isinstance(tips, list):
+            # A list of its own, as the cached entry's is shared
+            tips=list(tips)
+        ex=exercise.Exercise(name, desc, tips)
+        ex.ex_id=exercise_id
+        return ex
+
+    def __contains__(self, ex):
+        if hasattr(ex, 'get_exercise_ids'):
+            return super().__contains__(ex)
+        return self.fetch(str(ex))!=None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+#####################################################################
+# Test code
+
+import os, time, tempfile, corpus
+
+class TestDBGuide(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.filename=os.path.join(self.dir.name, 'exercises.db')
+        self.g=guide.Guide()
+        self.g.load_file("data/exercises/kettlebell.yaml")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_import(self):
+        db=DBGuide(self.filename)
+        db.import_file("data/exercises/kettlebell.yaml")
+        db.close()
+        # It's all in the file
+        db=DBGuide(self.filename)
+        self.assertEqual(db.get_exercise_ids(), self.g.get_exercise_ids())
+        self.assertEqual(len(db), 7)
+        for ex_id in self.g.get_exercise_ids():
+            (a, b)=(db.get_exercise(ex_id), self.g.get_exercise(ex_id))
+            self.assertEqual((a.name, a.desc, a.tips, a.ex_id),
+              (b.name, b.desc, b.tips, b.ex_id)
+            )
+            self.assertEqual(db.get_tags(ex_id), self.g.get_tags(ex_id))
+        self.assertEqual(list(db.get_entries()), list(self.g.get_entries()))
+        self.assertEqual(db.get_entry('kettle_swing'),
+          self.g.get_entry('kettle_swing')
+        )
+        self.assertRaises(KeyError, db.get_entry, 'squat')
+        self.assertIn('kettle_swing', db)
+        self.assertNotIn('squat', db)
+        self.assertEqual(db, self.g)
+        self.assertRaises(KeyError, db.get_exercise, 'squat')
+        self.assertEqual(db.get_tags('squat'), {})
+        self.assertRaises(exceptions.ProtocolError, db.reload)
+        # Repeat lookups come from the cache
+        db.get_exercise('kettle_swing')
+        self.assertGreater(db.fetch.cache_info().hits, 0)
+        db.close()
+
+    def test_export(self):
+        db=DBGuide(":memory:")
+        db.import_guide(self.g)
+        out=io.StringIO()
+        db.export(out)
+        again=guide.Guide()
+        again.load_io(io.StringIO(out.getvalue()))
+        self.assertEqual(again.exercises, self.g.exercises)
+        self.assertEqual(again.tags, self.g.tags)
+
+    def test_guidebook(self):
+        db=DBGuide(":memory:")
+        db.import_io(io.StringIO("kettle_swing:\n  Name: Stored swing\n"
+          "squat_left:\n  Name: Squat\n  Tips: Knees out\n"))
+        book=guide.GuideBook()
+        book.add_guide(self.g)
+        self.assertRaises(Warning, book.add_guide, db)
+        self.assertEqual(book.get_exercise('kettle_swing').name,
+          "Stored swing"
+        )
+        self.assertEqual(book.get_exercise('kettle_press_left').name,
+          "Kettlebell left press"
+        )
+        self.assertEqual(book.get_exercise('squat_left').tips, ["Knees out"])
+        self.assertEqual(book.suggest('squat_lfet'), ['squat_left'])
+        self.assertEqual(book.suggest('kettle_swnig'), ['kettle_swing'])
+        # Imports replace what's cached, misses included
+        self.assertRaises(KeyError, book.get_exercise, 'squat_right')
+        generation=db.generation
+        db.import_entries([('squat_left', "Deep squat", None, None, None),
+          ('squat_right', "Squat", None, None, None)])
+        self.assertGreater(db.generation, generation)
+        self.assertEqual(book.get_exercise('squat_left').name, "Deep squat")
+        self.assertEqual(book.get_exercise('squat_right').name, "Squat")
+        self.assertEqual(book.suggest('squat_rihgt'), ['squat_right'])
+        # None of the database's ids are indexed in memory
+        self.assertNotIn('squat_left', book.suggester.words)
+
+    def test_scale(self):
+        db=DBGuide(self.filename, cache_size=64)
+        ids=corpus.exercise_ids(200000)
+        started=time.perf_counter()
+        db.import_entries((ex_id, "Synthetic "+ex_id, "A description",
+          ("Tip one", "Tip two"), {'side':(ex_id.rsplit('_', 1)[1],)})
+          for ex_id in ids)
+        self.assertLess(time.perf_counter()-started, 30)
+        self.assertEqual(len(db), 200000)
+        started=time.perf_counter()
+        for ex_id in ids[::1000]:
+            self.assertEqual(db.get_exercise(ex_id).name, "Synthetic "+ex_id)
+            self.assertIn(ex_id, db)
+        self.assertLess((time.perf_counter()-started)/200, 0.005)
+        self.assertEqual(db.get_tags(ids[1]), {'side':('left',)})
+        started=time.perf_counter()
+        for ex_id in ids[::10000]:
+            typo=ex_id[:3]+ex_id[4]+ex_id[3]+ex_id[5:]
+            self.assertIn(ex_id, db.suggest(typo, 10))
+        self.assertLess((time.perf_counter()-started)/20, 0.02)
+        db.close()
+
+if __name__=="__main__":
+    unittest.main()
@@ -1,19 +1,34 @@
 #!/usr/bin/python3
 
-import countdown,exceptions,sounder
+import countdown,exceptions,sounder,clocks,metrics,tracing
 import time, logging, sys, unittest
 
+overruns={phase:metrics.registry.histogram(
+  'exercise_{0}_overrun_seconds'.format(phase),
+  "How much longer than planned each {0} phase took".format(phase)
+) for phase in ('read','work','rest')}
+
 class Exercise(object):
     def __init__(self, name="", desc="", tips=[]):
         """Create a named exercise object"""
         self.name=name
         self.desc=desc
+        # The id of the guide entry it came from, if any
+        self.ex_id=None
         if not hasattr(tips,'append'):
             # Ensure tips is a list
             tips=[str(tips)]
         self.tips=tips
         self.messagelogger=logging.getLogger(__name__)
         self.sounder=sounder.Sounder()
+        self.clock=clocks.default
+
+    def set_clock(self, clock):
+        """Time the exercise against the given clock (see clocks.py)"""
+        self.clock=clock
+        if hasattr(self,'duration'):
+            self.reading.clock=clock
+            self.countdown.clock=clock
 
     def prep(self, duration, rest=5, read_delay=5):
         """Set the exercise durations.  Arguments:
@@ -38,8 +53,12 @@ class Exercise(object):
               "Not a time traveller: Can't let the user read for {0} second(s)".
               format(repr(read_delay))
             )
-        self.reading=countdown.Countdown(read_delay, self.session_start)
-        self.countdown=countdown.Countdown(duration, self.finish, self.tick)
+        self.reading=countdown.Countdown(read_delay, self.session_start,
+          clock=self.clock
+        )
+        self.countdown=countdown.Countdown(duration, self.finish, self.tick,
+          clock=self.clock
+        )
         self.duration=duration
         self.rest=rest
         self.read_delay=read_delay
@@ -47,8 +66,9 @@ class Exercise(object):
     def get_total_time(self):
         return self.read_delay+self.duration+self.rest
 
-    def start(self):
-        """Run the exercise
+    def start(self, offset=0):
+        """Run the exercise.  Given an offset, start that many seconds in,
+        skipping into the work or rest phase if need be
         
         Throws: Exception is not already prepared
         """
@@ -58,15 +78,35 @@ class Exercise(object):
               "Can't start an exercise without first preparing it"
             )
 
-        self.messagelogger.info("Exercise: "+self.name+", for "+str(self.duration)+"s")
-        self.messagelogger.info("Get ready...")
-        self.reading.start()
-
-    def session_start(self):
-        """Called by self.reading once the read delay is over"""
-        self.sounder.play('sounds/boop.ogg')
+        self.messagelogger.info("Exercise: %s, for %ss", self.name,
+          self.duration
+        )
+        now=self.clock.time()
+        if not offset or offset<self.read_delay:
+            self.messagelogger.info("Get ready...")
+            self.phase_started=now-offset
+            if tracing.enabled:
+                tracing.emit(tracing.PHASE, self.name, 'read', self.read_delay)
+            self.reading.start(offset)
+        elif offset<self.read_delay+self.duration:
+            self.phase_started=now-offset
+            self.session_start(offset-self.read_delay)
+        else:
+            self.phase_started=now-offset+self.read_delay
+            self.finish(offset-self.read_delay-self.duration)
+
+    def session_start(self, offset=0):
+        """Called by self.reading once the read delay is over, or by start()
+        to resume offset seconds into the work phase"""
+        now=self.clock.time()
+        if not offset:
+            overruns['read'].observe(now-self.phase_started-self.read_delay)
+        self.phase_started=now-offset
+        if tracing.enabled:
+            tracing.emit(tracing.PHASE, self.name, 'work', self.duration)
+        self.play('sounds/boop.ogg')
         self.messagelogger.info("Start exercise")
-        self.countdown.start()
+        self.countdown.start(offset)
 
     def tick(self,clock):
         """Used by self.countdown to inform the athlete of progress
@@ -80,21 +120,37 @@ class Exercise(object):
             sys.stdout.flush()
         time_left=self.duration-clock
         if time_left<10:
-            self.messagelogger.debug(str(time_left)+"...")
+            self.messagelogger.debug("%s...", time_left)
         if time_left<5 and time_left>0:
-            self.sounder.play('sounds/beep.ogg')
-
-    def finish(self):
-        """Used by self.countdown to complete the exercise"""
-        if self.messagelogger.isEnabledFor(logging.INFO):
-            sys.stdout.write("\n")
-        self.messagelogger.info("Finish (exercise "+self.name+"): "+str(self.rest)+"s rest")
-        self.sounder.play('sounds/boop.ogg')
-        rest_start=time.time()
-        while time.time()-rest_start < self.rest:
-            time.sleep(0.2)
+            self.play('sounds/beep.ogg')
+
+    def finish(self, offset=0):
+        """Used by self.countdown to complete the exercise, or by start() to
+        resume offset seconds into the rest"""
+        rest_start=self.clock.time()-offset
+        if not offset:
+            overruns['work'].observe(
+              rest_start-self.phase_started-self.duration
+            )
+            if self.messagelogger.isEnabledFor(logging.INFO):
+                sys.stdout.write("\n")
+        self.messagelogger.info("Finish (exercise %s): %ss rest", self.name,
+          self.rest
+        )
+        if tracing.enabled:
+            tracing.emit(tracing.PHASE, self.name, 'rest', self.rest)
+        if not offset:
+            self.play('sounds/boop.ogg')
+        self.clock.sleep_until(rest_start+self.rest, 0.2)
+        overruns['rest'].observe(self.clock.time()-rest_start-self.rest)
         self.messagelogger.info("-"*70)
 
+    def play(self, soundfile):
+        """Sound a cue"""
+        if tracing.enabled:
+            tracing.emit(tracing.CUE, self.name, soundfile)
+        self.sounder.play(soundfile)
+
     def __del__(self):
         self.sounder.stop()
 
@@ -106,7 +162,7 @@ class TestExercise(unittest.TestCase):
     time=0
 
     class MockCountdown(countdown.Countdown):
-        def start(self):
+        def start(self, offset=0):
             if TestExercise.mock:
                 # Don't actually countdown - just add the time
                 TestExercise.time+=self.duration
@@ -120,7 +176,7 @@ class TestExercise(unittest.TestCase):
             if TestExercise.quiet:
                 self.sounder=sounderinterface.QuietSounder()
 
-        def start(self):
+        def start(self, offset=0):
             TestExercise.time=0
             # Plug in our MockCountdown object, to allow mocking
             self.reading=TestExercise.MockCountdown(
@@ -131,9 +187,9 @@ class TestExercise(unittest.TestCase):
               self.countdown.func_finish,
               self.countdown.func_tick
             )
-            super().start()
+            super().start(offset)
 
-        def finish(self):
+        def finish(self, offset=0):
             if TestExercise.mock:
                 TestExercise.time+=self.rest
             else:
@@ -226,6 +282,72 @@ class TestExercise(unittest.TestCase):
         else:
             self.assertLess(abs(time-expected_time),0.2)
 
+    def test_virtual_clock(self):
+        exercise=Exercise("TEST_VIRTUAL")
+        exercise.sounder=sounderinterface.QuietSounder()
+        clock=clocks.VirtualClock()
+        exercise.set_clock(clock)
+        exercise.prep(60, 30, 10)
+        exercise.start()
+        self.assertEqual(clock.time(), 100)
+
+        # Setting the clock after prepping moves the countdowns over too
+        clock=clocks.VirtualClock()
+        exercise.set_clock(clock)
+        exercise.start()
+        self.assertEqual(clock.time(), 100)
+
+    def test_offset(self):
+        played=[]
+        exercise=Exercise("TEST_OFFSET")
+        exercise.sounder=sounderinterface.QuietSounder()
+        exercise.sounder.play=played.append
+        clock=clocks.VirtualClock()
+        exercise.set_clock(clock)
+        exercise.prep(10, 5, 5)
+        # Part way through reading, then working, then resting
+        for (offset, beeps, boops) in ((3, 4, 2), (5, 4, 2), (12, 2, 2),
+          (16, 0, 0)):
+            played.clear()
+            started=clock.time()
+            exercise.start(offset)
+            self.assertEqual(clock.time()-started, 20-offset)
+            self.assertEqual(played.count('sounds/beep.ogg'), beeps)
+            self.assertEqual(played.count('sounds/boop.ogg'), boops)
+
+    def test_metrics(self):
+        counts={phase:overruns[phase].count for phase in overruns}
+        exercise=Exercise("TEST_METRICS")
+        exercise.sounder=sounderinterface.QuietSounder()
+        exercise.set_clock(clocks.VirtualClock())
+        exercise.prep(3, 2, 1)
+        exercise.start()
+        for phase in overruns:
+            self.assertEqual(overruns[phase].count, counts[phase]+1)
+
+    def test_tracing(self):
+        exercise=Exercise("TEST_TRACING")
+        exercise.sounder=sounderinterface.QuietSounder()
+        exercise.set_clock(clocks.VirtualClock())
+        exercise.prep(3, 2, 1)
+        ring=tracing.RingBuffer()
+        tracing.add_sink(ring)
+        try:
+            exercise.start()
+        finally:
+            tracing.remove_sink(ring)
+        events=[(event, fields) for (when, event, fields) in ring.get_events()
+          if event in (tracing.PHASE, tracing.CUE)]
+        self.assertEqual(events, [
+          (tracing.PHASE, ("TEST_TRACING", 'read', 1)),
+          (tracing.PHASE, ("TEST_TRACING", 'work', 3)),
+          (tracing.CUE, ("TEST_TRACING", 'sounds/boop.ogg')),
+          (tracing.CUE, ("TEST_TRACING", 'sounds/beep.ogg')),
+          (tracing.CUE, ("TEST_TRACING", 'sounds/beep.ogg')),
+          (tracing.PHASE, ("TEST_TRACING", 'rest', 2)),
+          (tracing.CUE, ("TEST_TRACING", 'sounds/boop.ogg')),
+        ])
+
     def test_get_total_time(self):
         exercise=Exercise("TEST_TOTAL_DUR")
         exercise.prep(86)
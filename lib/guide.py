@@ -1,10 +1,16 @@
 #!/usr/bin/python3
 import yaml,io,logging,unittest
-import exercise, exceptions
+import exercise, exceptions, suggest, stringtable
 
 class Guide(object):
-    def __init__(self):
-        pass
+    def __init__(self, strings=None):
+        """
+        Descriptions and tips are interned in strings, a StringTable, so text
+        repeated across guides is kept once.  Without one, the guide keeps
+        its text as parsed until it's added to a GuideBook, and moves it into
+        the book's table then.
+        """
+        self.strings=strings
 
     def load_file(self, filename):
         """
@@ -28,9 +34,52 @@ class Guide(object):
             raise exceptions.ParseError(e)
         self.db=self.parse(yamlfile)
         self.filename="StreamIO"
+        if self.strings!=None:
+            self.strings.collect()
+
+    def reload(self):
+        """
+        Re-read the file the guide was loaded from, keeping the entries of
+        any exercises whose definitions are unchanged.  The new set of
+        exercises is swapped in all at once, so lookups in other threads see
+        either the old guide or the new one, never a mixture.  Returns the
+        set of exercise ids added, changed or removed.
+
+        Raises ParseError on a parse failure, leaving the guide as it was
+        Raises ProtocolError if the guide wasn't loaded from a file
+        """
+        if not hasattr(self,'exercises') or self.filename=="StreamIO":
+            raise exceptions.ProtocolError(
+              "Only guides loaded from a file can be reloaded"
+            )
+        with io.open(self.filename) as f:
+            try:
+                yamlfile=yaml.safe_load(f)
+            except yaml.error.YAMLError as e:
+                raise exceptions.ParseError(e)
+        fresh=Guide(self.strings)
+        fresh.parse(yamlfile)
+        old=self.exercises
+        new=fresh.exercises
+        changed=set(ex_id for ex_id in old.keys()|new.keys()
+          if old.get(ex_id)!=new.get(ex_id)
+          or self.tags.get(ex_id)!=fresh.tags.get(ex_id))
+        self.exercises={ex_id:new[ex_id] if ex_id in changed else old[ex_id]
+          for ex_id in new}
+        self.tags=fresh.tags
+        if self.strings!=None:
+            # Once the fresh guide's gone, so the table counts only the text
+            # this one holds
+            del fresh
+            self.strings.collect()
+        return changed
 
     def parse(self, yamlfile):
+        if not hasattr(yamlfile,'keys'):
+            raise exceptions.ParseError("A guide must map exercise ids to "
+              "exercises; got "+str(yamlfile))
         self.exercises={}
+        self.tags={}
         for ex_id in yamlfile:
             if not self.valid_id(ex_id):
                 raise exceptions.ParseError("Exercise id '{0}' is not valid; ".
@@ -46,7 +95,47 @@ class Guide(object):
 
             name=self.yaml_parse_as_scalar(name)
             desc=self.yaml_parse_as_scalar(desc)
-            self.exercises[ex_id]=[name, desc, tips]
+            if self.strings!=None:
+                desc=self.strings.intern(desc)
+                tips=self.strings.intern_tips(tips)
+            self.exercises[ex_id]=(name, desc, tips)
+            if ex.get('Tags')!=None:
+                self.tags[ex_id]=self.parse_tags(ex_id, ex.get('Tags'))
+        if self.strings!=None:
+            self.strings.add_guide(self)
+
+    def share_strings(self, strings):
+        """
+        Move the guide's text into strings, a StringTable shared with other
+        guides, unless it already keeps its text in one
+        """
+        if self.strings!=None:
+            return
+        self.strings=strings
+        strings.add_guide(self)
+        if hasattr(self,'exercises'):
+            self.exercises={ex_id:(name, strings.intern(desc),
+              strings.intern_tips(tips))
+              for (ex_id, (name, desc, tips)) in self.exercises.items()}
+
+    def parse_tags(self, ex_id, tags):
+        """
+        Return an exercise's tags as {attribute: tuple of values}, from a
+        mapping of each attribute to a value or a list of them
+        """
+        if not hasattr(tags,'keys'):
+            raise exceptions.ParseError("Tags for {0} must map attributes to ".
+              format(ex_id)+"values; got "+str(tags))
+        parsed={}
+        for (attribute, values) in tags.items():
+            if not hasattr(values,'append'):
+                values=[values]
+            for value in values:
+                if hasattr(value,'keys') or hasattr(value,'append'):
+                    raise exceptions.ParseError("Expected scalar tag value "+
+                      "for {0}; got {1}".format(ex_id, value))
+            parsed[str(attribute)]=tuple(str(value) for value in values)
+        return parsed
 
     def yaml_parse_as_scalar(self, entry):
         if hasattr(entry,'keys'):
@@ -69,6 +158,13 @@ class Guide(object):
         """Get a list of all the exercises this guide documents"""
         return set(self.exercises.keys())
 
+    def get_tags(self,exercise_id):
+        """
+        Get the tags of an exercise, as {attribute: tuple of values}; empty
+        if it has none, or the guide doesn't carry tags
+        """
+        return dict(getattr(self,'tags',{}).get(exercise_id,{}))
+
     def get_exercise(self,exercise_id):
         """
         Get a new instance of the named Exercise object
@@ -77,7 +173,33 @@ class Guide(object):
             KeyError if the named exercise_id doesn't exist.
         """
         (name, desc, tips) = self.exercises[exercise_id]
-        return exercise.Exercise(name, desc, tips)
+        ex=exercise.Exercise(name, desc, tips)
+        ex.ex_id=exercise_id
+        return ex
+
+    def get_entry(self,exercise_id):
+        """
+        Get the definition of an exercise as (name, desc, tips, tags),
+        without making an Exercise of it where the guide can help it
+
+        Throws:
+            KeyError if the named exercise_id doesn't exist.
+        """
+        exercises=getattr(self,'exercises',None)
+        if exercises!=None:
+            (name, desc, tips)=exercises[exercise_id]
+        else:
+            ex=self.get_exercise(exercise_id)
+            (name, desc, tips)=(ex.name, ex.desc, ex.tips)
+        return (name, desc, tips, self.get_tags(exercise_id))
+
+    def get_entries(self):
+        """
+        Yield (ex_id, name, desc, tips, tags) for every exercise, in order
+        of id, as DBGuide.import_entries takes them
+        """
+        for ex_id in sorted(self.get_exercise_ids()):
+            yield (ex_id,)+self.get_entry(ex_id)
 
     def __contains__(self, exercise):
         if hasattr(exercise,'get_exercise_ids'):
@@ -88,13 +210,42 @@ class Guide(object):
     def __eq__(self, exercise):
         return exercise in self and self in exercise
 
+def find_entry(guides, g, ex_id):
+    """
+    Return (guide, (name, desc, tips, tags)) for the last of guides (or g,
+    if it isn't one of them) defining ex_id, as GuideBook.get_exercise would
+    find it; or None if none do
+    """
+    if not any(other is g for other in guides):
+        guides=guides+[g]
+    for other in reversed(guides):
+        try:
+            return (other, other.get_entry(ex_id))
+        except KeyError:
+            pass
+    return None
+
 class GuideBook(object):
     def __init__(self):
         self.guides=[]
+        # The text of the guides' exercises, shared between them
+        self.strings=stringtable.StringTable()
+        self.listeners=[]
+        self.suggester=None
+        # What the suggester holds from each guide: its exercises dict,
+        # which a reload replaces (or for other guides the guide itself)
+        # and generation, if it has one, and the ids indexed from it
+        self.suggested=[]
 
     def get_guides(self):
         return self.guides
 
+    def add_listener(self,listener):
+        """
+        Call listener(guide) whenever a guide is added, after it's added
+        """
+        self.listeners.append(listener)
+
     def add_guide(self,guide):
         """
         Add a Guide so that any generated Routine files referencing this
@@ -114,7 +265,11 @@ class GuideBook(object):
                 if exercise in exercises.keys():
                     duplicates[exercise]=exercises[exercise]
                 
+            if hasattr(guide,'share_strings'):
+                guide.share_strings(self.strings)
             self.guides.append(guide)
+            for listener in self.listeners:
+                listener(guide)
 
             if len(duplicates)>0:
                 w_exercises=duplicates.keys()
@@ -136,14 +291,65 @@ class GuideBook(object):
         if len(self.get_guides())==0:
             raise KeyError('No guides imported')
         for guide in reversed(self.get_guides()):
-            if exercise_id in guide:
+            # Ask each guide directly, rather than testing 'in', which
+            # would build a set of every id each guide has on every lookup
+            try:
                 return guide.get_exercise(exercise_id)
+            except KeyError:
+                pass
+        suggestions=self.suggest(exercise_id)
         raise KeyError(
-          'Exercise {0} not found in any current guide'.format(
-            repr(exercise_id)
+          'Exercise {0} not found in any current guide{1}'.format(
+            repr(exercise_id),
+            '; did you mean {0}?'.format(' or '.join(repr(s)
+              for s in suggestions)) if suggestions else ''
           )
         )
 
+    def suggest(self,exercise_id,count=3):
+        """
+        Return up to count exercise ids, closest first, that exercise_id
+        might be a mistyping of
+        """
+        if self.suggester==None:
+            self.suggester=suggest.Suggester()
+        # Only the guides added, reloaded or imported into since are
+        # re-indexed, and only by the ids they gained or lost
+        for (i,guide) in enumerate(self.get_guides()):
+            source=(getattr(guide,'exercises',guide),
+              getattr(guide,'generation',None))
+            if i<len(self.suggested):
+                was=self.suggested[i][0]
+                if was[0] is source[0] and was[1]==source[1]:
+                    continue
+                old=self.suggested[i][1]
+            else:
+                self.suggested.append(None)
+                old=frozenset()
+            if hasattr(guide,'suggest'):
+                # It looks up its own suggestions, as a DBGuide does
+                ids=frozenset()
+            elif hasattr(source[0],'keys'):
+                ids=source[0].keys()
+            else:
+                ids=frozenset(guide.get_exercise_ids())
+            self.suggested[i]=(source,ids)
+            self.suggester.update(ids-old)
+            for gone in old-ids:
+                # Unless another guide still has it
+                if not any(gone in other
+                  for (s,other) in self.suggested):
+                    self.suggester.discard(gone)
+        suggestions=self.suggester.suggest(exercise_id,count)
+        others=[guide for guide in self.get_guides()
+          if hasattr(guide,'suggest')]
+        if not others:
+            return suggestions
+        for guide in others:
+            suggestions.extend(guide.suggest(exercise_id,count))
+        return sorted(set(suggestions),key=lambda ex_id:
+          (suggest.distance(exercise_id,ex_id),ex_id))[:count]
+
 class TestGuide(unittest.TestCase):
     def setUp(self):
         self.yaml_header='''
@@ -254,6 +460,7 @@ newlines are bad too":
     def test_exercise_1(self):
         e=self.g.get_exercise('test_exercise')
         self.assertEquals(e.name,'Test exercise')
+        self.assertEquals(e.ex_id,'test_exercise')
         self.assertEquals(e.desc,'Test description')
         self.assertEquals(e.tips,['Test tip 1'])
 
@@ -263,6 +470,53 @@ newlines are bad too":
         self.assertEquals(e.desc,'Test description 2\non two lines')
         self.assertEquals(e.tips,['Test tip 1','Test tip 2','Test tip 3'])
 
+    def test_reload(self):
+        import tempfile, os
+        with tempfile.TemporaryDirectory() as d:
+            filename=os.path.join(d,'guide.yaml')
+            with open(filename,'w') as f:
+                f.write("a:\n  Name: A\nb:\n  Name: B\nc:\n  Name: C\n")
+            g=Guide()
+            g.load_file(filename)
+            self.assertRaises(exceptions.ProtocolError,self.g.reload)
+            entry=g.exercises['a']
+            with open(filename,'w') as f:
+                f.write("a:\n  Name: A\nb:\n  Name: Bee\nd:\n  Name: D\n")
+            self.assertEqual(g.reload(),set(['b','c','d']))
+            with open(filename,'w') as f:
+                f.write("a:\n  Name: A\nb:\n  Name: Bee\nd:\n  Name: D\n"
+                  "  Tags: {side: left}\n")
+            self.assertEqual(g.reload(),set(['d']))
+            self.assertEqual(g.get_tags('d'),{'side':('left',)})
+            self.assertEqual(g.get_exercise_ids(),set(['a','b','d']))
+            self.assertEqual(g.get_exercise('b').name,'Bee')
+            # Unchanged entries are kept as they were
+            self.assertIs(g.exercises['a'],entry)
+            self.assertEqual(g.reload(),set())
+            with open(filename,'w') as f:
+                f.write("a:\n  Name: [Broken\n")
+            self.assertRaises(exceptions.ParseError,g.reload)
+            self.assertEqual(g.get_exercise('b').name,'Bee')
+
+    def test_tags(self):
+        g=Guide()
+        g.load_io(io.StringIO(self.yaml_header+'''
+a:
+    Name: A
+    Tags: {equipment: kettlebell, muscles: [arms, core], reps: 10}
+b:
+    Name: B
+'''))
+        self.assertEqual(g.get_tags('a'),{'equipment':('kettlebell',),
+          'muscles':('arms','core'),'reps':('10',)}
+        )
+        self.assertEqual(g.get_tags('b'),{})
+        self.assertEqual(self.g.get_tags('kettle_swing'),{})
+        for tags in ('[arms, core]','{muscles: [[arms]]}','{side: {a: b}}'):
+            self.assertRaises(exceptions.ParseError,Guide().load_io,
+              io.StringIO('a:\n  Name: A\n  Tags: '+tags+'\n')
+            )
+
     def test_book(self):
         b=GuideBook()
         self.assertRaises(KeyError,b.get_exercise,'test_exercise')
@@ -283,5 +537,55 @@ newlines are bad too":
           'Test exercise 2'
         )
 
+    def test_suggest(self):
+        b=GuideBook()
+        b.add_guide(self.g)
+        self.assertEqual(b.suggest('test_exercise_3'),['test_exercise_2'])
+        self.assertRaisesRegexp(KeyError,
+          "did you mean 'kettle_clean_left'\\?",b.get_exercise,
+          'kettle_clean_lfet'
+        )
+        self.assertRaisesRegexp(KeyError,'guide"$',b.get_exercise,'squat')
+        # Guides added later are suggested from too
+        g=Guide()
+        g.load_io(io.StringIO("kettle_squat:\n  Name: Squat\n"))
+        b.add_guide(g)
+        self.assertEqual(b.suggest('kettle_sqaut'),['kettle_squat'])
+        g.exercises={}
+        self.assertEqual(b.suggest('kettle_sqaut'),[])
+
+    def test_suggest_reload(self):
+        import tempfile, os
+        b=GuideBook()
+        b.add_guide(self.g)
+        with tempfile.TemporaryDirectory() as d:
+            filename=os.path.join(d,'guide.yaml')
+            with open(filename,'w') as f:
+                f.write("kettle_swing:\n  Name: Swing\nsquat:\n  Name: S\n")
+            g=Guide()
+            g.load_file(filename)
+            self.assertRaises(Warning,b.add_guide,g)
+            self.assertEqual(b.suggest('sqaut'),['squat'])
+            suggester=b.suggester
+            with open(filename,'w') as f:
+                f.write("lunge:\n  Name: Lunge\n")
+            g.reload()
+            # Updated in place, by the ids the reload changed
+            self.assertEqual(b.suggest('lnuge'),['lunge'])
+            self.assertIs(b.suggester,suggester)
+            self.assertEqual(b.suggest('sqaut'),[])
+            # Still in the other guide
+            self.assertEqual(b.suggest('kettle_swnig'),['kettle_swing'])
+            self.assertEqual(len(b.suggester),len(self.g.exercises)+1)
+
+    def test_listeners(self):
+        b=GuideBook()
+        added=[]
+        b.add_listener(added.append)
+        b.add_guide(self.g)
+        b.add_guide(self.g)
+        self.assertRaises(Warning,b.add_guide,self.g2)
+        self.assertEqual(added,[self.g,self.g2])
+
 if __name__=="__main__":
     unittest.main()
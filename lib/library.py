@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+"""
+Statistics across a whole library of routine files.
+
+A Library reads routine files as outlines (see RoutineFile.outline), without
+preparing any exercises, and holds them as columns: one row for each
+distinct exercise entry in a routine, with the number of times it runs once
+repeated blocks are expanded.  Exercise ids are interned as numbers and
+durations held in integer arrays, so queries run across the columns in bulk
+rather than routine by routine:
+
+    lib=library.Library()
+    lib.load(filenames, cache="library.cache")
+    lib.get_exercise_seconds()      # {exercise id: total seconds of work}
+    lib.get_ratio_distribution()    # how many runs at each work:rest ratio
+    lib.get_over_budget(45*60)      # routines taking over 45 minutes
+
+The columns can be cached in a file between runs.  Each routine file is
+stamped with its modification time and size, and only files which have
+changed since are read again.
+"""
+
+import os, io, array, pickle, bisect, operator, itertools, unittest
+import routine, exceptions
+
+COLUMNS=('routine', 'exercise', 'duration', 'rest', 'read_delay', 'count')
+
+def flatten(plan, overrides=None, times=1):
+    """
+    Yield (ex_id, duration, rest, read_delay, count) for each exercise entry
+    in a routine's plan, with blocks' rounds counted out and their round
+    overrides applied
+    """
+    for entry in plan:
+        if isinstance(entry, routine.BlockPlan):
+            own=dict(entry.overrides)
+            # Rounds without overrides of their own all run the same
+            usual=entry.rounds-len(own)
+            if usual:
+                yield from flatten(entry.plan, overrides, times*usual)
+            for settings in own.values():
+                merged=dict(overrides) if overrides else {}
+                merged.update(settings)
+                yield from flatten(entry.plan, merged, times)
+        else:
+            yield (entry[0],)+routine.effective(entry, overrides)+(times,)
+
+class Library(object):
+    def __init__(self):
+        self.ids=[]             # Exercise number -> id
+        self.numbers={}         # Exercise id -> number
+        self.files=[]           # Routine number -> filename
+        self.stamps=[]          # Routine number -> (mtime, size)
+        self.names=[]           # Routine number -> routine name
+        self.errors={}          # Filename -> why it couldn't be read
+        # Each routine's rows are first[routine] to first[routine+1]
+        self.first=array.array('q', [0])
+        self.columns={column:array.array('q') for column in COLUMNS}
+
+    def __intern(self, ex_id):
+        number=self.numbers.get(ex_id)
+        if number==None:
+            number=len(self.ids)
+            self.ids.append(ex_id)
+            self.numbers[ex_id]=number
+        return number
+
+    def __add(self, filename, stamp, name, rows):
+        number=len(self.files)
+        self.files.append(filename)
+        self.stamps.append(stamp)
+        self.names.append(name)
+        columns=self.columns
+        for (ex_id, duration, rest, read_delay, count) in rows:
+            columns['routine'].append(number)
+            columns['exercise'].append(self.__intern(ex_id))
+            columns['duration'].append(duration)
+            columns['rest'].append(rest)
+            columns['read_delay'].append(read_delay)
+            columns['count'].append(count)
+        self.first.append(len(columns['routine']))
+
+    def __rows(self, number):
+        # A routine's rows, as add takes them
+        (start, end)=(self.first[number], self.first[number+1])
+        columns=[self.columns[column][start:end] for column in COLUMNS[1:]]
+        return [(self.ids[row[0]],)+row[1:] for row in zip(*columns)]
+
+    def add_io(self, file_io, filename='StreamIO', stamp=None):
+        """
+        Add the routine read from a file object
+
+        Throws: ParseError or DefaultError if it doesn't parse
+        """
+        (name, desc, plan)=routine.RoutineFile().outline(file_io)
+        self.__add(filename, stamp, name, flatten(plan))
+
+    def load(self, filenames, cache=None):
+        """
+        Add routine files, reusing the columns cached for any unchanged since
+        the cache file was written, then rewrite the cache.  Files that can't
+        be read or don't parse are skipped, and noted in self.errors.
+        """
+        cached=Library.load_cache(cache) if cache else None
+        index={filename:i for (i, filename)
+          in enumerate(cached.files)} if cached else {}
+        for filename in filenames:
+            try:
+                st=os.stat(filename)
+                stamp=(st.st_mtime_ns, st.st_size)
+                i=index.get(filename)
+                if i!=None and cached.stamps[i]==stamp:
+                    self.__add(filename, stamp, cached.names[i],
+                      cached.__rows(i)
+                    )
+                    continue
+                with io.open(filename) as f:
+                    self.add_io(f, filename, stamp)
+            except (OSError, exceptions.ParseError,
+              exceptions.DefaultError) as e:
+                self.errors[filename]=str(e)
+        if cache:
+            self.save_cache(cache)
+
+    @staticmethod
+    def load_cache(filename):
+        """Return the Library cached in a file, or None if there isn't one"""
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save_cache(self, filename):
+        # Written aside and renamed into place, so a reader never sees half
+        with open(filename+".new", 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(filename+".new", filename)
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_column(self, column):
+        """Return one of the COLUMNS, as an array with an entry per row"""
+        return self.columns[column]
+
+    def __sum_by(self, keys, values, size):
+        totals=array.array('q', bytes(8*size))
+        for (key, value) in zip(keys, values):
+            totals[key]+=value
+        return totals
+
+    def get_exercise_seconds(self, column='duration'):
+        """
+        Return the total seconds each exercise id is programmed for, across
+        every routine: of work by default, or of 'rest' or 'read_delay'
+        """
+        c=self.columns
+        totals=self.__sum_by(c['exercise'],
+          map(operator.mul, c[column], c['count']), len(self.ids)
+        )
+        return dict(zip(self.ids, totals))
+
+    def get_total_times(self):
+        """Return an array of each routine's total time"""
+        c=self.columns
+        row_times=map(operator.mul, map(operator.add,
+          map(operator.add, c['duration'], c['rest']), c['read_delay']),
+          c['count']
+        )
+        return self.__sum_by(c['routine'], row_times, len(self.files))
+
+    def get_ratio_distribution(self, bounds=(0.5, 1, 2, 4)):
+        """
+        Return how many times exercises run at each work:rest ratio: a count
+        for below bounds[0], for each range bounds[i] up to bounds[i+1], and
+        for bounds[-1] and up, which includes any run with no rest at all
+        """
+        c=self.columns
+        counts=[0]*(len(bounds)+1)
+        for (duration, rest, count) in zip(c['duration'], c['rest'],
+          c['count']):
+            ratio=duration/rest if rest else float('inf')
+            counts[bisect.bisect_right(bounds, ratio)]+=count
+        return counts
+
+    def get_over_budget(self, budget):
+        """
+        Return (filename, total seconds) for each routine taking longer than
+        budget seconds
+        """
+        totals=self.get_total_times()
+        over=list(map(budget.__lt__, totals))
+        return list(zip(itertools.compress(self.files, over),
+          itertools.compress(totals, over)))
+
+#####################################################################
+# Test code
+
+import random, tempfile, corpus
+
+class CountingLibrary(Library):
+    def add_io(self, file_io, filename='StreamIO', stamp=None):
+        self.reads=getattr(self, 'reads', [])+[filename]
+        super().add_io(file_io, filename, stamp)
+
+class TestLibrary(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, text):
+        filename=os.path.join(self.dir.name, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def test_data(self):
+        lib=Library()
+        lib.load(["data/routines/upperbody2", "data/routines/circuit1"])
+        self.assertEqual(lib.errors, {})
+        rf=routine.RoutineFile()
+        outlines=[]
+        for filename in lib.files:
+            outline=routine.Outline()
+            with open(filename) as f:
+                rf.load_io_into(outline, f)
+            outlines.append(outline.get_total_time())
+        self.assertEqual(list(lib.get_total_times()), outlines)
+        self.assertEqual(lib.get_over_budget(2000),
+          [("data/routines/circuit1", 2895)]
+        )
+        # Ten rounds of 30s
+        circuit=Library()
+        circuit.load(["data/routines/circuit1"])
+        self.assertEqual(circuit.get_exercise_seconds()['kettle_lunge_right'],
+          300
+        )
+        self.assertEqual(sum(lib.get_ratio_distribution()),
+          sum(lib.get_column('count'))
+        )
+
+    def test_flatten(self):
+        lib=Library()
+        lib.add_io(io.StringIO("rest=5\nread_delay=0\nrepeat=3\n"
+          "@2 rest=10\nrepeat=2\n@1 duration=1\na,30\nend\nend\nb,20,0\n"))
+        self.assertEqual(sorted(zip(*(lib.get_column(c) for c in COLUMNS))), [
+          (0, 0, 1, 5, 0, 2), (0, 0, 1, 10, 0, 1), (0, 0, 30, 5, 0, 2),
+          (0, 0, 30, 10, 0, 1), (0, 1, 20, 0, 0, 1)
+        ])
+        self.assertEqual(lib.get_exercise_seconds(), {'a':93, 'b':20})
+        self.assertEqual(lib.get_exercise_seconds('rest'), {'a':40, 'b':0})
+        self.assertEqual(list(lib.get_total_times()), [93+40+20])
+        # 1:5 and 1:10 below 0.5; 30:10 from 2; 30:5 and 20:0 from 4
+        self.assertEqual(lib.get_ratio_distribution(), [3, 0, 0, 1, 3])
+
+    def test_cache(self):
+        ids=corpus.exercise_ids(20)
+        filenames=[self.write("routine{0}".format(i),
+          corpus.routine_text(30, ids, seed=i)) for i in range(50)]
+        filenames.append(self.write("broken", "name\n"))
+        cache=os.path.join(self.dir.name, "cache")
+        first=Library()
+        first.load(filenames, cache)
+        self.assertEqual(list(first.errors), [filenames[-1]])
+        self.assertEqual(len(first), 50)
+        # Change one file; only it (and the broken one) are read again
+        filenames[3]=self.write("routine3", "x,1000,0,0\n")
+        os.utime(filenames[3], ns=(1, 1))
+        second=CountingLibrary()
+        second.load(filenames, cache)
+        self.assertEqual(second.reads, [filenames[3], filenames[-1]])
+        self.assertEqual(second.get_total_times()[3], 1000)
+        for i in (0, 4, 49):
+            self.assertEqual(second.get_total_times()[i],
+              first.get_total_times()[i]
+            )
+        self.assertEqual(second.get_exercise_seconds()['x'], 1000)
+        self.assertEqual(Library.load_cache(cache).get_exercise_seconds(),
+          second.get_exercise_seconds()
+        )
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,262 @@
+#!/usr/bin/python3
+"""
+A small in-process metrics registry of counters, gauges and histograms.
+
+Countdown, Exercise and the sounder backends record into the default
+registry: how late ticks fire, how far each phase overruns its planned
+length, and how long starting a sound takes.  A snapshot can be taken as a
+dict, as text or as JSON, or served over local HTTP.
+
+Recording is kept cheap (well under a microsecond) so that it can always be
+left on: metrics are created once, up front, and recording an event is an
+attribute update or a bisect.
+"""
+
+import bisect, json, threading, unittest
+import http.server
+
+class Counter(object):
+    __slots__=('name', 'help', 'value')
+    kind='counter'
+
+    def __init__(self, name, help):
+        self.name=name
+        self.help=help
+        self.value=0
+
+    def inc(self, amount=1):
+        self.value+=amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(Counter):
+    __slots__=()
+    kind='gauge'
+
+    def set(self, value):
+        self.value=value
+
+class Histogram(object):
+    """
+    Counts observations into buckets by their upper bounds, plus a final
+    bucket for anything larger, and keeps their total.
+    """
+    __slots__=('name', 'help', 'bounds', 'counts', 'sum', 'count')
+    kind='histogram'
+
+    # Seconds, from 100 microseconds to 10s
+    DEFAULT_BOUNDS=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1,
+      5, 10)
+
+    def __init__(self, name, help, bounds=DEFAULT_BOUNDS):
+        self.name=name
+        self.help=help
+        self.bounds=tuple(bounds)
+        self.counts=[0]*(len(self.bounds)+1)
+        self.sum=0
+        self.count=0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)]+=1
+        self.sum+=value
+        self.count+=1
+
+    def snapshot(self):
+        buckets={}
+        for (bound, count) in zip(self.bounds, self.counts):
+            buckets[repr(bound)]=count
+        buckets['+Inf']=self.counts[-1]
+        return {'count':self.count, 'sum':self.sum, 'buckets':buckets}
+
+class Registry(object):
+    def __init__(self):
+        self.metrics={}
+
+    def __get(self, cls, name, help, *args):
+        if name in self.metrics:
+            metric=self.metrics[name]
+            if not isinstance(metric, cls) or metric.kind!=cls.kind:
+                raise ValueError("Metric {0} is already a {1}".format(
+                  repr(name), metric.kind
+                ))
+            return metric
+        metric=cls(name, help, *args)
+        self.metrics[name]=metric
+        return metric
+
+    def counter(self, name, help=""):
+        """Return the named Counter, creating it if need be"""
+        return self.__get(Counter, name, help)
+
+    def gauge(self, name, help=""):
+        """Return the named Gauge, creating it if need be"""
+        return self.__get(Gauge, name, help)
+
+    def histogram(self, name, help="", bounds=Histogram.DEFAULT_BOUNDS):
+        """Return the named Histogram, creating it if need be"""
+        return self.__get(Histogram, name, help, bounds)
+
+    def snapshot(self):
+        """Return the current value of every metric, by name"""
+        return {name:self.metrics[name].snapshot()
+          for name in sorted(self.metrics)}
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_text(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines=[]
+        for name in sorted(self.metrics):
+            metric=self.metrics[name]
+            if metric.help:
+                lines.append("# HELP {0} {1}".format(name, metric.help))
+            lines.append("# TYPE {0} {1}".format(name, metric.kind))
+            if metric.kind=='histogram':
+                total=0
+                for (bound, count) in zip(metric.bounds+('+Inf',),
+                  metric.counts):
+                    total+=count
+                    lines.append('{0}_bucket{{le="{1}"}} {2}'.format(
+                      name, bound, total
+                    ))
+                lines.append("{0}_sum {1}".format(name, metric.sum))
+                lines.append("{0}_count {1}".format(name, metric.count))
+            else:
+                lines.append("{0} {1}".format(name, metric.value))
+        return "\n".join(lines)+"\n"
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """
+        Serve the metrics over HTTP in a background thread: as text at
+        /metrics, and as JSON at /metrics.json.  Returns the server; its
+        server_address says which port it's on, and shutdown() stops it.
+        """
+        registry=self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path=='/metrics':
+                    (body, kind)=(registry.to_text(), 'text/plain')
+                elif self.path=='/metrics.json':
+                    (body, kind)=(registry.to_json(), 'application/json')
+                else:
+                    self.send_error(404)
+                    return
+                body=body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server=http.server.ThreadingHTTPServer((host, port), Handler)
+        thread=threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+# The registry everything records into unless told otherwise
+registry=Registry()
+
+#####################################################################
+# Test code
+
+import time, urllib.request
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_gauge(self):
+        r=Registry()
+        c=r.counter('ticks', 'Ticks counted')
+        c.inc()
+        c.inc(2)
+        self.assertIs(r.counter('ticks'), c)
+        g=r.gauge('level')
+        g.set(4.5)
+        self.assertEqual(r.snapshot(), {'level':4.5, 'ticks':3})
+        self.assertRaisesRegex(ValueError, "already a counter",
+          r.gauge, 'ticks'
+        )
+        self.assertRaises(ValueError, r.histogram, 'level')
+
+    def test_histogram(self):
+        r=Registry()
+        h=r.histogram('latency', bounds=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            h.observe(value)
+        self.assertEqual(h.snapshot(), {'count':4, 'sum':2.65,
+          'buckets':{'0.1':2, '1':1, '+Inf':1}
+        })
+        text=r.to_text()
+        self.assertIn('# TYPE latency histogram', text)
+        self.assertIn('latency_bucket{le="1"} 3', text)
+        self.assertIn('latency_bucket{le="+Inf"} 4', text)
+        self.assertIn('latency_count 4', text)
+        self.assertEqual(json.loads(r.to_json())['latency']['count'], 4)
+
+    def test_serve(self):
+        r=Registry()
+        r.counter('served', 'A test counter').inc(7)
+        server=r.serve()
+        try:
+            url='http://127.0.0.1:{0}'.format(server.server_address[1])
+            with urllib.request.urlopen(url+'/metrics') as reply:
+                self.assertIn('served 7', reply.read().decode('utf-8'))
+            with urllib.request.urlopen(url+'/metrics.json') as reply:
+                self.assertEqual(json.loads(reply.read())['served'], 7)
+            self.assertRaises(urllib.error.HTTPError, urllib.request.urlopen,
+              url+'/other'
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_overhead(self):
+        import countdown, clocks
+        r=Registry()
+        c=r.counter('events')
+        h=r.histogram('seconds')
+        n=100000
+        values=[i/n for i in range(n)]
+        best=None
+        for attempt in range(5):
+            started=time.perf_counter()
+            for value in values:
+                h.observe(value)
+                c.inc()
+            taken=(time.perf_counter()-started)/n
+            best=taken if best==None else min(best, taken)
+        # A histogram observation and a counter increment per event
+        self.assertLess(best, 1e-6)
+        class Unrecorded(object):
+            __slots__=()
+            def observe(self, value):
+                pass
+        recorded=(countdown.tick_lateness, countdown.finish_lateness)
+        def run():
+            started=time.perf_counter()
+            countdown.Countdown(20000, lambda: None,
+              clock=clocks.VirtualClock()
+            ).start()
+            return time.perf_counter()-started
+        (on, off)=(None, None)
+        try:
+            # Interleaved, so both see the same load
+            for attempt in range(10):
+                (countdown.tick_lateness, countdown.finish_lateness)=recorded
+                taken=run()
+                on=taken if on==None else min(on, taken)
+                countdown.tick_lateness=Unrecorded()
+                countdown.finish_lateness=countdown.tick_lateness
+                taken=run()
+                off=taken if off==None else min(off, taken)
+        finally:
+            (countdown.tick_lateness, countdown.finish_lateness)=recorded
+        # Virtual ticks don't sleep, so this is the worst case: everything
+        # else a tick does costs little more than recording it
+        self.assertLess(on/off, 1.75)
+
+if __name__=="__main__":
+    unittest.main()
@@ -1,5 +1,9 @@
-import sounderinterface
-import subprocess
+import sounderinterface, metrics
+import subprocess, time
+
+play_seconds=metrics.registry.histogram('sounder_play_seconds',
+  "How long the sounder took to start playing each sound"
+)
 
 @sounderinterface.register
 class LinuxSounder(sounderinterface.SounderInterface):
@@ -10,12 +14,14 @@ class LinuxSounder(sounderinterface.SounderInterface):
  
     def play(self,soundfile):
         """play a soundfile and return immediately"""
+        started=time.perf_counter()
         self.stop()
         self.lastsound=subprocess.Popen(
           ['mplayer', soundfile],
           stdout=open('/dev/null','w'),
           stderr=open('/dev/null','w')
         )
+        play_seconds.observe(time.perf_counter()-started)
 
     def stop(self):
         """clear any currently playing sound"""
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+"""
+Back-to-back routines, without a gap between them for loading.
+
+    p=playlist.Playlist(lookahead=1)
+    p.add_guide(g)
+    p.add("data/routines/upperbody2")
+    p.add("data/routines/circuit1")
+    p.run()
+
+Each routine file is read, and all its exercises prepared (sounders and
+all), in a background thread while the routine before it runs, up to
+'lookahead' routines ahead, so the next one's ready to start the moment the
+last one's final rest ends.  Within each routine, the next exercises are
+likewise got ready while the current one runs (see Routine.set_lookahead).
+With a lookahead of 0 everything's loaded as it's reached, as before.
+"""
+
+import unittest
+import guide, routine, prefetch
+
+class Playlist(object):
+    def __init__(self, guidebook=None, lookahead=1, clock=None):
+        """
+        Optional parameters:
+            guidebook   The GuideBook to find exercises in; by default a new
+                        one, which add_guide adds to
+            lookahead   How many routines, and exercises within each routine,
+                        to get ready ahead of the one running
+            clock       The clock to time every routine against
+        """
+        self.guidebook=guidebook if guidebook else guide.GuideBook()
+        self.lookahead=lookahead
+        self.clock=clock
+        self.filenames=[]
+
+    def add_guide(self, g):
+        self.guidebook.add_guide(g)
+
+    def add(self, filename):
+        """Queue up a routine file to run after those already added"""
+        self.filenames.append(filename)
+
+    def get_filenames(self):
+        return list(self.filenames)
+
+    def load(self, filename):
+        """
+        Load and prepare one routine.  This runs in the background thread,
+        so each load gets a RoutineFile of its own, whose default settings
+        no other file can change underfoot.
+
+        Throws: OSError, ParseError, DefaultError or KeyError, as
+          RoutineFile.load_file_into, raised in run() in place of the
+          routine
+        """
+        routinefile=routine.RoutineFile()
+        routinefile.guidebook=self.guidebook
+        r=routine.Routine(self.guidebook, self.clock)
+        return routinefile.load_file_into(r, filename)
+
+    def routines(self):
+        """Load each routine in turn, as it's asked for"""
+        for filename in self.filenames:
+            yield self.load(filename)
+
+    def run(self, started=None):
+        """
+        Run every routine, one after the other.  started(routine), if given,
+        is called just before each routine starts.
+        """
+        routines=self.routines()
+        if self.lookahead:
+            routines=prefetch.prefetch(routines, self.lookahead)
+        try:
+            for r in routines:
+                r.set_lookahead(self.lookahead)
+                if started:
+                    started(r)
+                r.start()
+        finally:
+            routines.close()
+
+#####################################################################
+# Test code
+
+import os, time, tempfile, clocks, exceptions
+from simulate import RecordingSounder
+
+class FastClock(clocks.VirtualClock):
+    """A VirtualClock that takes a fiftieth of the time it says, for real"""
+
+    def sleep_until(self, deadline, poll=None):
+        if deadline>self.time():
+            time.sleep((deadline-self.time())/50)
+        super().sleep_until(deadline)
+
+class TestPlaylist(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        self.guide=g
+        self.filenames=[]
+        for (i, duration) in enumerate((5, 10, 15)):
+            filename=os.path.join(self.dir.name, 'routine{0}'.format(i))
+            with open(filename, 'w') as f:
+                f.write("name=Routine {0}\n".format(i))
+                f.write("kettle_swing,{0},0,0\nkettle_swing,{0},0,0\n".format(
+                  duration
+                ))
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def playlist(self, cls=Playlist, lookahead=1, clock=None):
+        clock=clock if clock else clocks.VirtualClock()
+        p=cls(lookahead=lookahead, clock=clock)
+        p.add_guide(self.guide)
+        for filename in self.filenames:
+            p.add(filename)
+        cues=[]
+        def started(r):
+            for ex in r.get_exercises():
+                ex.sounder=RecordingSounder(clock, cues)
+        return (p, cues, started)
+
+    def test_order(self):
+        (p, cues, started)=self.playlist()
+        names=[]
+        def record(r):
+            names.append(r.get_name())
+            started(r)
+        p.run(record)
+        self.assertEqual(names, ["Routine 0", "Routine 1", "Routine 2"])
+        # Each routine starts where the one before it finished
+        self.assertEqual([t for (t, sound) in cues if 'boop' in sound], [
+          0, 5, 5, 10, 10, 20, 20, 30, 30, 45, 45, 60
+        ])
+
+    def test_gapless(self):
+        class SlowPlaylist(Playlist):
+            def load(self, filename):
+                time.sleep(0.2)
+                return super().load(filename)
+
+        def gaps(lookahead):
+            (p, cues, started)=self.playlist(SlowPlaylist, lookahead,
+              FastClock()
+            )
+            times=[]
+            def record(r):
+                times.append(time.perf_counter())
+                started(r)
+            p.run(record)
+            # Each routine runs for a fiftieth of its total, in real time
+            return [times[i+1]-times[i]-total/50
+              for (i, total) in enumerate((10, 20))]
+
+        for gap in gaps(0):
+            self.assertGreater(gap, 0.15)
+        for gap in gaps(1):
+            self.assertLess(gap, 0.1)
+
+    def test_errors(self):
+        (p, cues, started)=self.playlist()
+        p.add(os.path.join(self.dir.name, 'missing'))
+        names=[]
+        def record(r):
+            names.append(r.get_name())
+            started(r)
+        # Raised once the routines before it have run
+        self.assertRaises(OSError, p.run, record)
+        self.assertEqual(len(names), 3)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+"""
+Background lookahead over slow iterators.
+
+    for routine in prefetch.prefetch(load_each(filenames), lookahead=1):
+        routine.start()
+
+runs load_each in a background thread, keeping up to 'lookahead' items ready
+ahead of the loop, so that the work of producing each item overlaps with
+the consumer's use of the one before it.  Items arrive in order; anything
+the iterator raises is raised in the consumer in its place.  Closing the
+generator (or leaving the loop early) stops the thread at its next item.
+"""
+
+import queue, threading, unittest
+
+END=object()
+
+def prefetch(iterable, lookahead=1):
+    if lookahead<1:
+        raise ValueError("Lookahead must be at least 1")
+    items=queue.Queue(lookahead)
+    stopping=threading.Event()
+
+    def put(entry):
+        # Give up if the consumer has gone away
+        while not stopping.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((END, None))
+        except BaseException as e:
+            put((END, e))
+
+    thread=threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            (item, error)=items.get()
+            if item is END:
+                if error!=None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopping.set()
+
+#####################################################################
+# Test code
+
+import time
+
+class TestPrefetch(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(list(prefetch(range(100), 3)), list(range(100)))
+        self.assertEqual(list(prefetch([])), [])
+        self.assertRaises(ValueError, list, prefetch([], 0))
+
+    def test_lookahead(self):
+        produced=[]
+        def slow():
+            for i in range(5):
+                time.sleep(0.05)
+                produced.append(i)
+                yield i
+        items=prefetch(slow(), 2)
+        self.assertEqual(next(items), 0)
+        # While the consumer's busy, the next items are got ready, but no
+        # more than the lookahead (plus the one waiting to go in)
+        time.sleep(0.3)
+        self.assertEqual(produced, [0, 1, 2, 3])
+        started=time.perf_counter()
+        self.assertEqual(next(items), 1)
+        self.assertLess(time.perf_counter()-started, 0.04)
+        items.close()
+
+    def test_errors(self):
+        def failing():
+            yield 1
+            raise KeyError("Test")
+        items=prefetch(failing())
+        self.assertEqual(next(items), 1)
+        self.assertRaises(KeyError, next, items)
+
+if __name__=="__main__":
+    unittest.main()
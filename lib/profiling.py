@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""
+Section-labelled profiling for entry points.
+
+A Profiler runs cProfile over everything between start() and stop(), and
+also times labelled sections of the run:
+
+    with profiler.section("load guides"):
+        ...
+
+report() then gives the wall clock cost of each section, and dump() writes
+the full profile for pstats, snakeviz and friends.  When profiling is off,
+use the shared 'null' profiler instead: its sections do nothing.
+"""
+
+import io, sys, time, cProfile, pstats, contextlib, unittest
+
+class Profiler(object):
+    enabled=True
+
+    def __init__(self):
+        self.profile=cProfile.Profile()
+        self.sections={}    # name -> [calls, total seconds]
+        self.order=[]
+        self.started=None
+        self.stopped=None
+
+    def start(self):
+        self.started=time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.stopped=time.perf_counter()
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """Time the enclosed block under the given label"""
+        started=time.perf_counter()
+        try:
+            yield
+        finally:
+            taken=time.perf_counter()-started
+            if name not in self.sections:
+                self.sections[name]=[0, 0.0]
+                self.order.append(name)
+            self.sections[name][0]+=1
+            self.sections[name][1]+=taken
+
+    def get_sections(self):
+        """Return (name, calls, total seconds) for each section, in order"""
+        return [(name,)+tuple(self.sections[name]) for name in self.order]
+
+    def report(self, out=sys.stderr):
+        """
+        Write the cost of each section.  Sections may nest, so their totals
+        can add up to more than the whole run.
+        """
+        total=(self.stopped or time.perf_counter())-self.started
+        out.write("{0:40} {1:>6} {2:>10} {3:>6}\n".format(
+          "Section", "Calls", "Seconds", "%"
+        ))
+        for (name, calls, seconds) in self.get_sections():
+            out.write("{0:40} {1:6d} {2:10.4f} {3:6.1f}\n".format(
+              name[:40], calls, seconds, 100*seconds/total if total else 0
+            ))
+        out.write("{0:40} {1:6} {2:10.4f}\n".format("Total", "", total))
+
+    def dump(self, filename):
+        """Write the cProfile data, loadable with pstats.Stats(filename)"""
+        self.profile.dump_stats(filename)
+
+class NullProfiler(object):
+    """A profiler that does nothing, at as little cost as possible"""
+    enabled=False
+
+    def __init__(self):
+        self.nothing=contextlib.nullcontext()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def section(self, name):
+        return self.nothing
+
+null=NullProfiler()
+
+#####################################################################
+# Test code
+
+import os, tempfile
+
+class TestProfiler(unittest.TestCase):
+    def test_sections(self):
+        p=Profiler()
+        p.start()
+        with p.section("outer"):
+            for i in range(3):
+                with p.section("inner"):
+                    sum(range(1000))
+        p.stop()
+        sections=p.get_sections()
+        self.assertEqual([(name, calls) for (name, calls, s) in sections],
+          [("inner", 3), ("outer", 1)]
+        )
+        self.assertGreaterEqual(sections[1][2], sections[0][2])
+        out=io.StringIO()
+        p.report(out)
+        self.assertIn("inner", out.getvalue())
+        self.assertIn("Total", out.getvalue())
+        with tempfile.TemporaryDirectory() as d:
+            filename=os.path.join(d, 'test.prof')
+            p.dump(filename)
+            self.assertGreater(pstats.Stats(filename).total_calls, 0)
+
+    def test_section_exception(self):
+        p=Profiler()
+        p.start()
+        try:
+            with p.section("failing"):
+                raise ValueError("Test")
+        except ValueError:
+            pass
+        p.stop()
+        self.assertEqual(p.get_sections()[0][:2], ("failing", 1))
+
+    def test_null(self):
+        with null.section("anything"):
+            pass
+        null.start()
+        null.stop()
+        self.assertFalse(null.enabled)
+
+if __name__=="__main__":
+    unittest.main()
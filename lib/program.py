@@ -0,0 +1,492 @@
+#!/usr/bin/python3
+"""
+Training programs: routines scheduled over days and weeks.
+
+A program file lists sessions by day and time of day, counting from day 1,
+and the routine file each one runs, relative to the program file:
+
+    Name=Four week kettlebell program
+    # Format: day,time,routine_file
+    1,07:00,../routines/upperbody2
+    3,07:00,../routines/circuit1
+
+A Program keeps its sessions sorted by start, with a running total of their
+planned durations, so that what's due in a range and how much is planned in
+it are found by binary search.  What was on at a given time comes from a
+centred interval tree of the sessions, in time logarithmic in their number
+plus the number found.  Routine durations come from a RoutineTotals cache,
+which outlines each routine file once (without preparing any exercises) and
+holds on to its total until the file changes.  Queries don't look at the
+routine files at all, so a Program's index stands until refresh() (or
+Calendar.refresh(), for every program) finds any of them changed; call it
+whenever routines may have been edited, on a timer, say.
+
+A Calendar puts athletes on programs from a given start time.  Athletes on
+the same program file share one Program, which is only read from disk when
+first asked about.
+"""
+
+import os, io, array, bisect, unittest
+import routine, exceptions
+
+DAY=24*60*60
+WEEK=7*DAY
+
+class RoutineTotals(object):
+    """
+    The total times of routine files, cached by filename, and worked out
+    again only if a file changes
+    """
+
+    def __init__(self):
+        self.totals={}      # filename -> (stamp, total seconds)
+        self.stats={'hits':0, 'misses':0}
+
+    def get_total_time(self, filename):
+        """
+        Throws: OSError if the file can't be read, or ParseError or
+          DefaultError if it doesn't parse
+        """
+        stamp=self.stamp(filename)
+        cached=self.totals.get(filename)
+        if cached and cached[0]==stamp:
+            self.stats['hits']+=1
+            return cached[1]
+        self.stats['misses']+=1
+        outline=routine.Outline()
+        with io.open(filename) as f:
+            routine.RoutineFile().load_io_into(outline, f)
+        total=outline.get_total_time()
+        self.totals[filename]=(stamp, total)
+        return total
+
+    def stamp(self, filename):
+        st=os.stat(filename)
+        return (st.st_mtime_ns, st.st_size)
+
+    def changed(self, filenames):
+        """
+        Return whether any of the files has changed since its total was
+        worked out (or can't now be read)
+        """
+        for filename in filenames:
+            cached=self.totals.get(filename)
+            try:
+                if cached==None or cached[0]!=self.stamp(filename):
+                    return True
+            except OSError:
+                return True
+        return False
+
+class Program(object):
+    def __init__(self, totals=None):
+        """
+        Optional parameters:
+            totals      The RoutineTotals to get routine durations from
+        """
+        self.name=None
+        self.totals=totals if totals else RoutineTotals()
+        self.sessions=[]    # (offset, routine filename), in any order
+        self.index=None
+        self.filename=None
+
+    def set_name(self, name):
+        self.name=name
+
+    def get_name(self):
+        self.load()
+        return self.name
+
+    def add_session(self, offset, routine_file):
+        """Schedule a routine offset seconds after the program starts"""
+        self.sessions.append((offset, routine_file))
+        self.index=None
+
+    def load_file(self, filename, lazy=True):
+        """
+        Read sessions from a program file: straight away, or, if lazy, the
+        first time the program is asked about
+
+        Throws (when read): OSError, or ParseError for a bad line
+        """
+        self.filename=filename
+        if not lazy:
+            self.load()
+
+    def load(self):
+        """
+        Read the program file given to load_file, if it hasn't been yet.
+        Should it fail, the program is left as it was, to be tried again.
+
+        Throws: OSError, or ParseError for a bad line
+        """
+        if self.filename==None:
+            return
+        fresh=Program(self.totals)
+        with io.open(self.filename) as f:
+            fresh.load_io(f, os.path.dirname(self.filename))
+        if fresh.name!=None:
+            self.name=fresh.name
+        self.sessions.extend(fresh.sessions)
+        (self.index, self.filename)=(None, None)
+
+    def load_io(self, file_io, directory=''):
+        """
+        Read sessions from a file object, with routine files relative to
+        directory
+
+        Throws: ParseError for a bad line
+        """
+        for line in file_io.readlines():
+            line=line.strip()
+            if len(line)==0 or line[0]=="#":
+                continue
+            if '=' in line:
+                (setting, value)=line.split('=', 1)
+                if setting.strip().lower()!='name':
+                    raise exceptions.ParseError(
+                      "Unrecognised setting {0}\n  Line:{1}".format(
+                        repr(setting.strip()), line
+                      )
+                    )
+                self.set_name(value.strip())
+                continue
+            fields=line.split(',', 2)
+            if len(fields)!=3:
+                raise exceptions.ParseError(
+                  "Sessions take the form day,hh:mm,routine_file\n"
+                  "  Line:{0}".format(line)
+                )
+            try:
+                day=int(fields[0])
+                (hours, minutes)=(int(n) for n in fields[1].split(':'))
+            except ValueError:
+                raise exceptions.ParseError(
+                  "Bad day or time\n  Line:{0}".format(line)
+                )
+            if day<1 or not 0<=hours<24 or not 0<=minutes<60:
+                raise exceptions.ParseError(
+                  "Day or time out of range\n  Line:{0}".format(line)
+                )
+            self.add_session((day-1)*DAY+hours*3600+minutes*60,
+              os.path.normpath(os.path.join(directory, fields[2].strip()))
+            )
+
+    def refresh(self):
+        """
+        Drop the index if any of the program's routine files has changed
+        since it was built, so the next query rebuilds it.  Returns whether
+        it did.
+        """
+        if self.index!=None and self.totals.changed(self.index[3]):
+            self.index=None
+            return True
+        return False
+
+    def __get_index(self):
+        self.load()
+        if self.index==None:
+            self.sessions.sort()
+            starts=array.array('d')
+            # Running totals of durations, from 0
+            planned=array.array('d', [0])
+            intervals=[]
+            total=0
+            # Each routine file is looked at once, however many sessions
+            # run it
+            routine_files=set(routine_file
+              for (offset, routine_file) in self.sessions)
+            durations={routine_file:self.totals.get_total_time(routine_file)
+              for routine_file in routine_files}
+            for (i, (offset, routine_file)) in enumerate(self.sessions):
+                duration=durations[routine_file]
+                starts.append(offset)
+                total+=duration
+                planned.append(total)
+                if duration>0:
+                    intervals.append((offset, offset+duration, i))
+            self.index=(starts, planned, build_tree(intervals), routine_files)
+        return self.index
+
+    def get_sessions(self):
+        """Return every (offset, routine filename), in order"""
+        self.__get_index()
+        return list(self.sessions)
+
+    def get_due(self, start, end):
+        """Return the (offset, routine filename)s starting in [start, end)"""
+        (starts, planned, tree, routine_files)=self.__get_index()
+        return self.sessions[bisect.bisect_left(starts, start):
+          bisect.bisect_left(starts, end)]
+
+    def get_planned_time(self, start, end):
+        """
+        Return the total planned seconds of sessions starting in [start, end)
+        """
+        (starts, planned, tree, routine_files)=self.__get_index()
+        return planned[bisect.bisect_left(starts, end)]- \
+          planned[bisect.bisect_left(starts, start)]
+
+    def get_at(self, offset):
+        """
+        Return the (offset, routine filename)s of any sessions in progress
+        offset seconds into the program
+        """
+        (starts, planned, tree, routine_files)=self.__get_index()
+        return [self.sessions[i] for i in sorted(query_tree(tree, offset))]
+
+def build_tree(intervals):
+    """
+    Return a centred interval tree of (start, end, value) intervals, sorted
+    by start, each covering [start, end): a node for the middle interval's
+    start, holding every interval covering that point (once by start, and
+    once by end, latest first), with the intervals wholly before it in one
+    subtree and those wholly after it in the other; or None if there are no
+    intervals
+    """
+    if not intervals:
+        return None
+    centre=intervals[len(intervals)//2][0]
+    (before, here, after)=([], [], [])
+    for interval in intervals:
+        if interval[1]<=centre:
+            before.append(interval)
+        elif interval[0]>centre:
+            after.append(interval)
+        else:
+            here.append(interval)
+    return (centre, here, sorted(here, key=lambda i: -i[1]),
+      build_tree(before), build_tree(after))
+
+def query_tree(tree, point):
+    """Return the values of the intervals in a tree covering point"""
+    found=[]
+    while tree!=None:
+        (centre, by_start, by_end, before, after)=tree
+        if point<centre:
+            # Everything here ends after the centre, so covers the point if
+            # it's started by then
+            for (start, end, value) in by_start:
+                if start>point:
+                    break
+                found.append(value)
+            tree=before
+        else:
+            # Everything here has started by the centre
+            for (start, end, value) in by_end:
+                if end<=point:
+                    break
+                found.append(value)
+            tree=after if point>centre else None
+    return found
+
+class Calendar(object):
+    def __init__(self, totals=None):
+        self.totals=totals if totals else RoutineTotals()
+        self.programs={}    # filename -> Program
+        self.athletes={}    # athlete -> (Program, start time)
+
+    def get_program(self, filename):
+        """Return the Program for a file, shared by all its athletes"""
+        program=self.programs.get(filename)
+        if program==None:
+            program=Program(self.totals)
+            program.load_file(filename)
+            self.programs[filename]=program
+        return program
+
+    def refresh(self):
+        """
+        Refresh every program (see Program.refresh); returns whether any
+        changed
+        """
+        changed=False
+        for program in self.programs.values():
+            changed=program.refresh() or changed
+        return changed
+
+    def add_athlete(self, athlete, program_file, start):
+        """Put an athlete on a program, with day 1 beginning at time start"""
+        self.athletes[athlete]=(self.get_program(program_file), start)
+
+    def get_athletes(self):
+        return list(self.athletes)
+
+    def get_due(self, athlete, start, end):
+        """
+        Return (time, routine filename) for each of the athlete's sessions
+        starting in [start, end)
+        """
+        (program, began)=self.athletes[athlete]
+        return [(began+offset, routine_file) for (offset, routine_file)
+          in program.get_due(start-began, end-began)]
+
+    def get_planned_time(self, athlete, start, end):
+        (program, began)=self.athletes[athlete]
+        return program.get_planned_time(start-began, end-began)
+
+    def get_weekly_planned_time(self, athlete, start, weeks):
+        """Return the athlete's planned seconds for each of a run of weeks"""
+        return [self.get_planned_time(athlete, start+i*WEEK, start+(i+1)*WEEK)
+          for i in range(weeks)]
+
+    def get_at(self, athlete, time):
+        """Return (time, routine filename) for anything on at a given time"""
+        (program, began)=self.athletes[athlete]
+        return [(began+offset, routine_file) for (offset, routine_file)
+          in program.get_at(time-began)]
+
+    def get_total_planned_time(self, start, end):
+        """Return the planned seconds across every athlete"""
+        return sum(program.get_planned_time(start-began, end-began)
+          for (program, began) in self.athletes.values())
+
+#####################################################################
+# Test code
+
+import random, tempfile, time
+
+class TestProgram(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.routines=[]
+        for (i, duration) in enumerate((600, 1800, 45)):
+            filename=os.path.join(self.dir.name, 'routine{0}'.format(i))
+            with open(filename, 'w') as f:
+                f.write("x,{0},0,0\n".format(duration))
+            self.routines.append(filename)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_data(self):
+        p=Program()
+        p.load_file("data/programs/kettlebell4")
+        self.assertEqual(p.sessions, [])
+        self.assertEqual(p.get_name(), "Four week kettlebell program")
+        self.assertEqual(len(p.get_due(0, 4*WEEK)), 12)
+        self.assertEqual(p.get_due(0, DAY)[0],
+          (7*3600, "data/routines/upperbody2")
+        )
+        self.assertEqual(p.get_planned_time(0, WEEK),
+          2*p.totals.get_total_time("data/routines/upperbody2")+
+          p.totals.get_total_time("data/routines/circuit1")
+        )
+        self.assertEqual(p.totals.stats['misses'], 2)
+
+    def test_bad(self):
+        for text in ("1,07:00", "x,07:00,a", "1,25:00,a", "0,07:00,a",
+          "1,7,a", "start=1"):
+            self.assertRaises(exceptions.ParseError, Program().load_io,
+              io.StringIO(text)
+            )
+
+    def test_queries(self):
+        rand=random.Random(39)
+        p=Program()
+        for i in range(500):
+            p.add_session(rand.randrange(100*DAY), rand.choice(self.routines))
+        # Against the obvious linear scans
+        durations={f:p.totals.get_total_time(f) for f in self.routines}
+        sessions=sorted(p.sessions)
+        # Building the index looks at each routine file once, and queries
+        # don't look at them again; only refreshing does
+        stamped=[]
+        stamp=p.totals.stamp
+        p.totals.stamp=lambda f: stamped.append(f) or stamp(f)
+        for attempt in range(200):
+            start=rand.randrange(-DAY, 101*DAY)
+            end=start+rand.randrange(10*DAY)
+            due=[s for s in sessions if start<=s[0]<end]
+            self.assertEqual(p.get_due(start, end), due)
+            self.assertEqual(p.get_planned_time(start, end),
+              sum(durations[f] for (o, f) in due)
+            )
+            self.assertEqual(p.get_at(start), [s for s in sessions
+              if s[0]<=start<s[0]+durations[s[1]]])
+        self.assertEqual(p.totals.stats['misses'], 3)
+        self.assertEqual(sorted(stamped), sorted(self.routines))
+        self.assertFalse(p.refresh())
+        self.assertEqual(sorted(stamped), sorted(self.routines*2))
+
+    def test_long_session(self):
+        # One long session first, then many short ones: only the sessions
+        # on at a point are visited, not every one back to the long one
+        p=Program()
+        with open(self.routines[0], 'w') as f:
+            f.write("x,{0},0,0\n".format(100000*60))
+        p.add_session(0, self.routines[0])
+        for i in range(100000):
+            p.add_session(10+i*60, self.routines[2])
+        self.assertEqual(p.get_at(5), [(0, self.routines[0])])
+        started=time.perf_counter()
+        for i in range(1000):
+            offset=10+i*97*60+30
+            self.assertEqual(p.get_at(offset), [(0, self.routines[0]),
+              (offset-30, self.routines[2])]
+            )
+        self.assertLess((time.perf_counter()-started)/1000, 0.001)
+        # Editing a routine changes what's on, once the program's refreshed
+        p.get_planned_time(0, 1)
+        self.assertFalse(p.refresh())
+        with open(self.routines[0], 'w') as f:
+            f.write("x,1,0,0\n")
+        stat=os.stat(self.routines[0])
+        os.utime(self.routines[0],
+          ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+        self.assertEqual(p.get_at(5), [(0, self.routines[0])])
+        self.assertTrue(p.refresh())
+        self.assertEqual(p.get_at(5), [])
+        self.assertEqual(p.get_planned_time(0, 1), 1)
+
+    def test_failed_load(self):
+        program=os.path.join(self.dir.name, 'program')
+        with open(program, 'w') as f:
+            f.write("name=Broken\n1,08:00,routine0\n1,25:00,routine1\n")
+        p=Program()
+        p.load_file(program)
+        # Nothing's half loaded, and asking again reads it again
+        for attempt in range(2):
+            self.assertRaises(exceptions.ParseError, p.get_due, 0, WEEK)
+            self.assertEqual((p.name, p.sessions), (None, []))
+        with open(program, 'w') as f:
+            f.write("name=Fixed\n1,08:00,routine0\n")
+        self.assertEqual(p.get_due(0, WEEK), [(8*3600, self.routines[0])])
+        self.assertEqual(p.get_name(), "Fixed")
+        p.load_file(os.path.join(self.dir.name, 'missing'))
+        self.assertRaises(OSError, p.get_at, 0)
+        self.assertEqual(p.sessions, [(8*3600, self.routines[0])])
+
+    def test_calendar(self):
+        program=os.path.join(self.dir.name, 'program')
+        with open(program, 'w') as f:
+            f.write("name=Test\n1,08:00,routine0\n2,08:00,routine1\n"
+              "8,09:30,routine2\n")
+        c=Calendar()
+        started=time.perf_counter()
+        for athlete in range(1000):
+            c.add_athlete(athlete, program, athlete*DAY)
+        self.assertEqual(len(c.programs), 1)
+        self.assertEqual(c.get_due(3, 3*DAY, 4*DAY),
+          [(3*DAY+8*3600, self.routines[0])]
+        )
+        self.assertEqual(c.get_at(3, 4*DAY+8*3600+1000),
+          [(4*DAY+8*3600, self.routines[1])]
+        )
+        self.assertEqual(c.get_at(3, 4*DAY+8*3600+1800), [])
+        self.assertEqual(c.get_weekly_planned_time(0, 0, 3),
+          [2400, 45, 0]
+        )
+        self.assertEqual(c.get_total_planned_time(0, 1010*DAY), 1000*2445)
+        self.assertLess(time.perf_counter()-started, 1)
+        with open(self.routines[2], 'w') as f:
+            f.write("x,90,0,0\n")
+        stat=os.stat(self.routines[2])
+        os.utime(self.routines[2],
+          ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+        self.assertTrue(c.refresh())
+        self.assertEqual(c.get_weekly_planned_time(0, 0, 2), [2400, 90])
+        self.assertFalse(c.refresh())
+
+if __name__=="__main__":
+    unittest.main()
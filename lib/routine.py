@@ -1,12 +1,202 @@
 #!/usr/bin/python3
-import io, unittest, collections
-import guide, exceptions
+import io, copy, bisect, unittest, collections
+import guide, exceptions, clocks, profiling, prefetch
+
+# A repeated block's entry in a Routine's plan; other entries are exercises'
+# (ex_id, duration, rest, read_delay).  overrides is a sorted tuple of
+# (round, ((setting, value), ...)), and plan the block's own entries.
+BlockPlan=collections.namedtuple('BlockPlan', 'rounds overrides plan')
+
+def effective(plan, overrides):
+    """
+    Return (duration, rest, read_delay) for an exercise's entry in a plan,
+    with any round overrides applied
+    """
+    (ex_id, duration, rest, read_delay)=plan
+    if overrides:
+        duration=overrides.get('duration', duration)
+        rest=overrides.get('rest', rest)
+        read_delay=overrides.get('read_delay', read_delay)
+    return (duration, rest, read_delay)
+
+def plan_entry(item):
+    """
+    Return an item's entry in a plan: a BlockPlan for a Block, or
+    (ex_id, duration, rest, read_delay) for an exercise.  Prepared exercises
+    already hold all four, so they're read back rather than kept twice;
+    Outlines keep each exercise's entry as the item itself.
+    """
+    if isinstance(item, Block):
+        return item.get_plan()
+    if isinstance(item, tuple):
+        return item
+    return (item.ex_id, item.duration, item.rest, item.read_delay)
+
+class Block(object):
+    """
+    A run of exercises, and perhaps nested Blocks, repeated for a number of
+    rounds.  Each exercise is prepared just once, and run again in every
+    round, so a circuit costs the same memory however many times it goes
+    round.  A round may override the duration, rest or read delay of all of
+    the exercises in it, including those in nested blocks; an exercise is
+    prepared once more for each different set of durations that gives it,
+    the first time it's needed, so that preparing the next exercise never
+    disturbs the one running.
+    """
+    settings=('duration', 'rest', 'read_delay')
+
+    def __init__(self, rounds):
+        """
+        Throws: ParseError if rounds is less than 1
+        """
+        if rounds<1:
+            raise exceptions.ParseError(
+              "A block must repeat at least once, not {0} time(s)".format(
+                rounds
+              )
+            )
+        self.rounds=rounds
+        self.items=[]
+        # Round number, counting from 1 -> {setting: value}
+        self.overrides={}
+        # (index, durations) -> exercise prepared for overridden durations
+        self.variants={}
+
+    def add(self, item):
+        """Add an exercise or a nested block"""
+        self.items.append(item)
+
+    def set_override(self, round, setting, value):
+        """
+        Override a setting for every exercise in the given round
+
+        Throws: ParseError if there's no such round or setting, or the
+          value's negative
+        """
+        if round<1 or round>self.rounds:
+            raise exceptions.ParseError(
+              "No round {0} in a block of {1} round(s)".format(
+                round, self.rounds
+              )
+            )
+        if setting not in self.settings:
+            raise exceptions.ParseError(
+              "Rounds can't override {0}; only {1}".format(
+                repr(setting), ", ".join(self.settings)
+              )
+            )
+        if value<0:
+            raise exceptions.ParseError(
+              "Not a time traveller: Can't set {0} to {1}".format(
+                setting, value
+              )
+            )
+        self.overrides.setdefault(round, {})[setting]=value
+
+    def get_plan(self):
+        """Return the block's entry for a Routine's plan, as a BlockPlan"""
+        return BlockPlan(self.rounds,
+          tuple(sorted((round, tuple(sorted(settings.items())))
+            for (round, settings) in self.overrides.items())),
+          tuple(plan_entry(item) for item in self.items)
+        )
+
+    def get_exercises(self):
+        """Return each Exercise in the block once"""
+        exercises=[]
+        for item in self.items:
+            if isinstance(item, Block):
+                exercises.extend(item.get_exercises())
+            else:
+                exercises.append(item)
+        return exercises
+
+    def set_clock(self, clock):
+        for exercise in self.get_exercises():
+            exercise.set_clock(clock)
+
+    def __round_overrides(self, round, overrides):
+        own=self.overrides.get(round)
+        if not own:
+            return overrides
+        merged=dict(overrides) if overrides else {}
+        merged.update(own)
+        return merged
+
+    def get_round_time(self, overrides=None):
+        """Return how long one round takes, given any outer overrides"""
+        total=0
+        for item in self.items:
+            if isinstance(item, Block):
+                total+=item.get_total_time(overrides)
+            else:
+                total+=sum(effective(plan_entry(item), overrides))
+        return total
+
+    def get_total_time(self, overrides=None):
+        """
+        Return how long all the rounds take, given any outer overrides.
+        Rounds without overrides of their own all take the same time, so
+        only those with overrides are worked out separately.
+        """
+        total=self.get_round_time(overrides)*(self.rounds-len(self.overrides))
+        for round in self.overrides:
+            total+=self.get_round_time(self.__round_overrides(round, overrides))
+        return total
+
+    def phases(self, start=0, offset=0, overrides=None):
+        """
+        Yield (start, exercise) for each exercise as its turn comes round,
+        for a block starting 'start' seconds into the routine, from whichever
+        is in progress 'offset' seconds in.  Rounds before then are skipped
+        over whole.  An exercise whose round overrides its durations is
+        yielded as a copy prepared for them.
+        """
+        usual=None
+        for round in range(1, self.rounds+1):
+            round_overrides=self.__round_overrides(round, overrides)
+            if round in self.overrides:
+                time=self.get_round_time(round_overrides)
+            else:
+                if usual==None:
+                    usual=self.get_round_time(overrides)
+                time=usual
+            if start+time<=offset and start<offset:
+                start+=time
+                continue
+            for (i, item) in enumerate(self.items):
+                if isinstance(item, Block):
+                    yield from item.phases(start, offset, round_overrides)
+                    start+=item.get_total_time(round_overrides)
+                    continue
+                plan=plan_entry(item)
+                durations=effective(plan, round_overrides)
+                time=sum(durations)
+                if start+time>offset or start>=offset:
+                    yield (start, self.__get_variant(i, item, plan, durations))
+                start+=time
+
+    def __get_variant(self, i, item, plan, durations):
+        if durations==effective(plan, None):
+            return item
+        variant=self.variants.get((i, durations))
+        if variant==None:
+            variant=copy.copy(item)
+            variant.prep(*durations)
+            self.variants[(i, durations)]=variant
+        # Follow the template's sounder and clock, should they have changed
+        if variant.sounder is not item.sounder:
+            variant.sounder=item.sounder
+        if variant.clock is not item.clock:
+            variant.set_clock(item.clock)
+        return variant
 
 class Routine(object):
     """An exercise routine - a list of Exercises that have been prepped with
-    the appropriate durations, so that they can be run in series."""
+    the appropriate durations, so that they can be run in series.  Runs of
+    exercises may be grouped into Blocks, repeated for a number of rounds."""
 
-    def __init__(self,guidebook=None):
+    def __init__(self,guidebook=None,clock=None):
         """
         Create an exercise routine.
 
@@ -16,13 +206,27 @@ class Routine(object):
 
             If not specified, this class creates its own GuideBook, which you
             can get using get_guidebook and add guides to after the fact.
+
+            clock       The clock to time the exercises against (see
+                        clocks.py); by default a PausableClock over the real
+                        time clock, so that the routine can be paused and
+                        seeked while it runs
         """
         self.name=None
         self.desc=None
+        # Exercises and Blocks, run in turn
         self.exercises=[]
+        # The blocks being added to, innermost last
+        self.blocks=[]
         self.guidebook=guidebook
         if self.guidebook==None:
             self.guidebook=guide.GuideBook()
+        self.clock=clock if clock else clocks.PausableClock()
+        self.profiler=profiling.null
+        self.lookahead=0
+        self.listeners=[]
+        self.position=None
+        self.seek_to=None
 
     def get_guidebook(self):
         """Return the live guidebook - please handle with care"""
@@ -37,12 +241,60 @@ class Routine(object):
     def get_name(self):
         return self.name
 
+    def get_clock(self):
+        return self.clock
+
+    def set_profiler(self,profiler):
+        """
+        Profile preparing and running this routine's exercises in sections
+        (see profiling.py)
+        """
+        self.profiler=profiler
+
+    def add_listener(self,listener):
+        """
+        Call listener(exercise, started, planned, actual) after each exercise
+        runs to its end: when it started by the routine's clock, and how many
+        seconds it was planned to take and actually took, all counting any
+        part of it skipped by starting part way through
+        """
+        self.listeners.append(listener)
+
+    def set_lookahead(self,lookahead):
+        """
+        Get up to lookahead exercises ready in a background thread while
+        each runs, rather than between them (see prefetch.py).  Changes made
+        by update() while running then take effect after the exercises
+        already got ready.  0, the default, gets each ready as it's reached.
+        """
+        self.lookahead=lookahead
+
+    def set_clock(self,clock):
+        """Time this routine, and all its exercises, against a new clock"""
+        self.clock=clock
+        for exercise in self.get_exercises():
+            exercise.set_clock(clock)
+
     def get_description(self):
         return self.desc
 
+    def get_exercises(self):
+        """
+        Return each Exercise in the routine once, however many times blocks
+        repeat it
+        """
+        exercises=[]
+        for item in self.exercises:
+            if isinstance(item,Block):
+                exercises.extend(item.get_exercises())
+            else:
+                exercises.append(item)
+        return exercises
+
     def add_exercise(self,ex_id, duration, rest, read_delay):
         """
-        Add a named exercise.
+        Add a named exercise, to the innermost block being added to if
+        there is one.
 
         Parameters:
         ex_id        The id of the exercise to add
@@ -54,20 +306,332 @@ class Routine(object):
         Throws:
         KeyError     If the id isn't recognised - it's not defined in any Guides
         """
-        ex=self.get_guidebook().get_exercise(ex_id)
-        ex.prep(duration, rest, read_delay)
-        self.exercises.append(ex)
-    
+        self.__add(self.__prep(ex_id, duration, rest, read_delay))
+
+    def __add(self, item):
+        if self.blocks:
+            self.blocks[-1].add(item)
+        else:
+            self.exercises.append(item)
+
+    def __prep(self, ex_id, duration, rest, read_delay):
+        with self.profiler.section("prep"):
+            ex=self.get_guidebook().get_exercise(ex_id)
+            ex.set_clock(self.clock)
+            ex.prep(duration, rest, read_delay)
+        return ex
+
+    def begin_block(self,rounds):
+        """
+        Start a block, repeated for the given number of rounds.  Exercises
+        and blocks added before the matching end_block() go in it.
+
+        Throws: ParseError if rounds is less than 1
+        """
+        block=Block(rounds)
+        self.__add(block)
+        self.blocks.append(block)
+
+    def set_round_override(self,round,setting,value):
+        """
+        Override the duration, rest or read_delay of every exercise in one
+        round of the block being added to
+
+        Throws:
+        ProtocolError  If no block has been begun
+        ParseError     If there's no such round or setting
+        """
+        if not self.blocks:
+            raise exceptions.ProtocolError(
+              "Round overrides can only be set within a block"
+            )
+        self.blocks[-1].set_override(round,setting,value)
+
+    def end_block(self):
+        """
+        Finish the innermost block being added to
+
+        Throws: ProtocolError if no block has been begun
+        """
+        if not self.blocks:
+            raise exceptions.ProtocolError("No block to end")
+        self.blocks.pop()
+
+    def get_plan(self):
+        """
+        Return the routine as a plan: a list with each exercise's
+        (ex_id, duration, rest, read_delay), and a BlockPlan for each block
+        """
+        return [plan_entry(item) for item in self.exercises]
+
+    def update(self,plan,changed=()):
+        """
+        Bring the exercises still to come into line with a new plan, such as
+        RoutineFile.outline() returns.  Only entries which differ from the
+        current plan, or which use an id in changed (for exercises redefined
+        in a guide), are prepared afresh; the exercise or block in progress
+        and any already done are left alone.  The new list of exercises is
+        swapped in all at once, so a running routine just carries on with
+        it.  Returns the number of exercises prepared.
+
+        Throws:
+        KeyError     If the plan uses an id not defined in any Guides, in which
+                       case the routine is left as it was
+        """
+        position=self.position
+        first=position[0]+1 if position else 0
+        current=self.get_plan()
+        exercises=self.exercises[:first]
+        prepared=0
+        for i in range(first,len(plan)):
+            if i<len(current) and plan[i]==current[i] and \
+              not self.__uses(plan[i],changed):
+                exercises.append(self.exercises[i])
+                continue
+            item=self.__build(plan[i])
+            new=item.get_exercises() if isinstance(item,Block) else [item]
+            if i<len(self.exercises):
+                old=self.exercises[i]
+                old=old.get_exercises() if isinstance(old,Block) else [old]
+                if old:
+                    # Give the new exercises a sounder of their own, of the
+                    # same kind, so the old ones can't stop it from under
+                    # them when they're collected.  The old ones keep theirs,
+                    # as a lookahead may already have them ready to run.
+                    for ex in new:
+                        ex.sounder=type(old[0].sounder)()
+            exercises.append(item)
+            prepared+=len(new)
+        self.exercises=exercises
+        return prepared
+
+    def __uses(self,entry,ex_ids):
+        if isinstance(entry,BlockPlan):
+            return any(self.__uses(sub,ex_ids) for sub in entry.plan)
+        return entry[0] in ex_ids
+
+    def __build(self,entry):
+        if not isinstance(entry,BlockPlan):
+            return self.__prep(*entry)
+        block=Block(entry.rounds)
+        for (round,settings) in entry.overrides:
+            for (setting,value) in settings:
+                block.set_override(round,setting,value)
+        for sub in entry.plan:
+            block.add(self.__build(sub))
+        return block
+
     def get_total_time(self):
-        """Sum the total times for all of the exercises"""
+        """
+        Sum the total times for all of the exercises, working out repeated
+        blocks without running through every round
+        """
         totals=[exercise.get_total_time() for exercise in self.exercises]
         return sum(totals)
 
-    def start(self):
-        """Run all the exercises"""
+    def get_starts(self):
+        """
+        Return the offset in seconds at which each exercise or block starts
+        """
+        starts=[]
+        offset=0
         for exercise in self.exercises:
-            exercise.start()
-            
+            starts.append(offset)
+            offset+=exercise.get_total_time()
+        return starts
+
+    def locate(self,offset):
+        """
+        Return (index, offset into that exercise or block) for an offset in
+        seconds into the routine.  Offsets past the end give the number of
+        exercises.
+        """
+        starts=self.get_starts()
+        if offset>0 and offset>=self.get_total_time():
+            return (len(self.exercises),0)
+        i=max(bisect.bisect_right(starts,offset)-1,0)
+        return (i,max(offset-starts[i],0))
+
+    def phases(self,offset=0):
+        """
+        Yield (start, exercise) for each exercise in the order they're run,
+        expanding blocks round by round as they're reached, from whichever is
+        in progress offset seconds in.  Exercises in blocks are prepared for
+        their round as they're yielded, so each must be finished with before
+        the next is asked for.
+        """
+        for (i,start,exercise) in self.__phases(offset):
+            yield (start,exercise)
+
+    def __phases(self,offset):
+        i=0
+        start=0
+        # Look the list up each time round, as update() may replace it
+        while i<len(self.exercises):
+            item=self.exercises[i]
+            total=item.get_total_time()
+            if start+total>offset or start>=offset:
+                if isinstance(item,Block):
+                    for (at,exercise) in item.phases(start,offset):
+                        yield (i,at,exercise)
+                else:
+                    yield (i,start,item)
+            start+=total
+            i+=1
+
+    def start(self,offset=0):
+        """
+        Run all the exercises, starting offset seconds in.  While it runs,
+        other threads may pause(), resume() and seek() the routine.
+        """
+        self.seek_to=offset
+        try:
+            while self.seek_to!=None:
+                offset=self.seek_to
+                self.seek_to=None
+                if isinstance(self.clock,clocks.PausableClock):
+                    # Drop any interrupt left over from a seek that raced
+                    # the end of the routine
+                    self.clock.interrupted=False
+                try:
+                    self.__run(offset)
+                except clocks.Interrupted:
+                    if self.seek_to==None:
+                        raise
+        finally:
+            self.position=None
+
+    def __run(self,offset):
+        phases=self.__phases(offset)
+        if self.lookahead:
+            phases=prefetch.prefetch(phases,self.lookahead)
+        try:
+            for (n,(i,start,exercise)) in enumerate(phases,1):
+                into=max(offset-start,0)
+                # One tuple, so get_offset() in another thread sees it all at
+                # once
+                started=self.clock.time()-into
+                self.position=(i,start,started)
+                with self.profiler.section("exercise {0}: {1}".format(
+                  n, exercise.name
+                )):
+                    exercise.start(into)
+                for listener in self.listeners:
+                    listener(exercise,started,exercise.get_total_time(),
+                      self.clock.time()-started
+                    )
+        finally:
+            phases.close()
+
+    def get_offset(self):
+        """
+        Return how many seconds into the routine the running routine is, or
+        None if it isn't running
+        """
+        position=self.position
+        if position==None:
+            return None
+        (i,start,started)=position
+        return start+self.clock.time()-started
+
+    def __get_pausable_clock(self):
+        if not isinstance(self.clock,clocks.PausableClock):
+            raise exceptions.ProtocolError(
+              "Only routines timed by a PausableClock can be paused or seeked"
+            )
+        return self.clock
+
+    def pause(self):
+        """
+        Pause the routine, part way through whatever it's doing
+
+        Throws: ProtocolError if the routine's clock isn't a PausableClock
+        """
+        self.__get_pausable_clock().pause()
+
+    def resume(self):
+        """Carry on after a pause"""
+        self.__get_pausable_clock().resume()
+
+    def is_paused(self):
+        return isinstance(self.clock,clocks.PausableClock) and \
+          self.clock.is_paused()
+
+    def seek(self,offset):
+        """
+        Jump the running routine to offset seconds in.  A paused routine
+        stays paused.
+
+        Throws: ProtocolError if the routine isn't running (use start(offset)
+          instead), or its clock isn't a PausableClock
+        """
+        clock=self.__get_pausable_clock()
+        if self.position==None:
+            raise exceptions.ProtocolError(
+              "Can't seek a routine that isn't running"
+            )
+        self.seek_to=offset
+        clock.interrupt()
+
+    def seek_exercise(self,index):
+        """
+        Jump the running routine to the start of the numbered exercise or
+        block
+        """
+        self.seek(self.get_starts()[index])
+
+class Outline(object):
+    """
+    Stands in for a Routine while RoutineFile reads a file, noting what it's
+    asked to do rather than doing it
+    """
+
+    def __init__(self):
+        self.name=None
+        self.desc=None
+        self.items=[]
+        self.blocks=[]
+
+    def set_name(self,name):
+        self.name=name
+
+    def set_description(self,desc):
+        self.desc=desc
+
+    def __add(self,item):
+        if self.blocks:
+            self.blocks[-1].add(item)
+        else:
+            self.items.append(item)
+
+    def add_exercise(self,ex_id,duration,rest,read_delay):
+        self.__add((ex_id,duration,rest,read_delay))
+
+    def begin_block(self,rounds):
+        block=Block(rounds)
+        self.__add(block)
+        self.blocks.append(block)
+
+    def set_round_override(self,round,setting,value):
+        if not self.blocks:
+            raise exceptions.ProtocolError(
+              "Round overrides can only be set within a block"
+            )
+        self.blocks[-1].set_override(round,setting,value)
+
+    def end_block(self):
+        if not self.blocks:
+            raise exceptions.ProtocolError("No block to end")
+        self.blocks.pop()
+
+    def get_plan(self):
+        return [plan_entry(item) for item in self.items]
+
+    def get_total_time(self):
+        """The outlined routine's total time, as Routine.get_total_time()"""
+        return sum(item.get_total_time() if isinstance(item,Block) else
+          sum(effective(item,None)) for item in self.items)
+
 class RoutineFile(object):
     desc={
       'rest':'rest period',
@@ -127,6 +691,17 @@ class RoutineFile(object):
         with io.open(filename) as filehandle:
             return self.load_io_into(routine, filehandle)
 
+    def outline(self,file_io):
+        """
+        Read a routine specification from a file object without preparing
+        any exercises, returning (name, description, plan), where plan is as
+        Routine.get_plan() returns and Routine.update() takes.  The data will
+        be read using any pre-existing default settings.
+        """
+        outline=Outline()
+        self.load_io_into(outline,file_io)
+        return (outline.name,outline.desc,outline.get_plan())
+
     def load_io(self,file_io):
         """
         Load the provided file object into a new Routine object.
@@ -139,8 +714,21 @@ class RoutineFile(object):
         """
         Load a specification from a file object into a pre-prepared Routine
         object. The data will be loaded using any pre-existing default settings
+
+        Besides settings and exercises, a file may repeat a run of lines as a
+        block, with optional overrides for particular rounds:
+
+            repeat=10
+                kettle_swing,30
+                kettle_press_right,30
+                @10 rest=60
+            end
+
+        Blocks may be nested.  A round's overrides apply to every exercise
+        in it, including those in nested blocks.
         """
         in_setting=False
+        depth=0
         for line in file_io.readlines():
             # Eat the indent - not important to this file format
             line=line.strip()
@@ -163,6 +751,27 @@ class RoutineFile(object):
                     value+=' '
                 value+=line
                 continue
+            if line.lower()=='end':
+                if depth==0:
+                    raise exceptions.ParseError(
+                      "'end' without a block to end\n  Line:{0}".format(line)
+                    )
+                routine.end_block()
+                depth-=1
+                continue
+            if line.startswith('@'):
+                # Round override
+                if depth==0:
+                    raise exceptions.ParseError(
+                      "Round override outside a block\n  Line:{0}".format(line)
+                    )
+                try:
+                    self.__set_round_override(routine,line)
+                except exceptions.ParseError as e:
+                    raise exceptions.ParseError("{0}\n  Line:{1}".format(
+                      str(e),line
+                    ))
+                continue
             setline=self.__unescape(line,'=')
             if '\x0b' in setline:
                 if setline.endswith('\x0b'):
@@ -182,6 +791,12 @@ class RoutineFile(object):
                     (setting,value)=setline.split('\x0b')
                     setting=setting.lower().strip()
                     try:
+                        if setting=='repeat':
+                            routine.begin_block(self.__to_int(
+                              value.strip(),'number of rounds'
+                            ))
+                            depth+=1
+                            continue
                         self.__set_setting(setting,value,routine)
                     except exceptions.ParseError as e:
                         raise exceptions.ParseError("{0}\n  Line:{1}".format(
@@ -204,6 +819,10 @@ class RoutineFile(object):
                   "Unrecognised line in routine file: {0}".
                   format(line)
                 )
+        if depth>0:
+            raise exceptions.ParseError(
+              "{0} block(s) not ended by the end of the file".format(depth)
+            )
         return routine
 
     def clear_settings(self):
@@ -274,6 +893,20 @@ been set, you must supply an explicit one""".format(parms[i])
                 textout+=c
         return textout
 
+    def __set_round_override(self,routine,line):
+        """Apply a line of the form '@round setting=value'"""
+        (round,space,assignment)=line[1:].partition(' ')
+        (setting,equals,value)=assignment.partition('=')
+        if not equals:
+            raise exceptions.ParseError(
+              "Round overrides take the form '@round setting=value'"
+            )
+        setting=setting.lower().strip()
+        routine.set_round_override(
+          self.__to_int(round,'round number'),setting,
+          self.__to_int(value.strip(),self.desc.get(setting,setting))
+        )
+
     def __set_setting(self,setting,value,routine):
         if not setting in self.desc:
             raise exceptions.ParseError(
@@ -290,6 +923,7 @@ been set, you must supply an explicit one""".format(parms[i])
 # Test code
 
 import exercise
+from sounderinterface import QuietSounder
 
 class TestRoutine(unittest.TestCase):
     countstart=0
@@ -355,7 +989,7 @@ class TestRoutine(unittest.TestCase):
 
     def test_start(self):
         class DummyExercise(exercise.Exercise):
-            def start(self):
+            def start(self,offset=0):
                 TestRoutine.countstart+=1
         class GuideMock(guide.Guide):
             def get_exercise(self,*args):
@@ -376,6 +1010,257 @@ class TestRoutine(unittest.TestCase):
         r.start()
         self.assertEquals(TestRoutine.countstart,3)
 
+    def test_profiler(self):
+        r=Routine(clock=clocks.VirtualClock())
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        p=profiling.Profiler()
+        r.set_profiler(p)
+        p.start()
+        r.add_exercise("exercise1",1,0,0)
+        r.add_exercise("exercise1",2,0,0)
+        r.exercises[0].sounder=r.exercises[1].sounder=QuietSounder()
+        r.start()
+        p.stop()
+        self.assertEqual([name for (name,calls,s) in p.get_sections()],
+          ["prep","exercise 1: Test Exercise 1","exercise 2: Test Exercise 1"]
+        )
+        self.assertEqual(p.get_sections()[0][1],2)
+
+    def test_offset(self):
+        clock=clocks.PausableClock(clocks.VirtualClock())
+        r=Routine(clock=clock)
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        for i in range(3):
+            r.add_exercise("exercise1",10,5,5)
+        self.assertEqual(r.get_starts(),[0,20,40])
+        self.assertEqual(r.locate(0),(0,0))
+        self.assertEqual(r.locate(25.5),(1,5.5))
+        self.assertEqual(r.locate(60),(3,0))
+        offsets=[]
+        for ex in r.exercises:
+            ex.sounder=QuietSounder()
+            ex.sounder.play=lambda sound: sound.endswith('boop.ogg') and \
+              offsets.append(r.get_offset())
+        ran=[]
+        r.add_listener(lambda ex,started,planned,actual:
+          ran.append((started,planned,actual))
+        )
+        r.start(23)
+        # Boops starting and finishing the last two exercises' work
+        self.assertEqual(offsets,[25,35,45,55])
+        self.assertEqual(clock.time(),60-23)
+        self.assertEqual(r.get_offset(),None)
+        # The first as if started 3s before the routine was
+        self.assertEqual(ran,[(-3,20,20),(17,20,20)])
+
+    def test_pause_seek(self):
+        clock=clocks.PausableClock(clocks.VirtualClock())
+        r=Routine(clock=clock)
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        for i in range(4):
+            r.add_exercise("exercise1",10,5,5)
+        self.assertRaises(exceptions.ProtocolError,r.seek,10)
+        boops=[]
+        def play(sound):
+            if not sound.endswith('boop.ogg'):
+                return
+            offset=r.get_offset()
+            boops.append(offset)
+            if offset==5:
+                # Pausing mid-routine stops time until resumed
+                r.pause()
+                self.assertTrue(r.is_paused())
+                clock.clock.sleep(30)
+                self.assertEqual(r.get_offset(),5)
+                r.resume()
+                r.seek(50)
+            elif offset==55 and len(boops)==3:
+                r.seek_exercise(1)
+        for ex in r.exercises:
+            ex.sounder=QuietSounder()
+            ex.sounder.play=play
+        r.start()
+        self.assertEqual(boops,[5,50,55,25,35,45,55,65,75])
+        self.assertEqual(clock.time(),5+5+60)
+        r=Routine(clock=clocks.VirtualClock())
+        self.assertRaises(exceptions.ProtocolError,r.pause)
+        self.assertFalse(r.is_paused())
+
+    def test_update(self):
+        clock=clocks.PausableClock(clocks.VirtualClock())
+        r=Routine(clock=clock)
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        r.get_guidebook().add_guide(TestRoutine.simple_guide2())
+        (name,desc,plan)=RoutineFile().outline(io.StringIO("""
+            name=Outlined
+            exercise1,10,5,5
+            exercise2,10,5,5
+            exercise1,10,5,5
+        """))
+        self.assertEqual(name,"Outlined")
+        self.assertEqual(plan,[("exercise1",10,5,5),("exercise2",10,5,5),
+          ("exercise1",10,5,5)])
+        self.assertEqual(r.update(plan),3)
+        originals=list(r.exercises)
+        sounder=originals[1].sounder=QuietSounder()
+        self.assertEqual(r.update(plan),0)
+        self.assertEqual(r.update(plan,["exercise2"]),1)
+        self.assertIs(r.exercises[0],originals[0])
+        self.assertIsNot(r.exercises[1],originals[1])
+        # The new exercise has a sounder of its own, of the same kind, which
+        # the old one can't stop when it's collected
+        self.assertIsNot(r.exercises[1].sounder,sounder)
+        self.assertIs(type(r.exercises[1].sounder),QuietSounder)
+        self.assertIs(originals[1].sounder,sounder)
+        self.assertRaises(KeyError,r.update,[("missing",1,2,3)])
+        self.assertEqual(len(r.exercises),3)
+
+        # While running, only the exercises still to come are touched
+        names=[]
+        def play(sound):
+            if sound.endswith('boop.ogg') and r.get_offset()==5:
+                running=r.exercises[0]
+                self.assertEqual(r.update([("exercise2",10,5,5),
+                  ("exercise1",20,5,5)]),1)
+                self.assertIs(r.exercises[0],running)
+                r.exercises[1].sounder.play=play
+        for ex in r.exercises:
+            ex.sounder=QuietSounder()
+            ex.sounder.play=play
+        r.start()
+        self.assertEqual([ex.duration for ex in r.exercises],[10,20])
+        self.assertEqual(clock.time(),20+30)
+
+    def test_update_lookahead(self):
+        # Exercises a lookahead already got ready still sound in full, after
+        # update() has replaced them
+        cues=[]
+        class CountingSounder(QuietSounder):
+            def play(self,sound):
+                cues.append(sound)
+        clock=clocks.PausableClock(clocks.VirtualClock())
+        r=Routine(clock=clock)
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        plan=[("exercise1",3,1,1)]*3
+        r.update(plan)
+        for ex in r.exercises:
+            ex.sounder=CountingSounder()
+        updated=[]
+        def listener(exercise,started,planned,actual):
+            if not updated:
+                updated.append(r.update(plan,["exercise1"]))
+        r.add_listener(listener)
+        r.set_lookahead(2)
+        r.start()
+        self.assertEqual(updated,[2])
+        # Two boops and two beeps each
+        self.assertEqual(len(cues),12)
+        self.assertTrue(all(type(ex.sounder) is CountingSounder
+          for ex in r.exercises))
+
+    def test_blocks(self):
+        clock=clocks.PausableClock(clocks.VirtualClock())
+        r=Routine(clock=clock)
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        r.get_guidebook().add_guide(TestRoutine.simple_guide2())
+        RoutineFile().load_io_into(r,io.StringIO("""
+            exercise1,1,1,1
+            repeat=3
+                exercise1,2,1,1
+                repeat=2
+                    exercise2,3,1,1
+                    @2 duration=4
+                end
+                @3 rest=5
+            end
+        """))
+        self.assertEqual(len(r.exercises),2)
+        self.assertEqual(len(r.get_exercises()),3)
+        phases=[(start,ex.name[-1],ex.duration,ex.rest)
+          for (start,ex) in r.phases()]
+        self.assertEqual(phases,[(0,'1',1,1,),
+          (3,'1',2,1),(7,'2',3,1),(12,'2',4,1),
+          (18,'1',2,1),(22,'2',3,1),(27,'2',4,1),
+          (33,'1',2,5),(41,'2',3,5),(50,'2',4,5)
+        ])
+        self.assertEqual(r.get_total_time(),60)
+        outline=Outline()
+        RoutineFile().load_io_into(outline,io.StringIO("""
+            exercise1,1,1,1
+            repeat=3
+                exercise1,2,1,1
+                @3 rest=5
+            end
+        """))
+        self.assertEqual(outline.get_total_time(),3+3*4+4)
+        # Starting part way through skips straight to the right round
+        self.assertEqual([start for (start,ex) in r.phases(30)],[27,33,41,50])
+        self.assertEqual(r.get_plan(),[("exercise1",1,1,1),
+          BlockPlan(3,((3,(("rest",5),)),),(("exercise1",2,1,1),
+            BlockPlan(2,((2,(("duration",4),)),),(("exercise2",3,1,1),))
+          ))
+        ])
+        self.assertEqual(r.update(r.get_plan()),0)
+        self.assertEqual(r.update(r.get_plan(),["exercise2"]),2)
+
+        boops=[]
+        for ex in r.get_exercises():
+            ex.sounder=QuietSounder()
+            ex.sounder.play=lambda sound: sound.endswith('boop.ogg') and \
+              boops.append(r.get_offset())
+        r.start(20)
+        # Resuming part way through the work of the exercise from 18s in
+        self.assertEqual(boops[:3],[20,21,23])
+        self.assertEqual(len(boops),2+2*5)
+        self.assertEqual(clock.time(),60-20)
+
+        # Overridden rounds run their own copies of the exercises
+        template=r.exercises[1].items[0]
+        variants=[ex for (start,ex) in r.phases() if ex.name[-1]=='1'][1:]
+        self.assertIs(variants[0],template)
+        self.assertIsNot(variants[2],template)
+        self.assertEqual(template.rest,1)
+        self.assertIs(variants[2].sounder,template.sounder)
+        r.set_clock(clocks.VirtualClock())
+        self.assertIs([ex for (start,ex) in r.phases(33)][0].clock,r.clock)
+        # ...which can be got ready in the background as each runs
+        boops.clear()
+        r.set_clock(clock)
+        r.set_lookahead(2)
+        r.start()
+        self.assertEqual(len(boops),20)
+
+    def test_block_errors(self):
+        r=Routine()
+        r.get_guidebook().add_guide(TestRoutine.simple_guide())
+        for text in ("end","@1 rest=3","repeat=0","repeat=two",
+          "repeat=2\nexercise1,1,1,1","repeat=2\n@3 rest=1\nend",
+          "repeat=2\n@1 name=1\nend","repeat=2\n@1 rest\nend",
+          "repeat=2\n@1 rest=-1\nend"):
+            self.assertRaises(exceptions.ParseError,
+              RoutineFile().load_io_into,r,io.StringIO(text)
+            )
+        r=Routine()
+        self.assertRaises(exceptions.ProtocolError,r.end_block)
+        self.assertRaises(exceptions.ProtocolError,r.set_round_override,
+          1,'rest',1
+        )
+
+    def test_circuit(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        rf=RoutineFile()
+        rf.add_guide(g)
+        r=rf.load_file("data/routines/circuit1")
+        # Ten rounds of six exercises from six Exercises, plus one more
+        self.assertEqual(len(r.get_exercises()),7)
+        self.assertEqual(len(list(r.phases())),61)
+        self.assertEqual(r.get_total_time(),
+          sum(ex.get_total_time() for (start,ex) in r.phases())
+        )
+        # The first and last rounds' longer rest applies to every exercise
+        self.assertEqual(r.get_total_time(),8*(6*45-10)+2*6*65+35)
+
     def simple_guide():
         stream=io.StringIO("""\
 exercise1:
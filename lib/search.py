@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+"""
+Full-text search over the exercises in a GuideBook.
+
+An Index maps each word of every exercise's name, description and tips to
+the exercises using it, weighting words in the name above the rest:
+
+    index=search.Index()
+    index.watch(routinefile.guidebook)
+    index.search("kettle press")    # [(ex_id, score), ...], best first
+
+Every word of a query must match, either exactly or, for the word being
+typed (the last, unless the query ends in a space), as the start of a
+longer word.  Results are ranked by how rare the matched words are across
+the index, and how prominently each exercise uses them.  Watching a
+GuideBook indexes each guide as it's added, with later guides' definitions
+taking the place of earlier ones, as GuideBook.get_exercise does; should
+the later guide drop one, the earlier definition is indexed again.
+"""
+
+import re, math, bisect, heapq, collections, unittest
+import guide
+
+WORD=re.compile(r"[a-z0-9]+")
+# How much a word counts in each field
+WEIGHTS=(('name', 3), ('desc', 1), ('tips', 1))
+
+def tokenise(text):
+    """Return the lower-case words in a piece of text"""
+    return WORD.findall(text.lower()) if text else []
+
+class Index(object):
+    def __init__(self):
+        self.postings=collections.defaultdict(dict)   # word -> {ex_id: weight}
+        self.words=[]           # Every indexed word, sorted
+        self.docs={}            # ex_id -> the words it's indexed under
+        self.owners={}          # ex_id -> the guide it was indexed from
+        self.guides=[]          # Every guide indexed, in the order added
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, ex_id, name, desc=None, tips=None, owner=None):
+        """Index an exercise, replacing any earlier entry for the same id"""
+        self.remove(ex_id)
+        if isinstance(tips, str):
+            # A single tip, as a guide keeps one
+            tips=[tips]
+        fields={'name':name, 'desc':desc,
+          'tips':" ".join(tips) if tips else None}
+        weights=collections.Counter()
+        for (field, weight) in WEIGHTS:
+            counts=collections.Counter(tokenise(fields[field]))
+            if weight==1:
+                weights.update(counts)
+            else:
+                for (word, count) in counts.items():
+                    weights[word]+=count*weight
+        postings=self.postings
+        for (word, weight) in weights.items():
+            if word not in postings:
+                bisect.insort(self.words, word)
+            postings[word][ex_id]=weight
+        self.docs[ex_id]=tuple(weights)
+        self.owners[ex_id]=owner
+
+    def remove(self, ex_id):
+        for word in self.docs.pop(ex_id, ()):
+            posting=self.postings[word]
+            del posting[ex_id]
+            if not posting:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+        self.owners.pop(ex_id, None)
+
+    def add_guide(self, g):
+        """Index every exercise in a guide"""
+        if not any(other is g for other in self.guides):
+            self.guides.append(g)
+        for (ex_id, name, desc, tips, tags) in g.get_entries():
+            self.add(ex_id, name, desc, tips, g)
+
+    def update_guide(self, g, ex_ids):
+        """
+        Re-index the given exercises of a guide, as Guide.reload() returns
+        them: each from the last guide defining it, which may now be an
+        earlier one, or not at all if none do
+        """
+        for ex_id in ex_ids:
+            found=guide.find_entry(self.guides, g, ex_id)
+            if found:
+                (owner, (name, desc, tips, tags))=found
+                self.add(ex_id, name, desc, tips, owner)
+            else:
+                self.remove(ex_id)
+
+    def watch(self, guidebook):
+        """Index a GuideBook's guides, and any added to it from now on"""
+        for g in guidebook.get_guides():
+            self.add_guide(g)
+        guidebook.add_listener(self.add_guide)
+
+    def __matches(self, word, prefix):
+        # {ex_id: weight} for an exact word, or for the best of every word
+        # starting with it
+        if not prefix:
+            return self.postings.get(word, {})
+        start=bisect.bisect_left(self.words, word)
+        end=bisect.bisect_left(self.words, word+"\uffff", start)
+        if end-start==1:
+            return self.postings[self.words[start]]
+        matches={}
+        for i in range(start, end):
+            for (ex_id, weight) in self.postings[self.words[i]].items():
+                if weight>matches.get(ex_id, 0):
+                    matches[ex_id]=weight
+        return matches
+
+    def search(self, query, limit=10):
+        """
+        Return up to limit (ex_id, score) pairs for the exercises matching
+        every word in the query, best first
+        """
+        words=tokenise(query)
+        if not words:
+            return []
+        typing=not query[-1].isspace()
+        matches=[self.__matches(word, typing and i==len(words)-1)
+          for (i, word) in enumerate(words)]
+        if not all(matches):
+            return []
+        total=len(self.docs)
+        idfs=[math.log(1+total/len(m)) for m in matches]
+        # Score only what the rarest word matched
+        order=sorted(range(len(matches)), key=lambda i: len(matches[i]))
+        (rarest, rest)=(order[0], order[1:])
+        scores=[]
+        for (ex_id, weight) in matches[rarest].items():
+            score=idfs[rarest]*math.sqrt(weight)
+            for i in rest:
+                other=matches[i].get(ex_id)
+                if other==None:
+                    break
+                score+=idfs[i]*math.sqrt(other)
+            else:
+                scores.append((score, ex_id))
+        return [(ex_id, score) for (score, ex_id)
+          in heapq.nlargest(limit, scores, key=lambda s: (s[0], s[1]))]
+
+#####################################################################
+# Test code
+
+import io, time, guide, corpus
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.g=guide.Guide()
+        self.g.load_file("data/exercises/kettlebell.yaml")
+
+    def test_tokenise(self):
+        self.assertEqual(tokenise("Don't over-extend, 2 times!"),
+          ['don', 't', 'over', 'extend', '2', 'times']
+        )
+        self.assertEqual(tokenise(None), [])
+
+    def test_guide(self):
+        index=Index()
+        index.add_guide(self.g)
+        self.assertEqual(len(index), len(self.g.get_exercise_ids()))
+        results=[ex_id for (ex_id, score) in index.search("press")]
+        self.assertIn('kettle_press_right', results)
+        self.assertIn('kettle_press_left', results)
+        # Words in the name count for more
+        ranked=index.search("kettlebell clean")
+        self.assertEqual(set(ex_id for (ex_id, score) in ranked[:2]),
+          set(['kettle_clean_right', 'kettle_clean_left'])
+        )
+        # As typed: prefixes of the last word, but not of finished ones
+        self.assertEqual(index.search("kettlebell pres"), index.search(
+          "kettlebell press"
+        ))
+        self.assertEqual(index.search("kettlebell pres "), [])
+        self.assertEqual(index.search("zzz"), [])
+        self.assertEqual(index.search(""), [])
+
+    def test_guidebook(self):
+        book=guide.GuideBook()
+        index=Index()
+        index.watch(book)
+        self.assertEqual(index.search("press"), [])
+        book.add_guide(self.g)
+        self.assertNotEqual(index.search("press"), [])
+        # A later guide's definition replaces the earlier one
+        g2=guide.Guide()
+        g2.load_io(io.StringIO(
+          "kettle_press_right:\n  Name: Overhead thrust\n"
+        ))
+        try:
+            book.add_guide(g2)
+        except Warning:
+            pass
+        self.assertEqual(index.search("thrust"),
+          [('kettle_press_right', index.search("thrust")[0][1])]
+        )
+        self.assertNotIn('kettle_press_right',
+          [ex_id for (ex_id, score) in index.search("press", 100)]
+        )
+        # ...and is kept when the earlier guide is updated
+        index.update_guide(self.g, ['kettle_press_right'])
+        self.assertEqual(len(index.search("thrust")), 1)
+        index.update_guide(g2, ['kettle_press_right'])
+        g2.exercises.clear()
+        index.update_guide(g2, ['kettle_press_right'])
+        self.assertEqual(index.search("thrust"), [])
+        self.assertNotIn("thrust", index.words)
+        # ...and the earlier definition is back, as the book has it
+        self.assertEqual(book.get_exercise('kettle_press_right').name,
+          "Kettlebell right press"
+        )
+        self.assertIn('kettle_press_right',
+          [ex_id for (ex_id, score) in index.search("press", 100)]
+        )
+        self.assertIs(index.owners['kettle_press_right'], self.g)
+        # Gone altogether once no guide has it
+        del self.g.exercises['kettle_press_right']
+        index.update_guide(self.g, ['kettle_press_right'])
+        self.assertNotIn('kettle_press_right', index.docs)
+        # A single tip is indexed as a whole
+        index.add('single', "Single", tips="Knees out")
+        self.assertEqual([ex_id for (ex_id, score) in index.search("knees")],
+          ['single']
+        )
+
+    def test_other_guides(self):
+        # Guides that don't keep their exercises in a dict of their own
+        import dbguide
+        db=dbguide.DBGuide(":memory:")
+        db.import_io(io.StringIO("squat:\n  Name: Goblet squat\n"
+          "  Tips: Knees out\n"))
+        book=guide.GuideBook()
+        index=Index()
+        index.watch(book)
+        book.add_guide(db)
+        self.assertEqual([ex_id for (ex_id, score) in index.search("knees")],
+          ['squat']
+        )
+        self.assertIs(index.owners['squat'], db)
+
+    def test_scale(self):
+        index=Index()
+        ids=corpus.exercise_ids(100000)
+        rng=corpus.random.Random(45)
+        for (i, ex_id) in enumerate(ids):
+            index.add(ex_id, "Synthetic exercise {0} ({1})".format(i//2,
+              ex_id.rsplit('_', 1)[1]), corpus.sentence(rng, 6)
+            )
+        started=time.perf_counter()
+        for query in ("exercise 4242", "exercise 424", "synthetic 49999",
+          "exercise 12 left"):
+            self.assertTrue(index.search(query))
+        self.assertLess(time.perf_counter()-started, 0.1)
+        self.assertEqual(index.search("exercise 4242 left")[0][0],
+          'synthetic_4242_left'
+        )
+
+if __name__=="__main__":
+    unittest.main()
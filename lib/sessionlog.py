@@ -0,0 +1,352 @@
+#!/usr/bin/python3
+"""
+An append-only binary log of what was actually performed.
+
+Each exercise run is one fixed-size record: who did it, which exercise,
+how long it was planned to take and actually took, and when it started.
+Athletes and exercises are interned, as indexes into a names file beside
+the log, so every record is 24 bytes however long their names are:
+
+    log=sessionlog.SessionLog("data/sessions.log")
+    r.add_listener(log.listener("alice"))
+    r.start()
+
+Writing a record is a single append, so a crash loses at most the record
+being written: a partial record at the end is ignored by the reader, and
+cut off when the log's next opened for writing.
+Once the log reaches max_bytes it's renamed aside, numbered, and a new one
+started.
+
+A SessionLogReader memory-maps each file of the log and reads its columns
+in place, as strided memoryviews, without unpacking record by record; the
+per-exercise and per-athlete totals are summed from those into lists indexed
+by name number, as library.py sums its columns.
+"""
+
+import os, sys, mmap, array, struct, collections, unittest
+import clocks
+
+class SessionLog(object):
+    # Athlete, exercise, planned ms, actual ms, start time
+    RECORD=struct.Struct('<IIIId')
+
+    def __init__(self, filename, max_bytes=64*1024*1024, sync=False):
+        """
+        Open the log, which needn't exist yet.  With sync set, each record
+        is flushed to disk as it's written.
+        """
+        self.filename=filename
+        self.max_bytes=max(max_bytes, self.RECORD.size)
+        self.sync=sync
+        self.fd=None
+        self.size=0
+        self.names=load_names(filename)
+        self.ids={name:i for (i, name) in enumerate(self.names)}
+        self.names_fd=None
+
+    def intern(self, name):
+        """
+        Return the number standing for an athlete or exercise name, adding
+        it to the names file if it's new
+
+        Throws: ValueError if the name contains a newline
+        """
+        i=self.ids.get(name)
+        if i==None:
+            if "\n" in name:
+                raise ValueError("Names must not contain newlines: "+
+                  repr(name)
+                )
+            if self.names_fd==None:
+                self.names_fd=os.open(self.filename+".names",
+                  os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644
+                )
+            os.write(self.names_fd, (name+"\n").encode())
+            i=len(self.names)
+            self.names.append(name)
+            self.ids[name]=i
+        return i
+
+    def __open(self):
+        self.fd=os.open(self.filename, os.O_WRONLY|os.O_APPEND|os.O_CREAT,
+          0o644
+        )
+        self.size=os.fstat(self.fd).st_size
+        # Cut off any record a crash left part written, so as to append
+        # whole records after whole records
+        torn=self.size%self.RECORD.size
+        if torn:
+            self.size-=torn
+            os.ftruncate(self.fd, self.size)
+
+    def rotate(self):
+        """Rename the current file aside, and start a new one"""
+        self.close_log()
+        if os.path.exists(self.filename):
+            os.rename(self.filename, "{0}.{1}".format(self.filename,
+              len(get_segments(self.filename))
+            ))
+
+    def record(self, athlete, exercise, planned, actual, start):
+        """
+        Append a record: planned and actual are in seconds, start is a
+        clock time
+        """
+        data=self.RECORD.pack(self.intern(athlete), self.intern(exercise),
+          int(round(planned*1000)), int(round(actual*1000)), start
+        )
+        if self.fd==None:
+            self.__open()
+        if self.size+len(data)>self.max_bytes:
+            self.rotate()
+            self.__open()
+        os.write(self.fd, data)
+        self.size+=len(data)
+        if self.sync:
+            getattr(os, 'fdatasync', os.fsync)(self.fd)
+
+    def listener(self, athlete, clock=None):
+        """
+        Return a function to pass to Routine.add_listener, logging each
+        exercise the routine runs against athlete.  Each record is stamped
+        with when its exercise started by clock (the wall clock by default),
+        worked out as when it finished less how long it took.  The routine's
+        own clock won't do: a PausableClock falls behind by every pause.
+        """
+        if clock==None:
+            clock=clocks.RealClock()
+        def log(exercise, started, planned, actual):
+            self.record(athlete, exercise.ex_id or exercise.name, planned,
+              actual, clock.time()-actual
+            )
+        return log
+
+    def close_log(self):
+        if self.fd!=None:
+            os.close(self.fd)
+            self.fd=None
+
+    def close(self):
+        self.close_log()
+        if self.names_fd!=None:
+            os.close(self.names_fd)
+            self.names_fd=None
+
+def load_names(filename):
+    """Read the interned names of the log at filename"""
+    try:
+        with open(filename+".names", 'rb') as f:
+            return [line.decode() for line in f.read().split(b"\n")[:-1]]
+    except FileNotFoundError:
+        return []
+
+def get_segments(filename):
+    """Return the files making up the log at filename, oldest first"""
+    segments=[]
+    while os.path.exists("{0}.{1}".format(filename, len(segments)+1)):
+        segments.append("{0}.{1}".format(filename, len(segments)+1))
+    if os.path.exists(filename):
+        segments.append(filename)
+    return segments
+
+Totals=collections.namedtuple('Totals', 'count planned actual')
+
+class SessionLogReader(object):
+    COLUMNS=('athlete', 'exercise', 'planned', 'actual', 'start')
+
+    def __init__(self, filename):
+        self.filename=filename
+        self.names=load_names(filename)
+
+    def get_name(self, i):
+        return self.names[i]
+
+    def columns(self):
+        """
+        Yield, for each file in the log, a dict of its columns by name (see
+        COLUMNS): athlete and exercise numbers (see get_name), planned and
+        actual milliseconds, and start times.  The columns are views of the
+        mapped file, only good until the next one's yielded.
+        """
+        size=SessionLog.RECORD.size
+        for segment in get_segments(self.filename):
+            with open(segment, 'rb') as f:
+                length=os.fstat(f.fileno()).st_size
+                # Ignore any partly written record at the end
+                length-=length%size
+                if length==0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    views=[memoryview(mm)]
+                    views.append(views[0][:length])
+                    views.append(views[1].cast('I'))
+                    views.append(views[1].cast('d'))
+                    ints=views[2]
+                    columns=[ints[0::6], ints[1::6], ints[2::6], ints[3::6],
+                      views[3][2::3]]
+                    views.extend(columns)
+                    if sys.byteorder!='little':
+                        columns=[array.array(c.format, c) for c in columns]
+                        for c in columns:
+                            c.byteswap()
+                    try:
+                        yield dict(zip(self.COLUMNS, columns))
+                    finally:
+                        for view in reversed(views):
+                            view.release()
+
+    def __len__(self):
+        return sum(len(c['start']) for c in self.columns())
+
+    def __totals(self, key):
+        counts=collections.Counter()
+        planned=[0]*len(self.names)
+        actual=[0]*len(self.names)
+        for c in self.columns():
+            keys=c[key]
+            counts.update(keys)
+            for (k, p, a) in zip(keys, c['planned'], c['actual']):
+                planned[k]+=p
+                actual[k]+=a
+        return {self.names[k]:Totals(n, planned[k]/1000, actual[k]/1000)
+          for (k, n) in counts.items()}
+
+    def get_exercise_totals(self):
+        """
+        Return {exercise: Totals(count, planned seconds, actual seconds)}
+        """
+        return self.__totals('exercise')
+
+    def get_athlete_totals(self):
+        """Return {athlete: Totals(count, planned seconds, actual seconds)}"""
+        return self.__totals('athlete')
+
+#####################################################################
+# Test code
+
+import random, tempfile, time, guide, routine, exercise
+from sounderinterface import QuietSounder
+
+class TestSessionLog(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.filename=os.path.join(self.dir.name, 'sessions.log')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_routine(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        r=rf.load_file("data/routines/upperbody2")
+        clock=clocks.VirtualClock(100)
+        r.set_clock(clock)
+        for ex in r.get_exercises():
+            ex.sounder=QuietSounder()
+        log=SessionLog(self.filename)
+        r.add_listener(log.listener("alice", clock))
+        r.start()
+        log.close()
+        self.assertEqual(os.path.getsize(self.filename), 7*24)
+        reader=SessionLogReader(self.filename)
+        self.assertEqual(len(reader), 7)
+        for c in reader.columns():
+            self.assertEqual(list(c['start'][:2]), [100, 100+75])
+            self.assertEqual(reader.get_name(c['exercise'][0]),
+              r.exercises[0].ex_id
+            )
+        # The columns can't be used once the files are unmapped
+        self.assertRaises(ValueError, len, c['start'])
+        self.assertEqual(reader.get_athlete_totals(),
+          {"alice":Totals(7, r.get_total_time(), r.get_total_time())}
+        )
+
+    def test_paused(self):
+        # Time the routine doesn't count while it's paused still passes on
+        # the clock the log's stamped by
+        wall=clocks.VirtualClock(1000)
+        clock=clocks.PausableClock(wall)
+        log=SessionLog(self.filename)
+        listener=log.listener("dave", wall)
+        for (pause, duration) in ((0, 30), (50, 20)):
+            clock.pause()
+            wall.sleep(pause)
+            clock.resume()
+            started=clock.time()
+            wall.sleep(duration)
+            listener(exercise.Exercise("Squat"), started, duration,
+              clock.time()-started
+            )
+        log.close()
+        for c in SessionLogReader(self.filename).columns():
+            self.assertEqual(list(c['start']), [1000, 1080])
+
+    def test_rotation(self):
+        log=SessionLog(self.filename, max_bytes=24*10)
+        for i in range(25):
+            log.record("bob", "ex{0}".format(i%3), 10, 10.5, i)
+        log.close()
+        self.assertEqual(get_segments(self.filename), [self.filename+".1",
+          self.filename+".2", self.filename])
+        # Reopened, it carries on where it left off
+        log=SessionLog(self.filename, max_bytes=24*10)
+        log.record("carol", "ex0", 1, 1, 25)
+        log.close()
+        # A crash part way through writing a record
+        with open(self.filename, 'ab') as f:
+            f.write(b"\0"*10)
+        reader=SessionLogReader(self.filename)
+        self.assertEqual([t for c in reader.columns() for t in c['start']],
+          list(range(26))
+        )
+        self.assertEqual(reader.get_exercise_totals()["ex1"],
+          Totals(8, 80, 84)
+        )
+        # ...is cut off by the next writer, which carries on in step
+        log=SessionLog(self.filename, max_bytes=24*10)
+        log.record("carol", "ex1", 2, 2, 26)
+        log.record("carol", "ex2", 2, 2, 27)
+        log.close()
+        self.assertEqual(os.path.getsize(self.filename), 24*8)
+        self.assertEqual([t for c in reader.columns() for t in c['start']],
+          list(range(28))
+        )
+        self.assertEqual(reader.get_exercise_totals()["ex1"],
+          Totals(9, 82, 86)
+        )
+        self.assertEqual(reader.get_athlete_totals()["carol"],
+          Totals(3, 5, 5)
+        )
+        self.assertRaises(ValueError, log.intern, "two\nlines")
+
+    def test_totals(self):
+        rand=random.Random(43)
+        log=SessionLog(self.filename, max_bytes=24*100000)
+        expected=collections.defaultdict(lambda: [0, 0, 0])
+        for i in range(250000):
+            (athlete, exercise)=(rand.randrange(50), rand.randrange(200))
+            planned=rand.randrange(10, 120)
+            actual=planned+rand.randrange(-1000, 5000)/1000
+            log.record(str(athlete), "ex{0}".format(exercise), planned,
+              actual, i
+            )
+            totals=expected["ex{0}".format(exercise)]
+            totals[0]+=1
+            totals[1]+=planned*1000
+            totals[2]+=int(round(actual*1000))
+        log.close()
+        self.assertEqual(len(get_segments(self.filename)), 3)
+        reader=SessionLogReader(self.filename)
+        started=time.perf_counter()
+        totals=reader.get_exercise_totals()
+        self.assertLess(time.perf_counter()-started, 0.5)
+        self.assertEqual(totals, {name:Totals(n, p/1000, a/1000)
+          for (name, (n, p, a)) in expected.items()})
+        self.assertEqual(sum(t.count for t in
+          reader.get_athlete_totals().values()), 250000
+        )
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,345 @@
+#!/usr/bin/python3
+"""
+An exercise library serialised once into shared memory (or a memory-mapped
+file), so that many worker processes can share one physical copy of the
+exercise definitions instead of each parsing its own.
+
+Layout of the block (all integers little-endian, unsigned 32 bit):
+
+    header      magic 'ITSL', number of exercises
+    index       one entry per exercise, sorted by id: id offset, id length,
+                  record offset, record length
+    data        the utf-8 ids, and each exercise's record as utf-8 JSON of
+                  [name, description, tips, tags]
+"""
+
+import io, os, json, mmap, struct, inspect, unittest
+from multiprocessing import shared_memory
+import guide, exercise, exceptions
+
+# Whether attaching can leave the segment to its creator's resource tracker
+TRACK_OPTION='track' in inspect.signature(shared_memory.SharedMemory).parameters
+
+class SharedLibrary(object):
+    MAGIC=b'ITSL'
+    HEADER=struct.Struct('<4sI')
+    ENTRY=struct.Struct('<IIII')
+
+    def __init__(self, buf, name, owner=None):
+        """
+        Wrap an already serialised block; use one of the create/attach/
+        open_file functions rather than calling this directly.
+        """
+        (magic, self.count)=self.HEADER.unpack_from(buf, 0)
+        if magic!=self.MAGIC:
+            raise exceptions.ParseError(
+              "{0} is not a shared exercise library".format(repr(name))
+            )
+        self.buf=buf
+        self.name=name
+        self.owner=owner
+
+    @staticmethod
+    def serialise(guides):
+        """
+        Serialise the exercises from a GuideBook, or a list of Guides, into
+        bytes.  As with GuideBook, where an exercise is defined by more than
+        one guide the last one added takes precedence.
+        """
+        if hasattr(guides, 'get_guides'):
+            guides=guides.get_guides()
+        entries={}
+        for g in guides:
+            for (ex_id, name, desc, tips, tags) in g.get_entries():
+                entries[ex_id]=(name, desc, tips, tags)
+        ids=sorted(entries)
+        H=SharedLibrary.HEADER
+        E=SharedLibrary.ENTRY
+        index=bytearray(H.pack(SharedLibrary.MAGIC, len(ids)))
+        data=bytearray()
+        base=H.size+E.size*len(ids)
+        for ex_id in ids:
+            id_bytes=ex_id.encode('utf-8')
+            record=json.dumps(list(entries[ex_id])).encode('utf-8')
+            id_offset=base+len(data)
+            data+=id_bytes
+            index+=E.pack(id_offset, len(id_bytes),
+              id_offset+len(id_bytes), len(record)
+            )
+            data+=record
+        return bytes(index+data)
+
+    @staticmethod
+    def create(guides, name=None):
+        """
+        Serialise guides into a new shared memory segment.  This process owns
+        the segment; call close() to release it when no longer needed.
+        """
+        data=SharedLibrary.serialise(guides)
+        shm=shared_memory.SharedMemory(name=name, create=True, size=len(data))
+        shm.buf[:len(data)]=data
+        return SharedLibrary(shm.buf, shm.name, shm)
+
+    @staticmethod
+    def attach(name):
+        """
+        Attach to a segment created by another process, without parsing
+        anything.
+
+        Throws:
+            FileNotFoundError   if no such segment exists
+        """
+        if TRACK_OPTION:
+            # Only the creator should unlink the segment
+            shm=shared_memory.SharedMemory(name=name, track=False)
+        else:
+            # Left registered: a worker forked from the creator shares its
+            # resource tracker, and unregistering here would take the
+            # creator's registration with it.  (A process with a tracker of
+            # its own may see it unlink the segment when it exits; Python
+            # 3.13's track=False is what avoids that.)
+            shm=shared_memory.SharedMemory(name=name)
+        library=SharedLibrary(shm.buf, name)
+        library.shm=shm
+        return library
+
+    @staticmethod
+    def write_file(guides, filename):
+        """Serialise guides to a file, to be memory-mapped with open_file"""
+        with io.open(filename, 'wb') as f:
+            f.write(SharedLibrary.serialise(guides))
+
+    @staticmethod
+    def open_file(filename):
+        """Memory-map a library written by write_file"""
+        with io.open(filename, 'rb') as f:
+            mapped=mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        library=SharedLibrary(memoryview(mapped), filename)
+        library.mapped=mapped
+        return library
+
+    def close(self):
+        """
+        Release this process' view of the library, and if it created the
+        shared memory segment, remove the segment too.
+        """
+        self.buf.release()
+        if self.owner:
+            self.owner.close()
+            self.owner.unlink()
+        elif hasattr(self, 'shm'):
+            self.shm.close()
+        elif hasattr(self, 'mapped'):
+            self.mapped.close()
+
+    def __entry(self, i):
+        return self.ENTRY.unpack_from(
+          self.buf, self.HEADER.size+i*self.ENTRY.size
+        )
+
+    def __id(self, entry):
+        return bytes(self.buf[entry[0]:entry[0]+entry[1]])
+
+    def find(self, ex_id):
+        """
+        Return the index entry for ex_id, found by binary search over the
+        sorted index, or None if the library doesn't have it
+        """
+        key=ex_id.encode('utf-8')
+        (lo, hi)=(0, self.count)
+        while lo<hi:
+            mid=(lo+hi)//2
+            entry=self.__entry(mid)
+            mid_id=self.__id(entry)
+            if mid_id<key:
+                lo=mid+1
+            elif mid_id>key:
+                hi=mid
+            else:
+                return entry
+        return None
+
+    def get_ids(self):
+        return [self.__id(self.__entry(i)).decode('utf-8')
+          for i in range(self.count)]
+
+    def get_record(self, ex_id):
+        """
+        Return [name, desc, tips, tags] for ex_id
+
+        Throws:
+            KeyError if the library doesn't have the exercise
+        """
+        entry=self.find(ex_id)
+        if entry==None:
+            raise KeyError(ex_id)
+        record=bytes(self.buf[entry[2]:entry[2]+entry[3]])
+        return json.loads(record.decode('utf-8'))
+
+    def get_guide(self):
+        return SharedGuide(self)
+
+    def get_guidebook(self):
+        """Return a GuideBook containing a read-only view of this library"""
+        book=guide.GuideBook()
+        book.add_guide(self.get_guide())
+        return book
+
+class SharedGuide(guide.Guide):
+    """A read-only Guide reading its exercises from a SharedLibrary"""
+
+    def __init__(self, library):
+        self.library=library
+        self.filename="shared:"+library.name
+        self.ids=None
+
+    def load_io(self, iostream):
+        raise exceptions.ProtocolError("Shared guides are read-only")
+
+    def share_strings(self, strings):
+        # Its text is all in the shared memory already
+        pass
+
+    def get_exercise_ids(self):
+        if self.ids==None:
+            self.ids=frozenset(self.library.get_ids())
+        return set(self.ids)
+
+    def get_entry(self, exercise_id):
+        (name, desc, tips, tags)=self.library.get_record(exercise_id)
+        return (name, desc, tips,
+          {attribute:tuple(values) for (attribute, values) in tags.items()})
+
+    def get_tags(self, exercise_id):
+        try:
+            return self.get_entry(exercise_id)[3]
+        except KeyError:
+            return {}
+
+    def get_exercise(self, exercise_id):
+        (name, desc, tips, tags)=self.library.get_record(exercise_id)
+        ex=exercise.Exercise(name, desc, tips)
+        ex.ex_id=exercise_id
+        return ex
+
+    def __contains__(self, ex):
+        if hasattr(ex, 'get_exercise_ids'):
+            return super().__contains__(ex)
+        return self.library.find(str(ex))!=None
+
+#####################################################################
+# Test code
+
+import multiprocessing, tempfile
+
+def attached_name(name, ex_id, queue):
+    library=SharedLibrary.attach(name)
+    queue.put(library.get_guidebook().get_exercise(ex_id).name)
+    library.close()
+
+class TestSharedLibrary(unittest.TestCase):
+    def setUp(self):
+        self.g=guide.Guide()
+        self.g.load_io(io.StringIO("""\
+exercise1:
+    Name: Test Exercise 1
+    Description: Test description 1
+    Tips: &tips [Tip one, Tip two]
+    Tags: {muscles: arms}
+exercise2:
+    Name: Test Exercise 2
+    Description: Test description 2
+    Tips: *tips
+"""))
+        self.g2=guide.Guide()
+        self.g2.load_io(io.StringIO("""\
+exercise2:
+    Name: Test Exercise 2 override
+éxercise3:
+    Name: Non-ascii id
+"""))
+
+    def test_serialise(self):
+        library=SharedLibrary(
+          SharedLibrary.serialise([self.g, self.g2]), "test"
+        )
+        self.assertEqual(library.get_ids(),
+          ['exercise1', 'exercise2', 'éxercise3']
+        )
+        self.assertEqual(library.get_record('exercise1'),
+          ['Test Exercise 1', 'Test description 1', ['Tip one', 'Tip two'],
+            {'muscles':['arms']}]
+        )
+        self.assertEqual(library.get_record('exercise2')[0],
+          'Test Exercise 2 override'
+        )
+        self.assertRaises(KeyError, library.get_record, 'exercise4')
+        self.assertRaises(exceptions.ParseError, SharedLibrary,
+          b'NOPE\0\0\0\0', "bad"
+        )
+
+    def test_guidebook(self):
+        book=guide.GuideBook()
+        book.add_guide(self.g)
+        library=SharedLibrary.create(book)
+        try:
+            shared=library.get_guidebook()
+            e=shared.get_exercise('exercise2')
+            self.assertEqual(e.name, 'Test Exercise 2')
+            self.assertEqual(e.ex_id, 'exercise2')
+            self.assertEqual(e.tips, ['Tip one', 'Tip two'])
+            self.assertRaisesRegex(KeyError, "not found",
+              shared.get_exercise, 'exercise3'
+            )
+            sg=library.get_guide()
+            self.assertIn('exercise1', sg)
+            self.assertNotIn('exercise3', sg)
+            self.assertEqual(sg.get_exercise_ids(), self.g.get_exercise_ids())
+            self.assertTrue(sg in self.g and self.g in sg)
+            self.assertEqual(sg.get_tags('exercise1'), {'muscles':('arms',)})
+            self.assertEqual(sg.get_tags('exercise3'), {})
+            self.assertEqual(list(sg.get_entries()), list(self.g.get_entries()))
+        finally:
+            library.close()
+
+    def test_other_process(self):
+        library=SharedLibrary.create([self.g, self.g2])
+        try:
+            queue=multiprocessing.Queue()
+            p=multiprocessing.Process(target=attached_name,
+              args=(library.name, 'exercise2', queue)
+            )
+            p.start()
+            self.assertEqual(queue.get(timeout=10), 'Test Exercise 2 override')
+            p.join()
+            # The worker detaching mustn't have removed the segment
+            attached=SharedLibrary.attach(library.name)
+            self.assertEqual(attached.get_record('exercise1')[0],
+              'Test Exercise 1'
+            )
+            attached.close()
+        finally:
+            library.close()
+
+    def test_other_guides(self):
+        import dbguide
+        db=dbguide.DBGuide(":memory:")
+        db.import_guide(self.g)
+        library=SharedLibrary(SharedLibrary.serialise([db]), "test")
+        self.assertEqual(list(library.get_guide().get_entries()),
+          list(self.g.get_entries())
+        )
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename=os.path.join(d, 'library')
+            SharedLibrary.write_file([self.g], filename)
+            library=SharedLibrary.open_file(filename)
+            self.assertEqual(
+              library.get_guide().get_exercise('exercise1').desc,
+              'Test description 1'
+            )
+            library.close()
+
+if __name__=="__main__":
+    unittest.main()
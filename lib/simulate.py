@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Headless simulation of routines: run them against a VirtualClock, with the
+same callbacks they'd get for real, and record when each cue would sound.
+"""
+
+import io, time, unittest
+import clocks, sounderinterface
+
+class RecordingSounder(sounderinterface.SounderInterface):
+    """A Sounder that plays nothing, but notes down when it was asked to"""
+
+    def __init__(self, clock, cues=None):
+        self.clock=clock
+        self.cues=cues if cues!=None else []
+
+    def play(self, soundfile):
+        self.cues.append((self.clock.time(), soundfile))
+
+    def stop(self):
+        pass
+
+def run(routine, clock):
+    """
+    Run a prepared routine against clock, recording its cues rather than
+    sounding them.
+
+    Returns (cues, started, finished): the cues as (clock time, soundfile)
+    tuples, and the clock times the routine started and finished.  The
+    routine gets its own clock and sounders back afterwards.
+    """
+    cues=[]
+    old_clock=routine.get_clock()
+    exercises=routine.get_exercises()
+    old_sounders=[exercise.sounder for exercise in exercises]
+    routine.set_clock(clock)
+    for exercise in exercises:
+        exercise.sounder=RecordingSounder(clock, cues)
+    try:
+        started=clock.time()
+        routine.start()
+        finished=clock.time()
+    finally:
+        routine.set_clock(old_clock)
+        for (exercise, old_sounder) in zip(exercises, old_sounders):
+            exercise.sounder=old_sounder
+    return (cues, started, finished)
+
+def simulate(routine, start=0):
+    """
+    Run a prepared routine instantly against a VirtualClock.
+
+    Returns the cue timeline: a list of (offset, soundfile) tuples, with
+    offsets in seconds from the start of the routine.  The routine gets its
+    own clock and sounders back afterwards.
+    """
+    (cues, started, finished)=run(routine, clocks.VirtualClock(start))
+    return [(t-started, sound) for (t, sound) in cues]
+
+def simulate_all(routines):
+    """Simulate each of a batch of routines, returning their cue timelines"""
+    return [simulate(routine) for routine in routines]
+
+#####################################################################
+# Test code
+
+import guide, routine
+
+class TestSimulate(unittest.TestCase):
+    def setUp(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        self.routinefile=routine.RoutineFile()
+        self.routinefile.add_guide(g)
+
+    def test_upperbody(self):
+        r=self.routinefile.load_file("data/routines/upperbody2")
+        clock=r.get_clock()
+        cues=simulate(r)
+        self.assertIs(r.get_clock(), clock)
+        self.assertNotIsInstance(r.exercises[0].sounder, RecordingSounder)
+        # Each exercise boops to start and finish, and beeps four times
+        self.assertEqual(len(cues), 6*len(r.exercises))
+        self.assertEqual(cues[:6], [
+          (5, 'sounds/boop.ogg'),
+          (61, 'sounds/beep.ogg'), (62, 'sounds/beep.ogg'),
+          (63, 'sounds/beep.ogg'), (64, 'sounds/beep.ogg'),
+          (65, 'sounds/boop.ogg')
+        ])
+        # The second exercise starts after the first's 10s rest
+        self.assertEqual(cues[6], (75+5, 'sounds/boop.ogg'))
+        self.assertEqual(cues[-1][0], r.get_total_time())
+        # Simulating again gives the same timeline
+        self.assertEqual(simulate(r), cues)
+
+    def test_long_batch(self):
+        rf=self.routinefile
+        rf.set_default('rest', '15')
+        rf.set_default('read_delay', '5')
+        hour=io.StringIO("kettle_swing,40\n"*60)
+        r=rf.load_io(hour)
+        self.assertEqual(r.get_total_time(), 3600)
+        started=time.time()
+        timelines=simulate_all([r]*5)
+        self.assertLess(time.time()-started, 5)
+        self.assertEqual(len(timelines), 5)
+        self.assertEqual(timelines[0], timelines[4])
+        self.assertEqual(timelines[0][-1], (3600-15, 'sounds/boop.ogg'))
+
+if __name__=="__main__":
+    unittest.main()
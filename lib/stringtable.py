@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+"""
+Share the text of exercise definitions between the guides holding them.
+
+Guides repeat themselves: left and right variants share a description and
+tips, and the same descriptions and tips turn up again across guide files.
+YAML anchors share text within one file, but every file parsed (and every
+reload of one) still makes its own copy of each string.  A StringTable keeps
+one copy of each distinct string, and hands that copy to every guide asking
+for it:
+
+    strings=stringtable.StringTable()
+    desc=strings.intern(desc)
+    tips=strings.intern_tips(tips)
+
+Only descriptions and tips are interned.  Names are as good as unique to
+each exercise, so a table entry for each would cost more than it saved, and
+tips lists are kept as the lists the guide parsed (YAML anchors already
+share those between variants), with their tips swapped for the table's.
+
+Each GuideBook has a table of its own, which its guides move their text
+into as they're added, so the table goes when the book and its guides do.
+A guide on its own keeps its text as parsed.  The guides using a table are
+held weakly, and whenever the table has grown to twice what they held at the
+last count, the text none of them hold any more (from reloads, or guides
+since dropped) is let go.
+"""
+
+import sys, weakref, unittest
+
+class StringTable(object):
+    def __init__(self):
+        self.strings={}
+        # id(guide) -> guide; guides compare by content, so can't be hashed
+        self.guides=weakref.WeakValueDictionary()
+        # How big to let the table grow before collecting
+        self.limit=1024
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, text):
+        """Return the table's copy of text, adding it if it's new"""
+        if not isinstance(text, str):
+            return text
+        return self.strings.setdefault(text, text)
+
+    def intern_tips(self, tips):
+        """
+        Swap each of a list of tips for the table's copy, in place, and
+        return the list.  Anything other than a list is interned as intern()
+        would.
+        """
+        if not isinstance(tips, list):
+            return self.intern(tips)
+        for (i, tip) in enumerate(tips):
+            tips[i]=self.intern(tip)
+        return tips
+
+    def add_guide(self, g):
+        """
+        Keep the text of a guide's exercises when collecting, for as long as
+        the guide is in use
+        """
+        self.guides[id(g)]=g
+
+    def collect(self, force=False):
+        """
+        Drop whatever none of the guides using the table hold any more, if
+        the table has doubled in size since the last collection (or force)
+        """
+        if len(self)<=self.limit and not force:
+            return
+        self.strings={}
+        for g in list(self.guides.values()):
+            for (name, desc, tips) in list(getattr(g, 'exercises', {}
+              ).values()):
+                self.intern(desc)
+                self.intern_tips(tips)
+        self.limit=max(2*len(self), 1024)
+
+    def get_size(self):
+        """Return roughly how many bytes the interned text takes up"""
+        return sum(sys.getsizeof(s) for s in self.strings)
+
+#####################################################################
+# Test code
+
+import io, os, tempfile, guide, corpus, benchmark
+
+class TestStringTable(unittest.TestCase):
+    def test_intern(self):
+        strings=StringTable()
+        a="".join(["shared ", "text"])
+        b="".join(["shared ", "text"])
+        self.assertIsNot(a, b)
+        self.assertIs(strings.intern(a), a)
+        self.assertIs(strings.intern(b), a)
+        self.assertEqual(strings.intern(None), None)
+        self.assertEqual(strings.intern(3), 3)
+        tips=["one", b]
+        self.assertIs(strings.intern_tips(tips), tips)
+        self.assertEqual(tips, ["one", "shared text"])
+        self.assertIs(tips[1], a)
+        self.assertIs(strings.intern_tips(b), a)
+        self.assertEqual(len(strings), 2)
+
+    def test_guides(self):
+        strings=StringTable()
+        guides=[]
+        for prefix in ('first', 'second'):
+            g=guide.Guide(strings)
+            g.load_io(io.StringIO(corpus.guide_text(10, prefix=prefix)))
+            guides.append(g)
+        (first, second)=(guides[0].exercises, guides[1].exercises)
+        # The same text in different files, and left and right variants
+        self.assertIs(first['first_0_right'][1], second['second_0_left'][1])
+        self.assertIs(first['first_3_left'][2][0],
+          second['second_3_right'][2][0])
+        # Exercises get the guide's list of tips, as they always have
+        ex=guides[1].get_exercise('second_3_right')
+        self.assertIs(ex.tips, second['second_3_right'][2])
+        # Guides on their own keep their own text, until they're added to a
+        # book, when they share its table from then on
+        book=guide.GuideBook()
+        for prefix in ('third', 'fourth'):
+            g=guide.Guide()
+            g.load_io(io.StringIO(corpus.guide_text(10, prefix=prefix)))
+            self.assertEqual(g.strings, None)
+            book.add_guide(g)
+        (third, fourth)=(g.exercises for g in book.get_guides())
+        self.assertIs(third['third_0_right'][1], fourth['fourth_0_left'][1])
+        self.assertIs(third['third_3_left'][2][1],
+          fourth['fourth_3_right'][2][1])
+        self.assertIs(book.get_guides()[1].strings, book.strings)
+
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename=os.path.join(d, 'guide.yaml')
+            book=guide.GuideBook()
+            g=guide.Guide()
+            for i in range(30):
+                # Every edit brings all new text
+                with open(filename, 'w') as f:
+                    f.write(corpus.guide_text(200, seed=i))
+                if i==0:
+                    g.load_file(filename)
+                    book.add_guide(g)
+                    size=book.strings.get_size()
+                else:
+                    g.reload()
+                self.assertLess(book.strings.get_size(), size*4)
+            # Only what's in use is kept, once the table's collected
+            book.strings.collect(True)
+            self.assertLess(book.strings.get_size(), size*1.5)
+            # Including once a guide sharing it is gone
+            held=len(book.strings)
+            other=guide.Guide(book.strings)
+            other.load_io(io.StringIO(corpus.guide_text(200, seed=100)))
+            self.assertGreater(len(book.strings), held)
+            del other
+            book.strings.collect(True)
+            self.assertEqual(len(book.strings), held)
+
+    def test_memory(self):
+        # Five files repeating each other's descriptions and tips
+        text=[corpus.guide_text(200, prefix='guide{0}'.format(i))
+          for i in range(5)]
+        def load(book):
+            guides=[]
+            for t in text:
+                g=guide.Guide()
+                g.load_io(io.StringIO(t))
+                if book!=None:
+                    book.add_guide(g)
+                guides.append(g)
+            return (book, guides)
+        # What the guides keep, each with its own copy or sharing a book's
+        (kept, separate, sites)=benchmark.measure_memory(lambda: load(None))
+        del kept
+        (kept, shared, sites)=benchmark.measure_memory(
+          lambda: load(guide.GuideBook()))
+        self.assertLess(shared, separate*0.75)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+"""
+Make up a routine taking exactly a given time.
+
+Exercises are grouped into the units a routine runs them in: the right and
+left variants of an exercise as a pair, right then left, with the same
+timings, and everything else on its own.  Each exercise's time is its
+duration, its rest and the read delay, the durations and rests each chosen
+from a range in steps.  Which totals a routine can reach is worked out unit
+by unit, as a bitmap of the reachable seconds: the units so far can reach t
+seconds with one more if they could reach t less one of its possible times.
+Of the numbers of units that reach the target exactly, the one leaving
+their times nearest the middle of the range is used, and the times are
+then read back from the bitmaps, as evenly as they'll go:
+
+    plan=synth.synthesise(ex_ids, 30*60, durations=(30, 60), rests=(0, 15))
+    text=synth.routine_text(plan, "Half hour")
+
+The work grows with the target time and the number of units used, not with
+the number of exercises there are to choose from.
+"""
+
+import random, unittest
+
+SIDES=('_right', '_left')
+
+def group(ex_ids):
+    """
+    Return the units to run the exercises in, in the order given: a tuple
+    of (right, left) ids where both are there, and of the one id otherwise
+    """
+    ex_ids=list(ex_ids)
+    present=set(ex_ids)
+    units=[]
+    for ex_id in ex_ids:
+        if ex_id.endswith(SIDES[0]):
+            other=ex_id[:-len(SIDES[0])]+SIDES[1]
+            units.append((ex_id, other) if other in present else (ex_id,))
+        elif ex_id.endswith(SIDES[1]):
+            other=ex_id[:-len(SIDES[1])]+SIDES[0]
+            if other not in present:
+                units.append((ex_id,))
+        else:
+            units.append((ex_id,))
+    return units
+
+def timings(durations, rests, step, read_delay):
+    """
+    Return {time: (duration, rest)} for every time an exercise can take,
+    from durations and rests as (least, most), preferring for each time the
+    rest nearest the middle of its range
+    """
+    middle=(rests[0]+rests[1])/2
+    times={}
+    for duration in range(durations[0], durations[1]+1, step):
+        for rest in range(rests[0], rests[1]+1, step):
+            time=duration+rest+read_delay
+            best=times.get(time)
+            if best==None or abs(rest-middle)<abs(best[1]-middle):
+                times[time]=(duration, rest)
+    return times
+
+def synthesise(ex_ids, target, durations=(30, 60), rests=(0, 15), step=5,
+  read_delay=0, seed=None):
+    """
+    Return the plan of a routine taking exactly target seconds, as a list of
+    (ex_id, duration, rest, read_delay) as Routine.get_plan() gives, using
+    each of the exercises at most once.  They're taken in the order given,
+    or shuffled with seed if there is one.
+
+    Throws: ValueError if no routine takes exactly the target time
+    """
+    if durations[0]<=0 or durations[0]>durations[1] or rests[0]<0 or (
+      rests[0]>rests[1]) or step<=0:
+        raise ValueError("Durations and rests must be (least, most), and "
+          "durations and step positive")
+    units=group(ex_ids)
+    if seed!=None:
+        random.Random(seed).shuffle(units)
+    times=timings(durations, rests, step, read_delay)
+    sizes=sorted(times)
+    mask=(1<<(target+1))-1
+    # reach[n]: the seconds the first n units can take, as a bitmap
+    reach=[1]
+    weights=[0]
+    fits=[]
+    for unit in units:
+        if weights[-1]*sizes[0]>target:
+            break
+        (before, weight)=(reach[-1], len(unit))
+        after=0
+        for size in sizes:
+            after|=before<<(size*weight)
+        reach.append(after&mask)
+        weights.append(weights[-1]+weight)
+        if after>>target&1:
+            fits.append(len(reach)-1)
+    if not fits:
+        raise ValueError("No routine of exactly {0}s can be made from {1} "
+          "exercise(s)".format(target, sum(map(len, units))))
+    middle=(sizes[0]+sizes[-1])/2
+    n=min(fits, key=lambda n: (abs(target/weights[n]-middle), n))
+    # Read back a time for each unit, from the last, keeping the rest even
+    chosen=[]
+    remaining=target
+    for i in range(n, 0, -1):
+        weight=len(units[i-1])
+        even=remaining/weights[i]
+        size=min((size for size in sizes if size*weight<=remaining and
+          reach[i-1]>>(remaining-size*weight)&1),
+          key=lambda size: abs(size-even))
+        chosen.append(size)
+        remaining-=size*weight
+    plan=[]
+    for (unit, size) in zip(units, reversed(chosen)):
+        (duration, rest)=times[size]
+        plan.extend((ex_id, duration, rest, read_delay) for ex_id in unit)
+    return plan
+
+def escape(text, char):
+    return text.replace('\\', '\\\\').replace(char, '\\'+char)
+
+def routine_text(plan, name=None, description=None):
+    """
+    Return the text of a routine file running a plan, as synthesise gives
+    """
+    lines=["# Made up by synth.py to take {0}s".format(
+      sum(sum(entry[1:]) for entry in plan)
+    )]
+    if name:
+        lines.append("name="+escape(name, '='))
+    if description:
+        lines.append("description="+escape(description, '='))
+    read_delays=set(entry[3] for entry in plan)
+    if len(read_delays)==1:
+        lines.append("read_delay={0}".format(read_delays.pop()))
+        fields=3
+    else:
+        fields=4
+    lines.append("")
+    for entry in plan:
+        lines.append(",".join([escape(entry[0], ',')]+
+          [str(f) for f in entry[1:fields]]))
+    return "\n".join(lines)+"\n"
+
+#####################################################################
+# Test code
+
+import io, time, routine, library, guide, corpus
+
+class TestSynth(unittest.TestCase):
+    def outline(self, text):
+        (name, desc, plan)=routine.RoutineFile().outline(io.StringIO(text))
+        return (name, desc, plan)
+
+    def check(self, plan, target, durations=(30, 60), rests=(0, 15)):
+        self.assertEqual(sum(sum(entry[1:]) for entry in plan), target)
+        for (ex_id, duration, rest, read_delay) in plan:
+            self.assertTrue(durations[0]<=duration<=durations[1])
+            self.assertTrue(rests[0]<=rest<=rests[1])
+        ids=[entry[0] for entry in plan]
+        self.assertEqual(len(ids), len(set(ids)))
+        # Right is followed straight away by left, with the same timings
+        for (i, entry) in enumerate(plan):
+            if entry[0].endswith('_right') and entry[0][:-6]+'_left' in ids:
+                self.assertEqual(plan[i+1][0], entry[0][:-6]+'_left')
+                self.assertEqual(plan[i+1][1:], entry[1:])
+
+    def test_group(self):
+        self.assertEqual(group(['a_right', 'b', 'a_left', 'c_left', 'right']),
+          [('a_right', 'a_left'), ('b',), ('c_left',), ('right',)]
+        )
+        self.assertEqual(timings((30, 40), (0, 10), 5, 5), {35:(30, 0),
+          40:(30, 5), 45:(35, 5), 50:(40, 5), 55:(40, 10)}
+        )
+
+    def test_guide(self):
+        g=guide.Guide()
+        g.load_file("data/exercises/kettlebell.yaml")
+        ex_ids=sorted(g.get_exercise_ids())
+        plan=synthesise(ex_ids, 7*60, read_delay=5)
+        self.check(plan, 7*60)
+        text=routine_text(plan, "Seven = minutes, exactly",
+          "Made up\\by a test")
+        (name, desc, outline)=self.outline(text)
+        self.assertEqual((name, desc), ("Seven = minutes, exactly",
+          "Made up\\by a test"))
+        self.assertEqual(outline, plan)
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        self.assertEqual(rf.load_io(io.StringIO(text)).get_total_time(),
+          7*60
+        )
+        # Shuffled, but just as exact
+        self.check(synthesise(ex_ids, 7*60, read_delay=5, seed=1), 7*60)
+        # Seven exercises of at most 75s can't fill 12 minutes, nor can an
+        # odd number of seconds come from 5s steps
+        self.assertRaises(ValueError, synthesise, ex_ids, 12*60)
+        self.assertRaises(ValueError, synthesise, ex_ids, 7*60+1)
+        self.assertRaises(ValueError, synthesise, ex_ids, 60, (60, 30))
+
+    def test_scale(self):
+        ex_ids=corpus.exercise_ids(5000)+["solo_{0}".format(i)
+          for i in range(1000)]
+        for (target, durations, rests, read_delay) in ((30*60, (30, 60),
+          (0, 15), 0), (45*60, (20, 45), (10, 15), 5), (3*60*60, (30, 60),
+          (0, 15), 3)):
+            started=time.perf_counter()
+            plan=synthesise(ex_ids, target, durations, rests, 5, read_delay,
+              seed=50
+            )
+            self.assertLess(time.perf_counter()-started, 0.5)
+            self.check(plan, target, durations, rests)
+            lib=library.Library()
+            lib.add_io(io.StringIO(routine_text(plan)))
+            self.assertEqual(list(lib.get_total_times()), [target])
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,454 @@
+#!/usr/bin/python3
+"""
+Select exercises by their tags.
+
+A TagIndex gives every exercise a bit position, and holds a bitmap (a
+Python int) for each tag value, with the bits of the exercises having it
+set.  Queries are then a handful of bitwise ands and ors across whole
+bitmaps, rather than a test of every exercise:
+
+    index=tagindex.TagIndex()
+    index.watch(routinefile.guidebook)
+    index.select({'equipment':'kettlebell', 'muscles':['arms', 'core']},
+      exclude={'side':'left'})
+
+Values given for one attribute are alternatives (any will do), and every
+attribute given must match.  Tags come from each exercise's Tags in its
+guide (see Guide.get_tags); where those don't give a side, it's taken from
+an id ending _left or _right, as the guides' paired exercises are named.
+
+An index can be cached in a file, stamped with the guide files it was built
+from, and is only used again while none of them have changed.
+"""
+
+import os, gc, pickle, threading, contextlib, collections, unittest
+import guide
+
+SIDES=('left', 'right')
+
+SUFFIXES=tuple('_'+side for side in SIDES)
+
+def infer_tags(ex_id):
+    """Return the tags implied by an exercise's id"""
+    if ex_id.endswith(SUFFIXES):
+        return {'side':(ex_id.rsplit('_', 1)[1],)}
+    return {}
+
+def with_inferred(ex_id, tags):
+    """Return a guide's tags for an exercise, with those its id implies"""
+    inferred=infer_tags(ex_id)
+    inferred.update(tags)
+    return inferred
+
+def to_bitmap(bits):
+    """Return a bitmap with the given bit positions set"""
+    if not bits:
+        return 0
+    buf=bytearray(max(bits)//8+1)
+    for bit in bits:
+        buf[bit>>3]|=1<<(bit&7)
+    return int.from_bytes(buf, 'little')
+
+def from_bitmap(bitmap):
+    """Return the positions of the bits set in a bitmap, lowest first"""
+    digits=bin(bitmap)[:1:-1]
+    bits=[]
+    bit=digits.find('1')
+    while bit>=0:
+        bits.append(bit)
+        bit=digits.find('1', bit+1)
+    return bits
+
+# How many threads have the cyclic collector paused, and whether it was on
+# before the first of them did
+paused=[0, False]
+paused_lock=threading.Lock()
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    Pause the cyclic collector while the block runs.  Threads may overlap:
+    the first to pause it turns it off, and the last to finish turns it back
+    on, if it was on before.
+    """
+    with paused_lock:
+        if not paused[0]:
+            paused[1]=gc.isenabled()
+            gc.disable()
+        paused[0]+=1
+    try:
+        yield
+    finally:
+        with paused_lock:
+            paused[0]-=1
+            if not paused[0] and paused[1]:
+                gc.enable()
+
+class TagIndex(object):
+    def __init__(self):
+        self.ids=[]             # Bit position -> ex_id, or None if free
+        self.bits={}            # ex_id -> bit position
+        self.free=[]            # Positions freed by removals, for reuse
+        self.tags={}            # ex_id -> {attribute: values}
+        self.owners={}          # ex_id -> the guide it was indexed from,
+                                # or its filename in a cached index
+        self.guides=[]          # Every guide indexed, in the order added,
+                                # or their filenames in a cached index
+        self.bitmaps={}         # (attribute, value) -> bitmap
+        self.live=0             # Bitmap of every exercise indexed
+        self.stamps=None        # What a cached index was built from
+
+    def __len__(self):
+        return len(self.bits)
+
+    def update(self, entries, owner=None):
+        """
+        Index (ex_id, tags) pairs, tags as {attribute: values}, replacing
+        any earlier entries for the same ids
+        """
+        # A bulk build allocates a few containers per exercise, each batch
+        # of which would set the cyclic collector scanning the whole of the
+        # growing index again; none of it can form a cycle
+        with gc_paused():
+            self.__update(entries, owner)
+
+    def __update(self, entries, owner):
+        entries=list(entries)
+        if self.bits:
+            self.discard(ex_id for (ex_id, tags) in entries)
+        (ids, free)=(self.ids, self.free)
+        positions=collections.defaultdict(list)
+        added=[]
+        for (ex_id, tags) in entries:
+            if free:
+                bit=free.pop()
+                ids[bit]=ex_id
+            else:
+                bit=len(ids)
+                ids.append(ex_id)
+            self.bits[ex_id]=bit
+            self.tags[ex_id]=tags
+            self.owners[ex_id]=owner
+            added.append(bit)
+            for (attribute, values) in tags.items():
+                for value in values:
+                    positions[attribute, value].append(bit)
+        # Built a whole bitmap at a time; or-ing in one bit at a time would
+        # copy the bitmap for every exercise
+        for (key, bits) in positions.items():
+            self.bitmaps[key]=self.bitmaps.get(key, 0)|to_bitmap(bits)
+        self.live|=to_bitmap(added)
+
+    def add(self, ex_id, tags, owner=None):
+        self.update([(ex_id, tags)], owner)
+
+    def discard(self, ex_ids):
+        """Remove the given ids from the index, where they're in it"""
+        removed=[]
+        keys=set()
+        for ex_id in ex_ids:
+            bit=self.bits.pop(ex_id, None)
+            if bit==None:
+                continue
+            for (attribute, values) in self.tags.pop(ex_id).items():
+                keys.update((attribute, value) for value in values)
+            del self.owners[ex_id]
+            self.ids[bit]=None
+            self.free.append(bit)
+            removed.append(bit)
+        if not removed:
+            return
+        mask=~to_bitmap(removed)
+        for key in keys:
+            self.bitmaps[key]&=mask
+            if not self.bitmaps[key]:
+                del self.bitmaps[key]
+        self.live&=mask
+
+    def add_guide(self, g):
+        """Index every exercise in a guide"""
+        if not any(other is g for other in self.guides):
+            self.guides.append(g)
+        self.update(((ex_id, with_inferred(ex_id, tags))
+          for (ex_id, name, desc, tips, tags) in g.get_entries()), g)
+
+    def update_guide(self, g, ex_ids):
+        """
+        Re-index the given exercises of a guide, as Guide.reload() returns
+        them: each from the last guide defining it, which may now be an
+        earlier one, or not at all if none do.  A cached index knows its
+        guides only by filename, so re-indexes from g alone, and only the
+        exercises it had from g's file.
+        """
+        filename=getattr(g, 'filename', None)
+        guides=[other for other in self.guides if not isinstance(other, str)]
+        for ex_id in ex_ids:
+            owner=self.owners.get(ex_id)
+            if isinstance(owner, str) and owner!=filename:
+                continue
+            found=guide.find_entry(guides, g, ex_id)
+            if found:
+                (owner, (name, desc, tips, tags))=found
+                self.update([(ex_id, with_inferred(ex_id, tags))], owner)
+            else:
+                self.discard([ex_id])
+
+    def watch(self, guidebook):
+        """Index a GuideBook's guides, and any added to it from now on"""
+        for g in guidebook.get_guides():
+            self.add_guide(g)
+        guidebook.add_listener(self.add_guide)
+
+    def get_values(self, attribute):
+        """Return every value of an attribute that some exercise has"""
+        return sorted(value for (a, value) in self.bitmaps if a==attribute)
+
+    def get_bitmap(self, attribute, value):
+        """Return the bitmap of the exercises tagged attribute: value"""
+        return self.bitmaps.get((attribute, value), 0)
+
+    def __match(self, attribute, values):
+        if isinstance(values, str):
+            return self.get_bitmap(attribute, values)
+        bitmap=0
+        for value in values:
+            bitmap|=self.get_bitmap(attribute, value)
+        return bitmap
+
+    def query(self, criteria, exclude=None):
+        """
+        Return the bitmap of the exercises matching every attribute in
+        criteria, {attribute: value or list of values}, and none in exclude
+        """
+        bitmap=self.live
+        for (attribute, values) in criteria.items():
+            bitmap&=self.__match(attribute, values)
+            if not bitmap:
+                return 0
+        for (attribute, values) in (exclude or {}).items():
+            bitmap&=~self.__match(attribute, values)
+        return bitmap
+
+    def get_ids(self, bitmap):
+        """Return the exercise ids in a bitmap"""
+        return [self.ids[bit] for bit in from_bitmap(bitmap)]
+
+    def count(self, bitmap):
+        return bin(bitmap).count('1')
+
+    def select(self, criteria, exclude=None):
+        """
+        Return the ids of the exercises matching criteria and not exclude,
+        as for query
+        """
+        return self.get_ids(self.query(criteria, exclude))
+
+    @staticmethod
+    def stamp(filenames):
+        stamps=[]
+        for filename in filenames:
+            st=os.stat(filename)
+            stamps.append((filename, st.st_mtime_ns, st.st_size))
+        return tuple(stamps)
+
+    @staticmethod
+    def load_cache(filename, guide_filenames):
+        """
+        Return the index cached in a file, if it was built from the named
+        guide files as they are now, or else None: also if the file is
+        missing, truncated or otherwise doesn't unpickle to an index, so it
+        can just be built again
+        """
+        try:
+            with open(filename, 'rb') as f:
+                index=pickle.load(f)
+        except Exception:
+            # Unpickling garbage can raise almost anything
+            return None
+        if not isinstance(index, TagIndex):
+            return None
+        try:
+            if index.stamps==TagIndex.stamp(guide_filenames):
+                return index
+        except OSError:
+            pass
+        return None
+
+    def save_cache(self, filename, guide_filenames):
+        """Cache the index in a file, as built from the named guide files"""
+        self.stamps=TagIndex.stamp(guide_filenames)
+        (owners, guides)=(self.owners, self.guides)
+        # The guides themselves aren't worth keeping, only which file each
+        # exercise came from
+        def name(owner):
+            return owner if isinstance(owner, str) else \
+              getattr(owner, 'filename', None)
+        self.owners={ex_id:name(owner) for (ex_id, owner) in owners.items()}
+        self.guides=[name(g) for g in guides]
+        try:
+            with open(filename+".new", 'wb') as f:
+                pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            (self.owners, self.guides)=(owners, guides)
+        os.replace(filename+".new", filename)
+
+#####################################################################
+# Test code
+
+import io, time, random, tempfile, guide, corpus
+
+class TestTagIndex(unittest.TestCase):
+    def setUp(self):
+        self.g=guide.Guide()
+        self.g.load_file("data/exercises/kettlebell.yaml")
+
+    def test_bitmaps(self):
+        for bits in ([], [0], [3, 9, 64, 65, 1000]):
+            self.assertEqual(from_bitmap(to_bitmap(bits)), bits)
+        self.assertEqual(to_bitmap([1, 3]), 0b1010)
+        self.assertEqual(infer_tags("kettle_press_left"), {'side':('left',)})
+        self.assertEqual(infer_tags("right"), {})
+        self.assertEqual(infer_tags("kettle_swing"), {})
+
+    def test_guide(self):
+        index=TagIndex()
+        index.add_guide(self.g)
+        self.assertEqual(len(index), 7)
+        self.assertEqual(sorted(index.select({'muscles':'arms',
+          'side':'left'})), ['kettle_clean_left', 'kettle_press_left']
+        )
+        self.assertEqual(sorted(index.select({'muscles':['core', 'back']},
+          exclude={'side':SIDES})), ['kettle_swing']
+        )
+        self.assertEqual(len(index.select({})), 7)
+        self.assertEqual(index.select({'muscles':'toes'}), [])
+        self.assertEqual(index.get_values('side'), ['left', 'right'])
+        # Side comes from the id where the guide doesn't give one
+        g=guide.Guide()
+        g.load_io(io.StringIO("squat_left:\n  Name: Squat\n  Tags:\n"
+          "    muscles: legs\n"))
+        index.add_guide(g)
+        self.assertIn('squat_left', index.select({'side':'left',
+          'muscles':'legs'}))
+
+    def test_update(self):
+        book=guide.GuideBook()
+        index=TagIndex()
+        index.watch(book)
+        book.add_guide(self.g)
+        before=index.select({'muscles':'shoulders'})
+        self.g.tags['kettle_swing']={'muscles':('shoulders',)}
+        del self.g.exercises['kettle_press_left']
+        index.update_guide(self.g, ['kettle_swing', 'kettle_press_left'])
+        self.assertEqual(sorted(index.select({'muscles':'shoulders'})),
+          sorted(set(before)-set(['kettle_press_left'])|set(['kettle_swing']))
+        )
+        self.assertEqual(index.select({'muscles':'core', 'side':'right'}),
+          ['kettle_lunge_right']
+        )
+        self.assertNotIn(('muscles', 'legs'), [key for key in index.bitmaps
+          if not index.bitmaps[key]])
+        # An earlier guide's definition is indexed again once the later one
+        # drops it
+        g2=guide.Guide()
+        g2.load_io(io.StringIO("kettle_lunge_right:\n  Name: Lunge\n"
+          "  Tags: {muscles: legs}\n"))
+        try:
+            book.add_guide(g2)
+        except Warning:
+            pass
+        self.assertEqual(index.select({'muscles':'core', 'side':'right'}), [])
+        del g2.exercises['kettle_lunge_right']
+        index.update_guide(g2, ['kettle_lunge_right'])
+        self.assertEqual(index.select({'muscles':'core', 'side':'right'}),
+          ['kettle_lunge_right']
+        )
+        self.assertIs(index.owners['kettle_lunge_right'], self.g)
+        # Freed positions are reused
+        size=len(index.ids)
+        index.add('new_exercise', {'muscles':('legs',)})
+        self.assertEqual(len(index.ids), size)
+        self.assertIn('new_exercise', index.select({'muscles':'legs'}))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            filename=os.path.join(d, 'guide.yaml')
+            with open(filename, 'w') as f:
+                f.write("a_left:\n  Name: A\n  Tags: {muscles: arms}\n")
+            cache=os.path.join(d, 'tags.cache')
+            self.assertEqual(TagIndex.load_cache(cache, [filename]), None)
+            g=guide.Guide()
+            g.load_file(filename)
+            index=TagIndex()
+            index.add_guide(g)
+            index.save_cache(cache, [filename])
+            self.assertIs(index.owners['a_left'], g)
+            cached=TagIndex.load_cache(cache, [filename])
+            self.assertEqual(cached.select({'side':'left'}), ['a_left'])
+            # Updates from the guide reach a cached index too
+            g.tags['a_left']={'muscles':('legs',)}
+            cached.update_guide(g, ['a_left'])
+            self.assertEqual(cached.select({'muscles':'legs'}), ['a_left'])
+            self.assertIs(cached.owners['a_left'], g)
+            self.assertEqual(cached.guides, [filename])
+            with open(filename, 'a') as f:
+                f.write("b:\n  Name: B\n")
+            self.assertEqual(TagIndex.load_cache(cache, [filename]), None)
+            # Anything that isn't an index is rebuilt rather than used
+            with open(cache, 'rb') as f:
+                truncated=f.read()[:-10]
+            for junk in (b"", b"junk", pickle.dumps({'a':1}), truncated,
+              b"\x80\x04c__main__\nNope\n."):
+                with open(cache, 'wb') as f:
+                    f.write(junk)
+                self.assertEqual(TagIndex.load_cache(cache, [filename]), None)
+
+    def test_scale(self):
+        rand=random.Random(47)
+        muscles=("arms", "legs", "core", "back", "shoulders", "chest")
+        equipment=("kettlebell", "dumbbell", "band", "none")
+        entries=[(ex_id, {'equipment':(rand.choice(equipment),),
+          'muscles':tuple(rand.sample(muscles, 2))})
+          for ex_id in corpus.exercise_ids(100000)]
+        index=TagIndex()
+        started=time.perf_counter()
+        index.update((ex_id, dict(tags, **infer_tags(ex_id)))
+          for (ex_id, tags) in entries)
+        self.assertLess(time.perf_counter()-started, 2)
+        criteria={'equipment':['kettlebell', 'band'], 'muscles':'core',
+          'side':'left'}
+        started=time.perf_counter()
+        for i in range(100):
+            bitmap=index.query(criteria, exclude={'muscles':'arms'})
+        self.assertLess((time.perf_counter()-started)/100, 0.005)
+        expected=[ex_id for (ex_id, tags) in entries
+          if tags['equipment'][0] in ('kettlebell', 'band')
+          and 'core' in tags['muscles'] and 'arms' not in tags['muscles']
+          and ex_id.endswith('_left')]
+        self.assertEqual(index.count(bitmap), len(expected))
+        self.assertEqual(index.get_ids(bitmap), expected)
+
+    def test_gc_paused(self):
+        collecting=gc.isenabled()
+        gc.enable()
+        try:
+            # Two threads' builds overlapping: the collector stays off until
+            # the last of them is done
+            (first, second)=(gc_paused(), gc_paused())
+            first.__enter__()
+            second.__enter__()
+            first.__exit__(None, None, None)
+            self.assertFalse(gc.isenabled())
+            second.__exit__(None, None, None)
+            self.assertTrue(gc.isenabled())
+            # ...and stays off after, if it was off before
+            gc.disable()
+            with gc_paused():
+                pass
+            self.assertFalse(gc.isenabled())
+        finally:
+            if collecting:
+                gc.enable()
+
+if __name__=="__main__":
+    unittest.main()
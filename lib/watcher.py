@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+"""
+Hot reloading of guides and routines while they're in use.
+
+A Watcher polls the files it's given with os.stat, calling back when one's
+modification time or size changes; polling costs a stat per file per
+interval, and needs nothing outside the standard library.  A Reloader uses a
+Watcher to keep live Guides and Routines up to date with their files:
+
+    reloader=watcher.Reloader(routinefile)
+    reloader.watch_guide(g)
+    reloader.watch_routine(r, "data/routines/upperbody2")
+    reloader.start()
+
+When a guide changes, only the exercises whose definitions changed are
+swapped in, and only the exercises still to come in each watched routine are
+re-prepared.  When a routine file changes, it's re-read without preparing
+anything, and just the lines that differ are prepared and patched in.  An
+exercise already in progress is always left to finish as it was.  A file
+that fails to parse is logged and otherwise ignored, until it's fixed.
+"""
+
+import os, logging, threading, unittest
+import routine, exceptions
+
+class Watcher(threading.Thread):
+    def __init__(self, interval=1):
+        super().__init__(daemon=True)
+        self.interval=interval
+        self.files={}       # filename -> [stamp, callbacks]
+        self.stopping=threading.Event()
+        self.logger=logging.getLogger(__name__)
+
+    def stamp(self, filename):
+        try:
+            stat=os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def watch(self, filename, callback):
+        """Call callback(filename) whenever the file changes"""
+        if filename in self.files:
+            self.files[filename][1].append(callback)
+        else:
+            self.files[filename]=[self.stamp(filename), [callback]]
+
+    def check(self):
+        """
+        Check each file now, calling back for any which have changed since
+        the last check.  Returns the list of changed files.
+        """
+        changed=[]
+        for (filename, entry) in list(self.files.items()):
+            stamp=self.stamp(filename)
+            if stamp!=entry[0]:
+                entry[0]=stamp
+                changed.append(filename)
+                if stamp!=None:
+                    for callback in entry[1]:
+                        callback(filename)
+        return changed
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            # Keep watching whatever goes wrong; a file fixed later is still
+            # picked up
+            try:
+                self.check()
+            except Exception:
+                self.logger.exception("Error checking watched files")
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+
+class Reloader(object):
+    def __init__(self, routinefile=None, watcher=None):
+        """
+        Optional parameters:
+            routinefile The RoutineFile whose guidebook and default settings
+                        watched routine files are read with
+            watcher     The Watcher to use; by default a new one, polling
+                        every second
+        """
+        self.routinefile=routinefile if routinefile else routine.RoutineFile()
+        self.settings=dict(self.routinefile.settings)
+        self.watcher=watcher if watcher else Watcher()
+        self.routines=[]
+        self.logger=logging.getLogger(__name__)
+
+    def watch_guide(self, g):
+        """Reload the guide whenever its file changes"""
+        self.watcher.watch(g.filename, lambda filename: self.reload_guide(g))
+
+    def watch_routine(self, r, filename):
+        """
+        Keep the routine, loaded from filename, up to date with both the file
+        and any watched guides
+        """
+        self.routines.append(r)
+        self.watcher.watch(filename,
+          lambda filename: self.reload_routine(r, filename)
+        )
+
+    def reload_guide(self, g):
+        try:
+            changed=g.reload()
+        except (exceptions.BaseTrainingException, OSError) as e:
+            self.logger.warning("Not reloading %s: %s", g.filename, e)
+            return
+        self.logger.info("Reloaded %s: %d exercise(s) changed", g.filename,
+          len(changed)
+        )
+        if changed:
+            for r in self.routines:
+                self.__update(r, r.get_plan(), changed)
+
+    def reload_routine(self, r, filename):
+        # Read with the defaults in place when the routine was first loaded,
+        # not any the last file read left behind.  The file sets defaults as
+        # it's read, so it gets a RoutineFile of its own, leaving the shared
+        # one alone while other threads use it.
+        routinefile=routine.RoutineFile()
+        routinefile.settings=dict(self.settings)
+        try:
+            with open(filename) as f:
+                (name, desc, plan)=routinefile.outline(f)
+        except (exceptions.BaseTrainingException, OSError) as e:
+            self.logger.warning("Not reloading %s: %s", filename, e)
+            return
+        if name!=None:
+            r.set_name(name)
+        if desc!=None:
+            r.set_description(desc)
+        prepared=self.__update(r, plan)
+        self.logger.info("Reloaded %s: %s exercise(s) prepared", filename,
+          prepared
+        )
+
+    def __update(self, r, plan, changed=()):
+        try:
+            return r.update(plan, changed)
+        except KeyError as e:
+            self.logger.warning("Not updating %s: %s", r.get_name(), e)
+
+    def start(self):
+        self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+
+#####################################################################
+# Test code
+
+import time, tempfile, guide, clocks
+from sounderinterface import QuietSounder
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.dir=tempfile.TemporaryDirectory()
+        self.mtime=1000000000
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, text):
+        filename=os.path.join(self.dir.name, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        # Make sure the change shows, however coarse the filesystem's times
+        self.mtime+=1
+        os.utime(filename, (self.mtime, self.mtime))
+        return filename
+
+    def test_watcher(self):
+        filename=self.write('watched', 'one')
+        seen=[]
+        w=Watcher()
+        w.watch(filename, seen.append)
+        self.assertEqual(w.check(), [])
+        self.write('watched', 'two')
+        self.assertEqual(w.check(), [filename])
+        self.assertEqual(seen, [filename])
+        self.assertEqual(w.check(), [])
+        os.remove(filename)
+        self.assertEqual(w.check(), [filename])
+        self.assertEqual(seen, [filename])
+
+    def test_thread(self):
+        filename=self.write('watched', 'one')
+        event=threading.Event()
+        w=Watcher(0.01)
+        w.watch(filename, lambda filename: event.set())
+        w.start()
+        try:
+            self.write('watched', 'two')
+            self.assertTrue(event.wait(5))
+        finally:
+            w.stop()
+
+    def test_reloader(self):
+        guide_file=self.write('guide.yaml',
+          "a:\n  Name: A\nb:\n  Name: B\n"
+        )
+        routine_file=self.write('routine', "name=Test\na,1,1,1\nb,1,1,1\n")
+        g=guide.Guide()
+        g.load_file(guide_file)
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        r=routine.Routine(rf.guidebook, clocks.VirtualClock())
+        rf.load_file_into(r, routine_file)
+        for ex in r.exercises:
+            ex.sounder=QuietSounder()
+        first=r.exercises[0]
+        rf.set_default('rest', '4')
+        rf.set_default('read_delay', '4')
+        reloader=Reloader(rf)
+        reloader.watch_guide(g)
+        reloader.watch_routine(r, routine_file)
+
+        self.write('guide.yaml', "a:\n  Name: A\nb:\n  Name: Bee\n")
+        reloader.watcher.check()
+        self.assertIs(r.exercises[0], first)
+        self.assertEqual(r.exercises[1].name, "Bee")
+        self.assertIsInstance(r.exercises[1].sounder, QuietSounder)
+
+        self.write('routine', "name=Renamed\na,1,1,1\nb,2,1,1\na,3,1,1\n")
+        reloader.watcher.check()
+        self.assertEqual(r.get_name(), "Renamed")
+        self.assertIs(r.exercises[0], first)
+        self.assertEqual([ex.duration for ex in r.exercises], [1, 2, 3])
+
+        # Defaults the file sets apply to it alone
+        settings=dict(rf.settings)
+        self.write('routine', "rest=9\na,1,1,1\nb,2,1,1\na,3,1,1\n")
+        reloader.watcher.check()
+        self.assertEqual(rf.settings, settings)
+        self.assertEqual([ex.rest for ex in r.exercises], [1, 1, 1])
+        self.write('routine', "a,1,1,1\nb,2,1,1\na,3\n")
+        reloader.watcher.check()
+        self.assertEqual(rf.settings, settings)
+        self.assertEqual(r.exercises[2].rest, 4)
+
+        # Broken files are ignored until they're fixed
+        logging.disable(logging.WARNING)
+        try:
+            self.write('routine', "a,1,1,1\nc,1,1,1\n")
+            reloader.watcher.check()
+            self.write('guide.yaml', "a:\n  Name: [A\n")
+            reloader.watcher.check()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(len(r.exercises), 3)
+        self.assertEqual(r.exercises[1].name, "Bee")
+
+    def start_reloader(self, guide_text, routine_text):
+        guide_file=self.write('guide.yaml', guide_text)
+        routine_file=self.write('routine', routine_text)
+        g=guide.Guide()
+        g.load_file(guide_file)
+        rf=routine.RoutineFile()
+        rf.add_guide(g)
+        r=routine.Routine(rf.guidebook, clocks.VirtualClock())
+        rf.load_file_into(r, routine_file)
+        for ex in r.exercises:
+            ex.sounder=QuietSounder()
+        reloader=Reloader(rf, Watcher(0.01))
+        reloader.watch_guide(g)
+        reloader.watch_routine(r, routine_file)
+        reloader.start()
+        self.addCleanup(reloader.stop)
+        return (reloader, r)
+
+    def wait_for(self, condition):
+        for i in range(500):
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_empty_guide(self):
+        (reloader, r)=self.start_reloader("a:\n  Name: A\n", "a,1,1,1\n")
+        logging.disable(logging.WARNING)
+        try:
+            # Not a mapping at all
+            self.write('guide.yaml', "")
+            time.sleep(0.1)
+            self.write('guide.yaml', "- a\n- b\n")
+            time.sleep(0.1)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(reloader.watcher.is_alive())
+        self.write('guide.yaml', "a:\n  Name: Eh\n")
+        self.assertTrue(self.wait_for(lambda: r.exercises[0].name=="Eh"))
+
+    def test_routine_error(self):
+        (reloader, r)=self.start_reloader("a:\n  Name: A\n", "a,1,1,1\n")
+        logging.disable(logging.WARNING)
+        try:
+            # A DefaultError, rather than a ParseError
+            self.write('routine', "a,1\n")
+            time.sleep(0.1)
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(reloader.watcher.is_alive())
+        self.write('routine', "a,2,1,1\n")
+        self.assertTrue(self.wait_for(lambda: r.exercises[0].duration==2))
+
+    def test_callback_error(self):
+        filename=self.write('watched', 'one')
+        calls=[]
+        event=threading.Event()
+        def callback(filename):
+            calls.append(filename)
+            event.set()
+            if len(calls)==1:
+                raise RuntimeError("Broken callback")
+        w=Watcher(0.01)
+        w.watch(filename, callback)
+        logging.disable(logging.ERROR)
+        w.start()
+        try:
+            self.write('watched', 'two')
+            self.assertTrue(event.wait(5))
+            time.sleep(0.05)
+            self.assertTrue(w.is_alive())
+            event.clear()
+            self.write('watched', 'three')
+            self.assertTrue(event.wait(5))
+            self.assertEqual(len(calls), 2)
+        finally:
+            w.stop()
+            logging.disable(logging.NOTSET)
+
+if __name__=="__main__":
+    unittest.main()
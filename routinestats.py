@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+helptext="""\
+Usage: routinestats.py [-h] [-c cachefile] [-b seconds] [-n count] paths...
+
+Report statistics across a library of routine files: the seconds of work
+programmed for each exercise, how work compares to rest, and which routines
+run over a time budget.  Directories are searched for routine files.
+
+Optional arguments:
+ -c cachefile  Keep the parsed library in cachefile between runs, reading
+               only the routine files changed since
+ -b seconds    List the routines taking longer than this
+ -n count      How many exercises to list, most programmed first (default 20)
+"""
+
+import os,sys,getopt
+
+sys.path.append('./lib')
+import library
+
+def find(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for (dirpath,dirnames,filenames) in sorted(os.walk(path)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if not filename.startswith('.'):
+                        yield os.path.join(dirpath,filename)
+        else:
+            yield path
+
+def main(argv):
+    try:
+        (opts,args)=getopt.getopt(argv,"hc:b:n:",["help"])
+    except getopt.GetoptError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    cache=None
+    budget=None
+    count=20
+    try:
+        for (opt,val) in opts:
+            if opt in ('-h','--help'):
+                print(helptext)
+                return 0
+            elif opt=='-c':
+                cache=val
+            elif opt=='-b':
+                budget=int(val)
+            elif opt=='-n':
+                count=int(val)
+    except ValueError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    if len(args)==0:
+        print(helptext)
+        return 2
+
+    lib=library.Library()
+    lib.load(find(args),cache)
+    for (filename,error) in sorted(lib.errors.items()):
+        print("Skipped {0}: {1}".format(filename,error.split('\n')[0]))
+    print("{0} routine(s), {1} distinct exercise(s)".format(len(lib),
+      len(lib.ids)
+    ))
+
+    print("\nSeconds of work by exercise:")
+    seconds=sorted(lib.get_exercise_seconds().items(),
+      key=lambda item:(-item[1],item[0])
+    )
+    for (ex_id,total) in seconds[:count]:
+        print("  {0:>8}  {1}".format(total,ex_id))
+
+    print("\nWork:rest ratios:")
+    bounds=(0.5,1,2,4)
+    labels=["below 1:2"]+["{0:g}:1 to {1:g}:1".format(low,high)
+      for (low,high) in zip(bounds,bounds[1:])]+["4:1 and up (or no rest)"]
+    for (label,n) in zip(labels,lib.get_ratio_distribution(bounds)):
+        print("  {0:>8}  {1}".format(n,label))
+
+    if budget!=None:
+        print("\nOver {0}s:".format(budget))
+        for (filename,total) in lib.get_over_budget(budget):
+            print("  {0:>8}  {1}".format(total,filename))
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
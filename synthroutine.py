@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+helptext="""\
+Usage: synthroutine.py [-h] [-g guide]... [-f attribute=values]...
+                       [-d least-most] [-r least-most] [-s step]
+                       [-i read_delay] [-S seed] [-n name] [-o file] time
+
+Make up a routine file taking exactly time, given as minutes or m:ss, from
+the exercises in the guides.  Right and left variants run one after the
+other with the same timings.
+
+Optional arguments:
+ -g guide        A guide to take exercises from; may be given more than
+                 once (default data/exercises/kettlebell.yaml)
+ -f attribute=values
+                 Only use exercises tagged with one of the comma separated
+                 values; may be given more than once, for each attribute
+ -d least-most   Seconds each exercise may last (default 30-60)
+ -r least-most   Seconds of rest after each exercise (default 0-15)
+ -s step         Seconds to change durations and rests by (default 5)
+ -i read_delay   Seconds to read about each exercise first (default 0)
+ -S seed         Shuffle the exercises with this seed, rather than taking
+                 them in order of their ids
+ -n name         The routine's name
+ -o file         Write the routine here rather than to the screen
+"""
+
+import sys,getopt
+
+sys.path.append('./lib')
+import guide,tagindex,synth,exceptions
+
+def parse_range(text):
+    (least,dash,most)=text.partition('-')
+    if not dash:
+        raise ValueError("{0} is not a range least-most".format(repr(text)))
+    return (int(least),int(most))
+
+def parse_time(text):
+    (minutes,colon,seconds)=text.partition(':')
+    if colon:
+        return int(minutes)*60+int(seconds)
+    return int(round(float(minutes)*60))
+
+def main(argv):
+    try:
+        (opts,args)=getopt.getopt(argv,"hg:f:d:r:s:i:S:n:o:",["help"])
+    except getopt.GetoptError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+    guide_files=[]
+    criteria={}
+    settings={}
+    name=None
+    outfile=None
+    try:
+        for (opt,val) in opts:
+            if opt in ('-h','--help'):
+                print(helptext)
+                return 0
+            elif opt=='-g':
+                guide_files.append(val)
+            elif opt=='-f':
+                (attribute,equals,values)=val.partition('=')
+                if not equals:
+                    raise ValueError("{0} is not attribute=values".format(
+                      repr(val)
+                    ))
+                criteria[attribute]=values.split(',')
+            elif opt=='-d':
+                settings['durations']=parse_range(val)
+            elif opt=='-r':
+                settings['rests']=parse_range(val)
+            elif opt=='-s':
+                settings['step']=int(val)
+            elif opt=='-i':
+                settings['read_delay']=int(val)
+            elif opt=='-S':
+                settings['seed']=val
+            elif opt=='-n':
+                name=val
+            elif opt=='-o':
+                outfile=val
+        if len(args)!=1:
+            print(helptext)
+            return 2
+        target=parse_time(args[0])
+    except ValueError as e:
+        print(str(e))
+        print(helptext)
+        return 2
+
+    index=tagindex.TagIndex()
+    try:
+        for filename in guide_files or ["data/exercises/kettlebell.yaml"]:
+            g=guide.Guide()
+            g.load_file(filename)
+            index.add_guide(g)
+    except (OSError,exceptions.ParseError) as e:
+        print(str(e))
+        return 1
+    try:
+        plan=synth.synthesise(sorted(index.select(criteria)),target,
+          **settings
+        )
+    except ValueError as e:
+        print(str(e))
+        return 1
+    text=synth.routine_text(plan,name or "{0}'{1:02d}\" routine".format(
+      target//60,target%60
+    ))
+    if outfile:
+        with open(outfile,'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv[1:]))
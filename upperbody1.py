@@ -1,37 +1,151 @@
 #!/usr/bin/python3
 
-import sys,logging
+helptext="""\
+Usage: upperbody1.py [-h] [-d] [-s socket] [-c file] [-p]
+                     [--profile-out file]
+
+Run the upper body kettlebell routine
+
+Optional arguments:
+ -d         Run the routine through the intertrain daemon (intertraind.py),
+            if one is listening, rather than loading everything here
+ -s socket  The daemon's socket, if not the default
+ -c, --checkpoint file
+            Record progress through the routine to file as it runs, and if
+            the file is already there, resume from where it left off.  The
+            file is removed once the routine completes.  Routines run
+            here only, so this can't be used with -d
+ -p, --profile
+            Profile loading and running the routine, reporting the time
+            taken by each section (importing, loading guides, parsing the
+            routine, preparing and running each exercise) when done
+ --profile-out file
+            Where to write the full profile, for pstats (default
+            upperbody1.prof)
+"""
+
+import sys,os,getopt
 
 sys.path.append('./lib')
-import exercise,routine,guide
+import profiling
 
 max_line=79
+guide_files=["data/exercises/kettlebell.yaml"]
+routine_file="data/routines/upperbody2"
+
+def print_header(name,total_time,desc):
+    duration_string=str(int(total_time/60))+"'{0:02d}\"".format(total_time%60)
+
+    print("*"*70)
+    print("*",name,"("+duration_string+")")
+    i=0
+    while i<len(desc):
+        full_line=desc[i:i+max_line+1]
+        if len(full_line)==max_line+1:
+            last_word=full_line.rindex(' ')
+            if last_word==0: last_word=len(full_line)
+            line=full_line[:full_line.rindex(" ")]
+        else:
+            line=full_line
+        print("*",line)
+        i=i+len(line)+1
+    print("*"*70)
+
+def run_daemon(path):
+    """
+    Run the routine in the daemon.  Returns False if there's no daemon to
+    talk to.
+    """
+    import daemonclient
+    client=daemonclient.DaemonClient(path)
+    guides=[os.path.abspath(g) for g in guide_files]
+    routine=os.path.abspath(routine_file)
+    try:
+        with profiler.section("daemon prepare"):
+            info=client.prepare(routine,guides)
+    except OSError:
+        return False
+    print_header(info['name'],info['total_time'],info['description'])
+    with profiler.section("daemon run"):
+        client.run(routine,guides)
+    return True
 
-guide=guide.Guide()
-guide.load_file("data/exercises/kettlebell.yaml")
-routinefile=routine.RoutineFile()
-routinefile.add_guide(guide)
-routine=routinefile.load_file("data/routines/upperbody2")
-
-logging.basicConfig(format='%(message)s')
-logging.getLogger('exercise').setLevel(logging.INFO)
-
-duration_string=str(int(routine.get_total_time()/60))+"'{0:02d}\"".format(routine.get_total_time()%60)
-
-print("*"*70)
-print("*",routine.get_name(),"("+duration_string+")")
-desc=routine.get_description()
-i=0
-while i<len(desc):
-    full_line=desc[i:i+max_line+1]
-    if len(full_line)==max_line+1:
-        last_word=full_line.rindex(' ')
-        if last_word==0: last_word=len(full_line)
-        line=full_line[:full_line.rindex(" ")]
+def run_local():
+    with profiler.section("import"):
+        import logging
+        import exercise,routine,guide
+
+    routinefile=routine.RoutineFile()
+    with profiler.section("load guides"):
+        for filename in guide_files:
+            g=guide.Guide()
+            g.load_file(filename)
+            routinefile.add_guide(g)
+    r=routine.Routine(routinefile.guidebook)
+    r.set_profiler(profiler)
+    with profiler.section("parse routine"):
+        routinefile.load_file_into(r,routine_file)
+
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('exercise').setLevel(logging.INFO)
+
+    print_header(r.get_name(),r.get_total_time(),r.get_description())
+    if checkpoint_file:
+        import checkpoint
+        cp=checkpoint.Checkpoint(checkpoint_file)
+        offset=cp.get_offset()
+        if offset:
+            print("Resuming {0}s in".format(int(offset)))
+        with checkpoint.Checkpointer(r,cp):
+            r.start(offset)
     else:
-        line=full_line
-    print("*",line)
-    i=i+len(line)+1
-print("*"*70)
+        r.start()
 
-routine.start()
+try:
+    (opts,args)=getopt.getopt(sys.argv[1:],"hds:c:p",
+      ["help","daemon","checkpoint=","profile","profile-out="]
+    )
+except getopt.GetoptError as e:
+    print(str(e))
+    print(helptext)
+    sys.exit(2)
+
+use_daemon=False
+socket_path=None
+checkpoint_file=None
+profiler=profiling.null
+profile_out="upperbody1.prof"
+for (opt,val) in opts:
+    if opt in ('-h','--help'):
+        print(helptext)
+        sys.exit(0)
+    elif opt in ('-d','--daemon'):
+        use_daemon=True
+    elif opt=='-s':
+        socket_path=val
+    elif opt in ('-c','--checkpoint'):
+        checkpoint_file=val
+    elif opt in ('-p','--profile'):
+        profiler=profiling.Profiler()
+    elif opt=='--profile-out':
+        profile_out=val
+if use_daemon and checkpoint_file:
+    print("Checkpoints are only kept for routines run here, not with -d")
+    print(helptext)
+    sys.exit(2)
+
+profiler.start()
+try:
+    if use_daemon:
+        import daemonclient
+        if not run_daemon(socket_path or daemonclient.DEFAULT_SOCKET):
+            print("No daemon running; loading the routine locally")
+            run_local()
+    else:
+        run_local()
+finally:
+    profiler.stop()
+    if profiler.enabled:
+        profiler.report()
+        profiler.dump(profile_out)
+        print("Full profile written to",profile_out,file=sys.stderr)